@@ -0,0 +1,50 @@
+import argparse
+import sys
+
+from . import domain, harness, http, repository
+
+# Запуск из корня проекта: PYTHONPATH=src python -m benchmarks --group domain --output results.json.
+# Базовая линия - такой же файл с эталонной машины: --baseline baseline.json --threshold 0.1.
+# repository требует PostgreSQL (config.get_postgres_uri()), http - запущенное API
+GROUPS = {
+    'domain': domain.SCENARIOS,
+    'repository': repository.SCENARIOS,
+    'http': http.SCENARIOS,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Замеры скорости домена, репозитория и API')
+    parser.add_argument('--group', action='append', choices=sorted(GROUPS),
+                        help='группа сценариев, можно несколько; по умолчанию domain')
+    parser.add_argument('--filter', default='', help='подстрока имени сценария')
+    parser.add_argument('--repeat', type=int, default=None, help='замеряемых прогонов сценария')
+    parser.add_argument('--output', help='файл JSON для результатов')
+    parser.add_argument('--baseline', help='файл JSON с результатами базовой линии')
+    parser.add_argument('--threshold', type=float, default=0.1, help='допустимое замедление, 0.1 - на 10%%')
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario for group in args.group or ['domain'] for scenario in GROUPS[group]
+                 if args.filter in scenario.name]
+    results = []
+    for scenario in scenarios:
+        result = harness.run_scenario(scenario, args.repeat)
+        results.append(result)
+        print(f'{result.name:<55} {result.median * 1e6:>12.2f} us/op {result.ops_per_second:>12.0f} op/s',
+              flush=True)
+    if args.output:
+        harness.save(results, args.output)
+    if not args.baseline:
+        return
+
+    comparisons = harness.compare(harness.load_medians(args.baseline), results, args.threshold)
+    for comparison in comparisons:
+        mark = 'РЕГРЕССИЯ' if comparison.regressed else ''
+        print(f'{comparison.name:<55} {comparison.change:>+8.1%} {mark}')
+    # Ненулевой код - есть замедление сверх порога
+    if any(comparison.regressed for comparison in comparisons):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
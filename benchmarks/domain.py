@@ -0,0 +1,77 @@
+import random
+from datetime import date, timedelta
+
+from allocation.domain import model
+
+from .harness import Scenario
+
+SIZES = (10, 100, 1_000, 10_000, 100_000)
+SKU = 'BENCH-LAMP'
+# Аллокаций в одном прогоне
+ALLOCATIONS = 1_000
+
+
+def make_batches(count: int, seed: int, sku: str = SKU, qty: int = ALLOCATIONS * 10) -> list[model.Batch]:
+    """
+    Половина партий на складе, половина - поставки со случайным eta.
+    По умолчанию остатка любой партии хватает на все аллокации прогона
+    """
+    rng = random.Random(seed)
+    today = date(2022, 1, 1)
+    return [
+        model.Batch(f'{sku}-batch-{number}', sku, qty,
+                    None if number % 2 else today + timedelta(days=rng.randrange(365)))
+        for number in range(count)
+    ]
+
+
+def load_product(batches: int):
+    def setup():
+        loaded = make_batches(batches, seed=batches)
+
+        def run() -> int:
+            model.Product(SKU, loaded)
+            return batches
+        return run
+    return setup
+
+
+def allocate_with_batches(batches: int):
+    def setup():
+        product = model.Product(SKU, make_batches(batches, seed=batches))
+        runs = iter(range(10 ** 9))
+
+        def run() -> int:
+            run_number = next(runs)
+            for number in range(ALLOCATIONS):
+                product.allocate(model.OrderLine(f'order-{run_number}-{number}', SKU, 1))
+            return ALLOCATIONS
+        return run
+    return setup
+
+
+def allocate_with_lines(lines: int):
+    """
+    Продукт из 10 партий, в которых уже размещено lines строк заказа
+    """
+    def setup():
+        batches = make_batches(10, seed=lines, qty=lines + ALLOCATIONS * 10)
+        for number in range(lines):
+            batches[number % len(batches)]._restore_allocations([model.OrderLine(f'loaded-{number}', SKU, 1)])
+        product = model.Product(SKU, batches)
+        runs = iter(range(10 ** 9))
+
+        def run() -> int:
+            run_number = next(runs)
+            for number in range(ALLOCATIONS):
+                product.allocate(model.OrderLine(f'order-{run_number}-{number}', SKU, 1))
+            return ALLOCATIONS
+        return run
+    return setup
+
+
+SCENARIOS = [
+    *(Scenario(f'domain.load[batches={size}]', 'domain', load_product(size)) for size in SIZES),
+    *(Scenario(f'domain.allocate[batches={size}]', 'domain', allocate_with_batches(size)) for size in SIZES),
+    *(Scenario(f'domain.allocate[lines={size}]', 'domain', allocate_with_lines(size)) for size in SIZES),
+]
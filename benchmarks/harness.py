@@ -0,0 +1,128 @@
+import gc
+import json
+import platform
+import statistics
+import time
+import typing as t
+from dataclasses import dataclass, field
+
+import sqlalchemy as sa
+
+# Подготовка сценария вне замера; возвращает замеряемый прогон,
+# прогон возвращает число выполненных операций
+Setup = t.Callable[[], t.Callable[[], int]]
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    group: str
+    setup: Setup
+    repeat: int = 5
+    warmup: int = 1
+
+
+@dataclass
+class Result:
+    """
+    Замеры сценария. Сравнивается медиана времени одной операции: число
+    операций прогона может меняться (успешные аллокации под нагрузкой)
+    """
+    name: str
+    group: str
+    timings: list[float] = field(default_factory=list)
+    operations: list[int] = field(default_factory=list)
+
+    @property
+    def per_operation(self) -> list[float]:
+        return [elapsed / count if count else float('inf') for elapsed, count in zip(self.timings, self.operations)]
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.per_operation)
+
+    @property
+    def best(self) -> float:
+        return min(self.per_operation)
+
+    @property
+    def ops_per_second(self) -> float:
+        return 1 / self.median if self.median else float('inf')
+
+    def to_dict(self) -> dict[str, t.Any]:
+        return {'name': self.name, 'group': self.group, 'timings': self.timings,
+                'operations': self.operations, 'median': self.median, 'best': self.best,
+                'ops_per_second': self.ops_per_second}
+
+
+@dataclass(frozen=True)
+class Comparison:
+    name: str
+    baseline: float
+    current: float
+    threshold: float
+
+    @property
+    def change(self) -> float:
+        return self.current / self.baseline - 1
+
+    @property
+    def regressed(self) -> bool:
+        return self.change > self.threshold
+
+
+def run_scenario(scenario: Scenario, repeat: t.Optional[int] = None) -> Result:
+    """
+    Прогоны сценария: подготовка один раз, затем warmup прогонов без учёта
+    и repeat замеряемых. Сборщик мусора на время замера выключен, чтобы его
+    паузы не зависели от истории процесса
+    """
+    run = scenario.setup()
+    for _ in range(scenario.warmup):
+        run()
+    result = Result(scenario.name, scenario.group)
+    for _ in range(repeat or scenario.repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            operations = run()
+            result.timings.append(time.perf_counter() - started)
+        finally:
+            gc.enable()
+        result.operations.append(operations)
+    return result
+
+
+def environment() -> dict[str, str]:
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'system': platform.platform(),
+        'sqlalchemy': sa.__version__,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def save(results: t.Iterable[Result], path: str):
+    with open(path, 'w') as file:
+        json.dump({'environment': environment(), 'results': [result.to_dict() for result in results]},
+                  file, indent=2, ensure_ascii=False)
+
+
+def load_medians(path: str) -> dict[str, float]:
+    with open(path) as file:
+        return {result['name']: result['median'] for result in json.load(file)['results']}
+
+
+def compare(baseline: dict[str, float], results: t.Iterable[Result], threshold: float) -> list[Comparison]:
+    """
+    Сравнение медиан с базовой линией
+    :param baseline: медиана времени операции сценария по имени
+    :param results: текущие результаты, сценарии без базовой линии пропускаются
+    :param threshold: допустимое замедление, 0.1 - на 10%
+    :return: сравнения в порядке результатов
+    """
+    return [Comparison(result.name, baseline[result.name], result.median, threshold)
+            for result in results if result.name in baseline]
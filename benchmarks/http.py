@@ -0,0 +1,65 @@
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from allocation import config
+
+from .harness import Scenario
+
+# Запросов /allocate в одном прогоне и одновременных клиентов
+REQUESTS = 400
+CLIENTS = 8
+SKUS = 100
+# Доля запросов к горячему артикулу в профиле hot
+HOT_SHARE = 0.8
+
+
+def choose_skus(profile: str, skus: list[str], rng: random.Random) -> list[str]:
+    if profile == 'hot':
+        return [skus[0] if rng.random() < HOT_SHARE else rng.choice(skus) for _ in range(REQUESTS)]
+    return [rng.choice(skus) for _ in range(REQUESTS)]
+
+
+def allocate_throughput(profile: str):
+    """
+    Пропускная способность /allocate запущенного API (config.get_api_url()):
+    hot - большая часть запросов конкурирует за блокировку одного продукта,
+    uniform - запросы равномерно распределены по артикулам
+    """
+    def setup():
+        url = config.get_api_url()
+        prefix = uuid.uuid4().hex[:8]
+        skus = [f'BENCH-{prefix}-{number}' for number in range(SKUS)]
+        for sku in skus:
+            response = requests.post(f'{url}/add_batch',
+                                     json={'ref': f'{sku}-batch', 'sku': sku, 'qty': 10 ** 6, 'eta': None})
+            response.raise_for_status()
+        rng = random.Random(profile)
+        local = threading.local()
+        runs = iter(range(10 ** 9))
+
+        def post(orderid: str, sku: str) -> bool:
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            response = session.post(f'{url}/allocate', json={'orderid': orderid, 'sku': sku, 'qty': 1})
+            return response.status_code == 201
+
+        def run() -> int:
+            run_number = next(runs)
+            chosen = choose_skus(profile, skus, rng)
+            with ThreadPoolExecutor(CLIENTS) as executor:
+                allocated = executor.map(post, (f'{prefix}-{run_number}-{n}' for n in range(REQUESTS)), chosen)
+                # Операции - успешные аллокации: отказы из-за блокировок снижают пропускную способность
+                return sum(allocated)
+        return run
+    return setup
+
+
+SCENARIOS = [
+    Scenario(f'http.allocate[profile={profile}]', 'http', allocate_throughput(profile), repeat=3)
+    for profile in ('hot', 'uniform')
+]
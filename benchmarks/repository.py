@@ -0,0 +1,72 @@
+import uuid
+
+from allocation.adapters import engines
+from allocation.adapters.db_tables import metadata
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+from .domain import make_batches
+from .harness import Scenario
+
+SIZES = (10, 100, 1_000, 10_000)
+# Загрузок продукта в одном прогоне
+LOADS = 10
+
+
+def create_product(batches: int, lines: int) -> str:
+    """
+    Продукт с batches партиями и lines размещёнными строками заказа в базе;
+    артикул уникален, поэтому прогоны не видят данные друг друга
+    """
+    engine = engines.get_engine()
+    metadata.create_all(engine, checkfirst=True)
+    sku = f'BENCH-{uuid.uuid4().hex[:12]}'
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        product = model.Product(sku, batches=[])
+        uow.products.add(product)
+        for batch in make_batches(batches, seed=batches, sku=sku, qty=10 ** 6):
+            product.add_batch(batch)
+        for number in range(lines):
+            product.allocate(model.OrderLine(f'loaded-{number}', sku, 1))
+        uow.commit()
+    return sku
+
+
+def load_product(size: int, partial_load: bool = False):
+    def setup():
+        sku = create_product(batches=size, lines=size)
+
+        def run() -> int:
+            for _ in range(LOADS):
+                with unit_of_work.SqlAlchemyUnitOfWork(engines.get_engine(), partial_load=partial_load) as uow:
+                    uow.products.get(sku)
+            return LOADS
+        return run
+    return setup
+
+
+def allocate_and_commit(lines: int):
+    def setup():
+        sku = create_product(batches=10, lines=0)
+        runs = iter(range(10 ** 9))
+
+        def run() -> int:
+            run_number = next(runs)
+            with unit_of_work.SqlAlchemyUnitOfWork(engines.get_engine()) as uow:
+                product = uow.products.get(sku)
+                for number in range(lines):
+                    product.allocate(model.OrderLine(f'order-{run_number}-{number}', sku, 1))
+                uow.commit()
+            return lines
+        return run
+    return setup
+
+
+SCENARIOS = [
+    *(Scenario(f'repository.get[batches={size},lines={size}]', 'repository', load_product(size))
+      for size in SIZES),
+    *(Scenario(f'repository.get_partial[batches={size},lines={size}]', 'repository', load_product(size, True))
+      for size in SIZES),
+    *(Scenario(f'repository.commit[lines={size}]', 'repository', allocate_and_commit(size))
+      for size in SIZES[:-1]),
+]
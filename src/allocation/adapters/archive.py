@@ -0,0 +1,115 @@
+import typing as t
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Connection, Engine
+
+from .db_tables import (
+    allocations, allocations_archive, availability_view, batches, batches_archive, order_lines, order_lines_archive,
+    products
+)
+
+
+def archive_chunk(connection: Connection, chunk_size: int, now: datetime) -> int:
+    """
+    Перенос в архив одной порции израсходованных и доставленных партий
+    вместе с их аллокациями и строками заказа - одним запросом.
+
+    Строки партий и их продуктов блокируются с SKIP LOCKED: продукты, с которыми
+    сейчас работают аллокации, пропускаются до следующего прогона. Версия
+    затронутых продуктов увеличивается, чтобы сбросить кэши процессов.
+    :param connection: соединение с открытой транзакцией
+    :param chunk_size: максимум партий в порции
+    :param now: партии с eta позже этого момента ещё не доставлены
+    :return: число перенесённых партий
+    """
+    candidates = sa.select(batches.c.id).join(products, products.c.sku == batches.c.sku).where(
+        batches.c.allocated_quantity >= batches.c.purchased_quantity,
+        sa.or_(batches.c.eta.is_(None), batches.c.eta <= now)
+    ).order_by(batches.c.id).limit(chunk_size).with_for_update(skip_locked=True).cte('candidates')
+
+    moved_allocations = sa.delete(allocations).where(
+        allocations.c.batch_id.in_(sa.select(candidates.c.id))
+    ).returning(allocations.c.id, allocations.c.orderline_id, allocations.c.batch_id).cte('moved_allocations')
+    moved_lines = sa.delete(order_lines).where(
+        order_lines.c.id.in_(sa.select(moved_allocations.c.orderline_id))
+    ).returning(order_lines.c.id, order_lines.c.sku, order_lines.c.qty, order_lines.c.orderid).cte('moved_lines')
+    moved_batches = sa.delete(batches).where(
+        batches.c.id.in_(sa.select(candidates.c.id))
+    ).returning(
+        batches.c.id, batches.c.reference, batches.c.sku,
+        batches.c.purchased_quantity, batches.c.allocated_quantity, batches.c.eta
+    ).cte('moved_batches')
+
+    # Повторный перенос тех же id (после сбоя между прогонами) ничего не ломает
+    archived_allocations = insert(allocations_archive).from_select(
+        ['id', 'orderline_id', 'batch_id'], sa.select(moved_allocations)
+    ).on_conflict_do_nothing().cte('archived_allocations')
+    archived_lines = insert(order_lines_archive).from_select(
+        ['id', 'sku', 'qty', 'orderid'], sa.select(moved_lines)
+    ).on_conflict_do_nothing().cte('archived_lines')
+    archived_batches = insert(batches_archive).from_select(
+        ['id', 'reference', 'sku', 'purchased_quantity', 'allocated_quantity', 'eta'], sa.select(moved_batches)
+    ).on_conflict_do_nothing().cte('archived_batches')
+    changed_products = sa.update(products).values(
+        version_number=products.c.version_number + 1
+    ).where(products.c.sku.in_(sa.select(moved_batches.c.sku))).cte('changed_products')
+
+    # Аллокации в модели чтения остаются: заказ по-прежнему можно найти
+    deleted_availability = sa.delete(availability_view).where(
+        availability_view.c.reference.in_(sa.select(moved_batches.c.reference))
+    ).cte('deleted_availability')
+
+    select_stmt = sa.select(sa.func.count()).select_from(moved_batches)
+    # Изменяющие CTE без ссылок на них выполняются, только если попали в WITH
+    for cte in (archived_allocations, archived_lines, archived_batches, changed_products, deleted_availability):
+        select_stmt = select_stmt.add_cte(cte)
+    return connection.execute(select_stmt).scalar_one()
+
+
+def compact(engine: Engine, chunk_size: int = 1000, max_chunks: t.Optional[int] = None,
+            now: t.Optional[datetime] = None) -> int:
+    """
+    Перенос в архив израсходованных и доставленных партий порциями,
+    каждая порция - в своей транзакции
+    :param engine: движок базы
+    :param chunk_size: максимум партий в порции
+    :param max_chunks: ограничение числа порций за прогон, None - пока есть что переносить
+    :param now: момент, на который партии считаются доставленными, по умолчанию - текущий
+    :return: число перенесённых партий
+    """
+    now = now or datetime.now(timezone.utc)
+    moved, chunks = 0, 0
+    while max_chunks is None or chunks < max_chunks:
+        with engine.begin() as connection:
+            chunk = archive_chunk(connection, chunk_size, now)
+        moved += chunk
+        chunks += 1
+        if chunk < chunk_size:
+            break
+    return moved
+
+
+def select_allocation_history(connection: Connection, sku: str) -> list[sa.engine.Row]:
+    """
+    Аллокации артикула для отчётов: рабочие и архивные
+    :param connection: соединение
+    :param sku: артикул
+    :return: строки (orderid, sku, qty, reference, archived)
+    """
+    current = sa.select(
+        order_lines.c.orderid, order_lines.c.sku, order_lines.c.qty, batches.c.reference,
+        sa.literal(False).label('archived')
+    ).select_from(
+        allocations.join(order_lines, order_lines.c.id == allocations.c.orderline_id)
+                   .join(batches, batches.c.id == allocations.c.batch_id)
+    ).where(batches.c.sku == sku)
+    archived = sa.select(
+        order_lines_archive.c.orderid, order_lines_archive.c.sku, order_lines_archive.c.qty,
+        batches_archive.c.reference, sa.literal(True).label('archived')
+    ).select_from(
+        allocations_archive.join(order_lines_archive, order_lines_archive.c.id == allocations_archive.c.orderline_id)
+                           .join(batches_archive, batches_archive.c.id == allocations_archive.c.batch_id)
+    ).where(batches_archive.c.sku == sku)
+    return connection.execute(sa.union_all(current, archived)).all()
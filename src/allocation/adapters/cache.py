@@ -0,0 +1,66 @@
+import threading
+import typing as t
+from collections import OrderedDict
+
+from allocation.domain import model
+
+
+def product_weight(product: model.Product) -> int:
+    """
+    Условный размер продукта в памяти: сам продукт, его партии и строки заказа.
+    Число строк продукт ведёт сам, вес не пересчитывается по партиям
+    """
+    return 1 + len(product._batches) + product._lines
+
+
+class ProductCache:
+    """
+    LRU кэш загруженных продуктов в памяти процесса.
+
+    Продукт выдаётся во владение: take() забирает его из кэша, так что
+    с одним объектом одновременно работает только одна единица работы.
+    После коммита, а после отката - если продукт не изменён, он возвращается
+    через put(). Актуальность
+    проверяет репозиторий, сравнивая version_number с базой.
+    """
+
+    def __init__(self, max_weight: int):
+        self.max_weight = max_weight
+        self._products: OrderedDict[str, tuple[model.Product, int]] = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._products)
+
+    @property
+    def weight(self) -> int:
+        return self._weight
+
+    def take(self, sku: str) -> t.Optional[model.Product]:
+        with self._lock:
+            entry = self._products.pop(sku, None)
+            if entry is None:
+                return
+            product, weight = entry
+            self._weight -= weight
+            return product
+
+    def put(self, product: model.Product):
+        weight = product_weight(product)
+        with self._lock:
+            previous = self._products.pop(product.sku, None)
+            if previous is not None:
+                self._weight -= previous[1]
+            if weight > self.max_weight:
+                return
+            self._products[product.sku] = (product, weight)
+            self._weight += weight
+            while self._weight > self.max_weight:
+                _, (_, evicted_weight) = self._products.popitem(last=False)
+                self._weight -= evicted_weight
+
+    def clear(self):
+        with self._lock:
+            self._products.clear()
+            self._weight = 0
@@ -24,9 +24,15 @@ batches = sa.Table(
     sa.Column('reference', sa.String(255), unique=True),
     sa.Column('sku', sa.ForeignKey("products.sku")),
     sa.Column('purchased_quantity', sa.Integer, nullable=False),
+    sa.Column('allocated_quantity', sa.Integer, nullable=False, server_default='0'),
     sa.Column('eta', sa.DateTime(timezone=True)),
 )
 
+sa.Index('idx_batches_sku', batches.c.sku)
+# Загрузка продукта в режиме partial_load читает только партии с остатком
+sa.Index('idx_batches_sku_in_stock', batches.c.sku,
+         postgresql_where=batches.c.purchased_quantity > batches.c.allocated_quantity)
+
 allocations = sa.Table(
     "allocations", metadata,
     sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
@@ -34,8 +40,82 @@ allocations = sa.Table(
     sa.Column("batch_id", sa.ForeignKey("batches.id")),
 )
 
+sa.Index('idx_allocations_batch_id', allocations.c.batch_id)
+
 products = sa.Table(
     "products", metadata,
     sa.Column('sku', sa.String(255), primary_key=True),
+    sa.Column('version_number', sa.Integer, nullable=False, server_default='0'),
+)
+
+
+# Архив израсходованных и доставленных партий с их аллокациями и строками заказа.
+# Идентификаторы сохраняются как в рабочих таблицах, внешних ключей нет.
+batches_archive = sa.Table(
+    'batches_archive', metadata,
+    sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('reference', sa.String(255)),
+    sa.Column('sku', sa.String(255)),
+    sa.Column('purchased_quantity', sa.Integer, nullable=False),
+    sa.Column('allocated_quantity', sa.Integer, nullable=False),
+    sa.Column('eta', sa.DateTime(timezone=True)),
+    sa.Column('archived_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
 )
 
+sa.Index('idx_batches_archive_sku', batches_archive.c.sku)
+
+order_lines_archive = sa.Table(
+    'order_lines_archive', metadata,
+    sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('sku', sa.String(255)),
+    sa.Column('qty', sa.Integer, nullable=False),
+    sa.Column('orderid', sa.String(255)),
+)
+
+allocations_archive = sa.Table(
+    'allocations_archive', metadata,
+    sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('orderline_id', sa.Integer),
+    sa.Column('batch_id', sa.Integer),
+)
+
+sa.Index('idx_allocations_archive_batch_id', allocations_archive.c.batch_id)
+
+# Модели чтения: обновляются в тех же запросах, что и рабочие таблицы,
+# и отвечают на запросы одним поиском по индексу без сборки Product
+allocations_view = sa.Table(
+    'allocations_view', metadata,
+    sa.Column('orderid', sa.String(255), primary_key=True),
+    sa.Column('sku', sa.String(255), primary_key=True),
+    sa.Column('batchref', sa.String(255), nullable=False),
+)
+
+availability_view = sa.Table(
+    'availability_view', metadata,
+    sa.Column('reference', sa.String(255), primary_key=True),
+    sa.Column('sku', sa.String(255), nullable=False),
+    sa.Column('eta', sa.DateTime(timezone=True)),
+    sa.Column('available_quantity', sa.Integer, nullable=False),
+)
+
+sa.Index('idx_availability_view_sku', availability_view.c.sku)
+
+# Применённые миграции схемы, см. adapters/migrations.py
+schema_migrations = sa.Table(
+    'schema_migrations', metadata,
+    sa.Column('version', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('name', sa.String(255), nullable=False),
+    sa.Column('applied_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+)
+
+# Временная таблица для массовой загрузки партий через COPY, своя на каждое соединение.
+# Не входит в metadata: создаётся репозиторием по требованию
+batches_staging = sa.Table(
+    'batches_staging', sa.MetaData(),
+    sa.Column('reference', sa.String(255)),
+    sa.Column('sku', sa.String(255)),
+    sa.Column('purchased_quantity', sa.Integer),
+    sa.Column('eta', sa.DateTime(timezone=True)),
+    prefixes=['TEMPORARY'],
+    postgresql_on_commit='DELETE ROWS',
+)
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+import typing as t
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from allocation import config
+from allocation.adapters import instrumentation, metrics
+
+# Движки процесса создаются при первом обращении, а не при импорте: до fork
+# пре-форк сервера ни одно соединение не открывается
+_engines: dict[str, t.Union[Engine, AsyncEngine]] = {}
+_lock = threading.Lock()
+
+
+class _TimedCheckout:
+    """
+    Учёт ожидания соединения в пуле: свободного или нового, до проверки
+    pre-ping, которая выполняется уже после выдачи
+    """
+    # Имя движка - метка метрики
+    engine_name = ''
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started, self.engine_name)
+
+    def recreate(self):
+        # dispose создаёт пул заново, в том числе после fork
+        pool = super().recreate()
+        pool.engine_name = self.engine_name
+        return pool
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_options() -> dict[str, t.Any]:
+    return {
+        'pool_size': config.get_pool_size(),
+        'max_overflow': config.get_pool_max_overflow(),
+        'pool_timeout': config.get_pool_timeout(),
+        'pool_recycle': config.get_pool_recycle(),
+        'pool_pre_ping': config.get_pool_pre_ping(),
+    }
+
+
+def _get_or_create(name: str, factory: t.Callable[[], t.Union[Engine, AsyncEngine]]):
+    engine = _engines.get(name)
+    if engine is None:
+        with _lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = factory()
+                engine.pool.engine_name = name
+                instrumentation.install(engine)
+                _engines[name] = engine
+    return engine
+
+
+def get_engine() -> Engine:
+    return _get_or_create('primary', lambda: create_engine(
+        config.get_postgres_uri(), poolclass=TimedQueuePool, **pool_options()))
+
+
+def get_replica_engine() -> Engine:
+    """
+    Движок реплики для чтения, без DB_REPLICA_HOST - основной
+    """
+    replica_uri = config.get_replica_postgres_uri()
+    if not replica_uri:
+        return get_engine()
+    return _get_or_create('replica', lambda: create_engine(
+        replica_uri, poolclass=TimedQueuePool, **pool_options()))
+
+
+def get_async_engine() -> AsyncEngine:
+    return _get_or_create('async', lambda: create_async_engine(
+        config.get_async_postgres_uri(), poolclass=TimedAsyncQueuePool, **pool_options()))
+
+
+def _after_fork_in_child():
+    """
+    Соединения пулов, открытые родителем, остаются ему: дочерний процесс
+    забывает их, не закрывая, и открывает свои
+    """
+    global _lock
+    _lock = threading.Lock()
+    for engine in _engines.values():
+        getattr(engine, 'sync_engine', engine).dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,172 @@
+import contextlib
+import functools
+import time
+import typing as t
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import metrics
+
+
+@dataclass
+class RequestStats:
+    """
+    Затраты одного запроса (или любого блока кода) на работу с базой.
+    Время - в секундах; время методов репозитория включает вложенные вызовы
+    """
+    statements: int = 0
+    db_time: float = 0.0
+    rows: int = 0
+    lock_failures: int = 0
+    transactions: int = 0
+    transaction_time: float = 0.0
+    methods: dict[str, float] = field(default_factory=dict)
+    method_calls: dict[str, int] = field(default_factory=dict)
+
+    def headers(self) -> dict[str, str]:
+        return {
+            'X-DB-Statements': str(self.statements),
+            'X-DB-Time': f'{self.db_time * 1000:.2f}ms',
+            'X-DB-Rows': str(self.rows),
+            'X-DB-Lock-Failures': str(self.lock_failures),
+            'X-DB-Transaction-Time': f'{self.transaction_time * 1000:.2f}ms',
+            'X-DB-Repository-Time': ', '.join(
+                f'{name};calls={self.method_calls[name]};dur={elapsed * 1000:.2f}'
+                for name, elapsed in self.methods.items()
+            ),
+        }
+
+
+_current: ContextVar[t.Optional[RequestStats]] = ContextVar('allocation_request_stats', default=None)
+
+
+def current() -> t.Optional[RequestStats]:
+    return _current.get()
+
+
+def begin(stats: t.Optional[RequestStats] = None) -> tuple[RequestStats, Token]:
+    """
+    Начало учёта для хуков веб-фреймворка; учёт завершает end(token)
+    """
+    stats = stats if stats is not None else RequestStats()
+    return stats, _current.set(stats)
+
+
+def end(token: Token):
+    _current.reset(token)
+
+
+@contextlib.contextmanager
+def track_request(stats: t.Optional[RequestStats] = None) -> t.Iterator[RequestStats]:
+    """
+    Учёт затрат на базу в блоке кода текущего потока или задачи asyncio:
+    with track_request() as stats: ...
+    """
+    stats, token = begin(stats)
+    try:
+        yield stats
+    finally:
+        end(token)
+
+
+def timed(method):
+    """
+    Учёт времени метода репозитория в текущем RequestStats
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        stats = _current.get()
+        if stats is None:
+            return method(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.methods[name] = stats.methods.get(name, 0.0) + time.perf_counter() - started
+            stats.method_calls[name] = stats.method_calls.get(name, 0) + 1
+    return wrapper
+
+
+def record_transaction(elapsed: float, lock_failed: bool):
+    """
+    Учёт транзакции единицы работы; lock_failed - она завершилась ParallelAccess
+    (NOWAIT не получил блокировку или версия продукта уже изменилась)
+    """
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.transactions += 1
+    stats.transaction_time += elapsed
+    if lock_failed:
+        stats.lock_failures += 1
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        context.allocation_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = getattr(context, 'allocation_started', None)
+    if stats is None or started is None:
+        return
+    stats.db_time += time.perf_counter() - started
+    stats.statements += 1
+    # У серверного курсора rowcount неизвестен: его строки считает fetched_partitions
+    if context.execution_options.get('stream_results'):
+        return
+    if cursor.description is not None and cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+
+
+def fetched_partitions(result: sa.engine.Result, size: int) -> t.Iterator[list[sa.engine.Row]]:
+    """
+    Порции результата серверного курсора с учётом строк по мере чтения
+    """
+    for partition in result.partitions(size):
+        stats = _current.get()
+        if stats is not None:
+            stats.rows += len(partition)
+        yield partition
+
+
+def handle_error(exception_context):
+    stats = _current.get()
+    started = getattr(exception_context.execution_context, 'allocation_started', None)
+    if stats is None or started is None:
+        return
+    stats.db_time += time.perf_counter() - started
+    stats.statements += 1
+
+
+def install(engine: t.Union[Engine, AsyncEngine]):
+    """
+    Подписка на события движка. Пока запрос не отслеживается,
+    обработчики сводятся к чтению ContextVar
+    """
+    engine = getattr(engine, 'sync_engine', engine)
+    for name, listener in (('before_cursor_execute', before_cursor_execute),
+                           ('after_cursor_execute', after_cursor_execute),
+                           ('handle_error', handle_error)):
+        if not sa.event.contains(engine, name, listener):
+            sa.event.listen(engine, name, listener)
+
+
+def observe_request(endpoint: str, stats: RequestStats):
+    """
+    Затраты запроса на базу - в гистограммы метрик процесса, отдаваемые /metrics
+    """
+    metrics.REQUEST_DB_STATEMENTS.observe(stats.statements, endpoint)
+    metrics.REQUEST_DB_ROWS.observe(stats.rows, endpoint)
+    metrics.REQUEST_DB_TIME.observe(stats.db_time, endpoint)
+    metrics.REQUEST_TRANSACTION_TIME.observe(stats.transaction_time, endpoint)
+    metrics.REQUEST_LOCK_FAILURES.observe(stats.lock_failures, endpoint)
+    for method, elapsed in stats.methods.items():
+        metrics.REPOSITORY_METHOD_TIME.observe(elapsed, endpoint, method)
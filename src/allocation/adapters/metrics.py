@@ -0,0 +1,243 @@
+import abc
+import bisect
+import os
+import threading
+import typing as t
+import weakref
+import zlib
+
+from allocation import config
+
+Labels = tuple[str, ...]
+
+# Границы корзин задержек, сек
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Границы корзин счётчиков за запрос: запросов к базе, строк, отказов блокировки
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+class _Holder:
+    # Владелец словаря потока: живёт, пока жив поток
+    __slots__ = ('shard', '__weakref__')
+
+
+class _PerThread(abc.ABC):
+    """
+    Значения метрики по потокам: поток пишет только в свой словарь, без
+    блокировок. Блокировка берётся при первой записи потока, при чтении и при
+    завершении потока - тогда его словарь вливается в общий итог завершившихся
+    потоков, и число словарей не растёт с числом потоков
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._local = threading.local()
+        self._shards: dict[int, dict] = {}
+        self._retired: dict = {}
+        self._lock = threading.Lock()
+
+    def shard(self) -> dict:
+        try:
+            return self._local.holder.shard
+        except AttributeError:
+            holder = self._local.holder = _Holder()
+            holder.shard = {}
+            with self._lock:
+                self._shards[id(holder)] = holder.shard
+            finalizer = weakref.finalize(holder, self._retire, id(holder), self._lock)
+            finalizer.atexit = False
+            return holder.shard
+
+    def _retire(self, key: int, lock: threading.Lock):
+        with lock:
+            # Поток завершился после reset: его значения уже не учитываются
+            if lock is not self._lock:
+                return
+            shard = self._shards.pop(key, None)
+            if shard is not None:
+                self.merge(self._retired, shard)
+
+    @abc.abstractmethod
+    def merge(self, total: dict, shard: dict):
+        """
+        Добавление значений словаря потока к итогу
+        """
+        raise NotImplementedError
+
+    def values(self) -> dict:
+        total: dict = {}
+        with self._lock:
+            self.merge(total, self._retired)
+            for shard in self._shards.values():
+                # Копия словаря атомарна под GIL, даже пока владелец в него пишет
+                self.merge(total, shard.copy())
+        return total
+
+
+class Counter(_PerThread):
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        super().__init__()
+
+    def inc(self, *labels: str, amount: float = 1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def merge(self, total: dict[Labels, float], shard: dict[Labels, float]):
+        for labels, value in shard.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def samples(self) -> t.Iterator[tuple[str, dict[str, str], float]]:
+        for labels, value in sorted(self.values().items()):
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Histogram(_PerThread):
+    """
+    Гистограмма с фиксированными корзинами. Значение потока по набору меток -
+    список [счётчики корзин..., сумма]; последняя корзина - больше всех границ
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = (),
+                 buckets: t.Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        super().__init__()
+
+    def observe(self, value: float, *labels: str):
+        shard = self.shard()
+        cell = shard.get(labels)
+        if cell is None:
+            cell = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def merge(self, total: dict[Labels, list[float]], shard: dict[Labels, list[float]]):
+        for labels, cell in shard.items():
+            cell = list(cell)
+            summed = total.setdefault(labels, [0] * len(cell))
+            for position, value in enumerate(cell):
+                summed[position] += value
+
+    def samples(self) -> t.Iterator[tuple[str, dict[str, str], float]]:
+        for labels, cell in sorted(self.values().items()):
+            label_values = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float('inf')], cell):
+                cumulative += count
+                yield f'{self.name}_bucket', {**label_values, 'le': format_value(bound)}, cumulative
+            yield f'{self.name}_sum', label_values, cell[-1]
+            yield f'{self.name}_count', label_values, cumulative
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса. Каждый рабочий процесс пре-форк сервера считает свои:
+    сумму по процессам даёт сборщик метрик
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, t.Union[Counter, Histogram]] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Labels = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Labels = (),
+                  buckets: t.Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Метрика {metric.name} уже зарегистрирована')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def render(self) -> str:
+        """
+        Значения всех метрик в текстовом формате Prometheus
+        """
+        lines = []
+        for metric in self._metrics.values():
+            kind = 'counter' if isinstance(metric, Counter) else 'histogram'
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+registry = MetricsRegistry()
+
+REQUEST_DURATION = registry.histogram(
+    'allocation_request_duration_seconds', 'Время обработки HTTP запроса', ('endpoint', 'status'))
+ALLOCATIONS = registry.counter(
+    'allocation_allocations_total', 'Размещённые строки заказа')
+ALLOCATION_ERRORS = registry.counter(
+    'allocation_allocation_errors_total', 'Отказы в аллокации по типу ошибки и корзине артикулов',
+    ('error', 'sku_bucket'))
+POOL_CHECKOUT_WAIT = registry.histogram(
+    'allocation_pool_checkout_wait_seconds', 'Ожидание соединения из пула движка, без pre-ping', ('engine',))
+REQUEST_DB_STATEMENTS = registry.histogram(
+    'allocation_request_db_statements', 'Запросов к базе за HTTP запрос', ('endpoint',), COUNT_BUCKETS)
+REQUEST_DB_ROWS = registry.histogram(
+    'allocation_request_db_rows', 'Строк из базы за HTTP запрос', ('endpoint',), COUNT_BUCKETS)
+REQUEST_DB_TIME = registry.histogram(
+    'allocation_request_db_seconds', 'Время запросов к базе за HTTP запрос', ('endpoint',))
+REQUEST_TRANSACTION_TIME = registry.histogram(
+    'allocation_request_transaction_seconds', 'Время транзакций единиц работы за HTTP запрос', ('endpoint',))
+REQUEST_LOCK_FAILURES = registry.histogram(
+    'allocation_request_lock_failures', 'Транзакций, завершившихся ParallelAccess, за HTTP запрос',
+    ('endpoint',), COUNT_BUCKETS)
+REPOSITORY_METHOD_TIME = registry.histogram(
+    'allocation_repository_method_seconds', 'Время методов репозитория за HTTP запрос', ('endpoint', 'method'))
+
+_sku_buckets = config.get_metrics_sku_buckets()
+
+
+def sku_bucket(sku: str) -> str:
+    """
+    Корзина артикула: число меток ограничено, а артикул попадает
+    в одну и ту же корзину во всех процессах
+    """
+    return str(zlib.crc32(sku.encode()) % _sku_buckets)
+
+
+def record_allocation(sku: str, error: t.Optional[Exception] = None, lines: int = 1):
+    if error is None:
+        ALLOCATIONS.inc(amount=lines)
+    else:
+        ALLOCATION_ERRORS.inc(type(error).__name__, sku_bucket(sku), amount=lines)
+
+
+if hasattr(os, 'register_at_fork'):
+    # Дочерний процесс начинает с нуля, иначе значения родителя посчитаются дважды
+    os.register_at_fork(after_in_child=registry.reset)
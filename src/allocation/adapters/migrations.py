@@ -0,0 +1,134 @@
+import typing as t
+from dataclasses import dataclass
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection, Engine
+
+from .db_tables import (
+    metadata, allocations, allocations_archive, batches, batches_archive, order_lines, order_lines_archive,
+    products, schema_migrations, allocations_view, availability_view
+)
+
+# Ключ advisory-блокировки: миграции одной базы выполняет один процесс
+MIGRATIONS_LOCK_ID = 0x616C6C6F
+
+Statement = t.Union[str, t.Callable[[Connection], None]]
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    Версионированное изменение схемы. Операторы идемпотентны (IF NOT EXISTS),
+    поэтому миграция безопасно применяется и к базе, созданной metadata.create_all.
+    Нетранзакционные миграции (CREATE INDEX CONCURRENTLY) выполняются в autocommit
+    и не блокируют запись в рабочие таблицы
+    """
+    version: int
+    name: str
+    statements: t.Sequence[Statement]
+    transactional: bool = True
+
+
+def create_tables(*tables: sa.Table) -> t.Callable[[Connection], None]:
+    def create(connection: Connection):
+        metadata.create_all(connection, tables=list(tables), checkfirst=True)
+    return create
+
+
+def create_index_concurrently(name: str, definition: str) -> t.Callable[[Connection], None]:
+    """
+    CREATE INDEX CONCURRENTLY, который можно повторить после обрыва: прерванное
+    построение оставляет индекс INVALID, и IF NOT EXISTS его бы пропустил
+    """
+    def create(connection: Connection):
+        valid = connection.execute(
+            sa.text("SELECT pg_index.indisvalid FROM pg_index"
+                    " JOIN pg_class ON pg_class.oid = pg_index.indexrelid"
+                    " WHERE pg_class.relname = :name AND pg_class.relnamespace = current_schema()::regnamespace"),
+            {'name': name},
+        ).scalar()
+        if valid is False:
+            connection.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        connection.execute(sa.text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
+    return create
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, 'initial schema', [create_tables(products, order_lines, batches, allocations)]),
+    Migration(2, 'products.version_number', [
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS version_number integer NOT NULL DEFAULT 0",
+    ]),
+    Migration(3, 'batches.allocated_quantity', [
+        "ALTER TABLE batches ADD COLUMN IF NOT EXISTS allocated_quantity integer NOT NULL DEFAULT 0",
+        "UPDATE batches SET allocated_quantity = delta.qty"
+        " FROM (SELECT allocations.batch_id, sum(order_lines.qty) AS qty"
+        "       FROM allocations JOIN order_lines ON order_lines.id = allocations.orderline_id"
+        "       GROUP BY allocations.batch_id) AS delta"
+        " WHERE batches.id = delta.batch_id AND batches.allocated_quantity != delta.qty",
+    ]),
+    Migration(4, 'archive tables', [create_tables(batches_archive, order_lines_archive, allocations_archive)]),
+    Migration(5, 'indexes for product loading', [
+        create_index_concurrently('idx_batches_sku', 'batches (sku)'),
+        create_index_concurrently('idx_allocations_batch_id', 'allocations (batch_id)'),
+        create_index_concurrently('idx_batches_sku_in_stock', 'batches (sku) WHERE purchased_quantity > allocated_quantity'),
+    ], transactional=False),
+    Migration(6, 'read models', [
+        create_tables(allocations_view, availability_view),
+        "INSERT INTO allocations_view (orderid, sku, batchref)"
+        " SELECT order_lines.orderid, order_lines.sku, batches.reference FROM allocations"
+        " JOIN order_lines ON order_lines.id = allocations.orderline_id"
+        " JOIN batches ON batches.id = allocations.batch_id"
+        " ON CONFLICT DO NOTHING",
+        "INSERT INTO availability_view (reference, sku, eta, available_quantity)"
+        " SELECT reference, sku, eta, purchased_quantity - allocated_quantity FROM batches"
+        " ON CONFLICT DO NOTHING",
+    ]),
+]
+
+
+def applied_versions(connection: Connection) -> set[int]:
+    return set(connection.execute(sa.select(schema_migrations.c.version)).scalars())
+
+
+def migrate(engine: Engine, target: t.Optional[int] = None) -> list[Migration]:
+    """
+    Применение недостающих миграций по порядку версий
+    :param engine: движок базы
+    :param target: последняя применяемая версия, None - все
+    :return: применённые миграции
+    """
+    applied = []
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(sa.select(sa.func.pg_advisory_lock(MIGRATIONS_LOCK_ID)))
+        try:
+            metadata.create_all(connection, tables=[schema_migrations], checkfirst=True)
+            done = applied_versions(connection)
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in done or (target is not None and migration.version > target):
+                    continue
+                apply_migration(engine, connection, migration)
+                applied.append(migration)
+        finally:
+            connection.execute(sa.select(sa.func.pg_advisory_unlock(MIGRATIONS_LOCK_ID)))
+    return applied
+
+
+def apply_migration(engine: Engine, connection: Connection, migration: Migration):
+    if not migration.transactional:
+        # Оборванная миграция повторяется целиком: операторы идемпотентны
+        for statement in migration.statements:
+            execute_statement(connection, statement)
+        connection.execute(sa.insert(schema_migrations).values(version=migration.version, name=migration.name))
+        return
+    with engine.begin() as transaction:
+        for statement in migration.statements:
+            execute_statement(transaction, statement)
+        transaction.execute(sa.insert(schema_migrations).values(version=migration.version, name=migration.name))
+
+
+def execute_statement(connection: Connection, statement: Statement):
+    if callable(statement):
+        statement(connection)
+    else:
+        connection.execute(sa.text(statement))
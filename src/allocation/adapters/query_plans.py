@@ -0,0 +1,76 @@
+import json
+import typing as t
+from dataclasses import dataclass
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+
+# Таблицы, которые растут вместе с историей аллокаций
+HOT_TABLES = frozenset({'products', 'batches', 'allocations', 'order_lines'})
+
+
+@dataclass(frozen=True)
+class SequentialScan:
+    table: str
+    statement: str
+
+
+class SequentialScanFound(Exception):
+    pass
+
+
+class QueryPlanChecker:
+    """
+    Проверка планов запросов, которые движок отправляет в базу.
+
+    Перед каждым SELECT/INSERT/UPDATE/DELETE на том же соединении и с теми же
+    параметрами выполняется EXPLAIN при enable_seqscan = off: последовательное
+    чтение остаётся в плане, только если для запроса нет подходящего индекса,
+    независимо от объёма данных в тестовой базе. EXPLAIN без ANALYZE запрос
+    не выполняет и блокировок не берёт.
+
+    with QueryPlanChecker(engine) as checker:
+        ...
+    checker.check()
+    """
+
+    def __init__(self, engine: Engine, tables: t.Iterable[str] = HOT_TABLES):
+        self.engine = engine
+        self.tables = frozenset(tables)
+        self.scans: list[SequentialScan] = []
+        self.explained = 0
+
+    def __enter__(self):
+        sa.event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *args):
+        sa.event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+            return
+        explain_cursor = conn.connection.cursor()
+        try:
+            explain_cursor.execute('SET enable_seqscan = off')
+            explain_cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+            [[plan]] = explain_cursor.fetchall()
+            explain_cursor.execute('RESET enable_seqscan')
+        finally:
+            explain_cursor.close()
+        self.explained += 1
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        for table in self.sequential_scans(plan[0]['Plan']):
+            self.scans.append(SequentialScan(table, statement))
+
+    def sequential_scans(self, node: dict) -> t.Iterator[str]:
+        if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') in self.tables:
+            yield node['Relation Name']
+        for child in node.get('Plans', ()):
+            yield from self.sequential_scans(child)
+
+    def check(self):
+        if self.scans:
+            details = '\n'.join(f'{scan.table}: {scan.statement}' for scan in self.scans)
+            raise SequentialScanFound(f'Последовательное чтение больших таблиц:\n{details}')
@@ -1,14 +1,20 @@
 import abc
-import functools
+import csv
+import io
 import typing as t
 import sqlalchemy as sa
 from psycopg2.errorcodes import LOCK_NOT_AVAILABLE
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
 
 from allocation.domain import model
 
-from .db_tables import batches, order_lines, allocations, products
+from . import instrumentation
+from .cache import ProductCache
+from .db_tables import (
+    batches, order_lines, allocations, products, batches_staging, allocations_view, availability_view
+)
 
 
 class AbstractRepository(abc.ABC):
@@ -35,6 +41,29 @@ class AbstractProductRepository(abc.ABC):
     def get(self, sku: str) -> model.Product:
         pass
 
+    @abc.abstractmethod
+    def iter_products(self, chunk_size: int = 1000) -> t.Iterator[model.Product]:
+        """
+        Чтение всех продуктов для отчётов, без блокировок
+        """
+
+    def add_batches(self, new_batches: t.Iterable[model.Batch]) -> int:
+        """
+        Добавление партий пачкой, недостающие продукты создаются
+        :param new_batches: партии
+        :return: число добавленных партий, уже существующие пропускаются
+        """
+        added = 0
+        for batch in new_batches:
+            product = self.get(batch.sku)
+            if product is None:
+                product = model.Product(batch.sku, batches=[])
+                self.add(product)
+            if batch not in product._batches:
+                product.add_batch(batch)
+                added += 1
+        return added
+
 
 class ParallelAccess(Exception):
     pass
@@ -42,103 +71,468 @@ class ParallelAccess(Exception):
 
 class SqlAlchemyRepository(AbstractProductRepository):
 
-    def __init__(self, connection: sa.engine.Connection):
+    def __init__(self, connection: sa.engine.Connection, cache: t.Optional[ProductCache] = None,
+                 optimistic: bool = False, partial: bool = False, read_only: bool = False):
+        """
+        :param connection: соединение с открытой транзакцией
+        :param cache: кэш продуктов процесса
+        :param optimistic: загружать продукты без блокировки строки, а параллельные
+            изменения обнаруживать при сохранении по version_number
+        :param partial: загружать только партии с остатком и без строк заказа,
+            строки партии подгружаются при первом снятии аллокации
+        :param read_only: только чтение - продукты загружаются без блокировок
+        """
         self.session = connection
-
-    # def get(self, reference) -> t.Optional[model.Batch]:
-    #     batch = next(self.select_batches(batches.c.reference == reference), None)
-    #     if batch is None:
-    #         return
-    #     for _, line in self.select_lines(allocations.c.batch_id == batch.__repository_id__):
-    #         batch._allocations.add(line)
-    #     return batch
-
+        self.cache = cache
+        self.optimistic = optimistic
+        self.partial = partial
+        self.read_only = read_only
+        self.seen: dict[str, model.Product] = {}
+        self._new_products: list[model.Product] = []
+        # Версии продуктов на момент загрузки из базы
+        self._loaded_versions: dict[str, int] = {}
+
+    @instrumentation.timed
     def get(self, sku: str) -> t.Optional[model.Product]:
-        if not self.check_product_exist(sku):
-            return
-        product = model.Product(sku, self.get_batches(sku))
-        object.__setattr__(product, '__repository__', self)
+        if sku in self.seen:
+            return self.seen[sku]
+        product = self.get_cached(sku) if self.cache is not None else None
+        if product is None:
+            product = self.select_product(sku)
+        if product is not None:
+            product._lines_loader = self.select_batch_lines
+            self.seen[sku] = product
+            self._loaded_versions[sku] = product.version_number
         return product
 
-    def add(self, product: model.Product):
-        self.insert_product(product)
+    @instrumentation.timed
+    def get_cached(self, sku: str) -> t.Optional[model.Product]:
+        """
+        Продукт из кэша, если его версия совпадает с версией в базе.
+        Проверка версии заодно блокирует строку продукта
+        """
+        product = self.cache.take(sku)
+        if product is None:
+            return
+        try:
+            version = self.select_version(sku)
+        except ParallelAccess:
+            # Продукт изменяет другая единица работы: версию проверит следующая выдача
+            self.cache.put(product)
+            raise
+        if version == product.version_number:
+            return product
+
+    def cache_products(self):
+        """
+        Возврат загруженных продуктов в кэш после коммита или отката.
+        После отката возвращаются только продукты без изменений в памяти:
+        их версия по-прежнему совпадает с базой
+        """
+        if self.cache is None:
+            return
+        for sku, loaded_version in self._loaded_versions.items():
+            product = self.seen[sku]
+            if product.version_number != loaded_version or product._has_changes():
+                continue
+            # Загрузчик привязан к соединению этой единицы работы
+            product._lines_loader = None
+            self.cache.put(product)
 
-    @property
-    def is_active(self) -> bool:
-        return (not self.session.closed
-                and self.session.get_transaction() is not None
-                and self.session.get_transaction().is_active)
+    def add(self, product: model.Product):
+        self.seen[product.sku] = product
+        self._new_products.append(product)
 
-    def insert_product(self, product):
-        insert_stmt = insert(products).values({'sku': product.sku})
+    @instrumentation.timed
+    def flush(self):
+        """
+        Сохранение накопленных изменений: каждая группа изменений
+        (продукты, партии, снятые и размещённые строки) - одним запросом
+        """
+        new_products, self._new_products = self._new_products, []
+        new_batches, allocated, deallocated = [], [], []
+        changed_products = []
+        for product in self.seen.values():
+            product_batches, product_allocated, product_deallocated = product._take_changes()
+            new_batches.extend(product_batches)
+            allocated.extend(product_allocated)
+            deallocated.extend(product_deallocated)
+            loaded_version = self._loaded_versions.get(product.sku)
+            if loaded_version is None:
+                continue
+            if product_batches or product_allocated or product_deallocated:
+                if product.version_number == loaded_version:
+                    product.version_number += 1
+            if product.version_number != loaded_version:
+                changed_products.append(product)
+
+        if new_products:
+            self.insert_products(new_products)
+        for product in changed_products:
+            self.update_version(product, self._loaded_versions[product.sku])
+            self._loaded_versions[product.sku] = product.version_number
+        if new_batches:
+            self.insert_batches(new_batches)
+        if deallocated:
+            self.delete_allocations(deallocated)
+        if allocated:
+            self.insert_allocations(allocated)
+
+    @instrumentation.timed
+    def insert_products(self, new_products: list[model.Product]):
+        insert_stmt = insert(products).values(
+            [{'sku': product.sku, 'version_number': product.version_number} for product in new_products]
+        )
+        # Продукт уже создан параллельно - меняем его версию, чтобы сбросить чужие кэши
+        insert_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=[products.c.sku],
+            set_={'version_number': products.c.version_number + 1}
+        )
         self.session.execute(insert_stmt)
-        object.__setattr__(product, '__repository__', self)
 
-    def check_product_exist(self, sku) -> bool:
+    @instrumentation.timed
+    def update_version(self, product: model.Product, loaded_version: int):
+        """
+        Сохранение версии продукта. Если версия в базе уже не та, с которой
+        продукт загружали, продукт изменили параллельно
+        """
+        update_stmt = sa.update(products).where(
+            products.c.sku == product.sku,
+            products.c.version_number == loaded_version
+        ).values(version_number=product.version_number)
+        if self.session.execute(update_stmt).rowcount != 1:
+            raise ParallelAccess('Не получилось сериализовать доступ из-за паралельного обновления')
+
+    @instrumentation.timed
+    def select_version(self, sku: str) -> t.Optional[int]:
+        select_stmt = self.for_update(sa.select([products.c.version_number]).where(
+            products.c.sku == sku
+        ))
+        return self.execute_locking(select_stmt).scalar_one_or_none()
+
+    def for_update(self, select_stmt, **kwargs):
+        if self.optimistic or self.read_only:
+            return select_stmt
+        return select_stmt.with_for_update(nowait=True, **kwargs)
+
+    def execute_locking(self, statement):
         try:
-            select_stmt = sa.select([products], products.c.sku == sku).with_for_update(nowait=True)
-            result = self.session.execute(select_stmt).one_or_none()
-            return bool(result)
-        except OperationalError as err:
-            if err.orig.pgcode != LOCK_NOT_AVAILABLE:
+            return self.session.execute(statement)
+        except DBAPIError as err:
+            # psycopg2 отдаёт OperationalError, asyncpg - общую DBAPIError, pgcode есть у обоих
+            if getattr(err.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE:
                 raise err
             raise ParallelAccess('Не получилось сериализовать доступ из-за паралельного обновления')
-        except Exception as err:
-            raise err
 
+    @instrumentation.timed
+    def select_product(self, sku: str) -> t.Optional[model.Product]:
+        """
+        Загрузка продукта за один запрос: блокировка строки продукта
+        (кроме оптимистичного режима), его партии и размещённые в них строки заказа
+        :param sku: артикул
+        :return: продукт или None, если артикула нет
+        """
+        if self.partial:
+            return self.select_product_in_stock(sku)
+        select_stmt = self.for_update(self.product_rows().where(products.c.sku == sku), of=products)
+        rows = self.execute_locking(select_stmt).all()
+        return next(products_from_rows(rows), None)
+
+    @staticmethod
+    def product_rows():
+        """
+        Запрос строк продуктов: по строке на каждую пару партия - строка заказа,
+        для продукта без партий и партии без аллокаций - с NULL
+        """
+        join_stmt = (products
+                     .join(batches, batches.c.sku == products.c.sku, isouter=True)
+                     .join(allocations, allocations.c.batch_id == batches.c.id, isouter=True)
+                     .join(order_lines, order_lines.c.id == allocations.c.orderline_id, isouter=True))
+        return sa.select([
+            products.c.sku, products.c.version_number,
+            batches.c.id.label('batch_id'), batches.c.reference, batches.c.sku.label('batch_sku'),
+            batches.c.purchased_quantity, batches.c.eta,
+            order_lines.c.id.label('line_id'), order_lines.c.orderid,
+            order_lines.c.sku.label('line_sku'), order_lines.c.qty,
+        ]).select_from(join_stmt)
+
+    def iter_products(self, chunk_size: int = 1000) -> t.Iterator[model.Product]:
+        """
+        Потоковое чтение всех продуктов с партиями и аллокациями для отчётов:
+        серверный курсор отдаёт строки порциями по chunk_size, в памяти
+        одновременно не больше одной порции и одного продукта.
+        Продукты не блокируются и не попадают в единицу работы
+        :param chunk_size: строк в порции
+        :return: продукты в порядке артикула
+        """
+        select_stmt = self.product_rows().order_by(products.c.sku, batches.c.id)
+        result = self.session.execution_options(stream_results=True).execute(select_stmt)
+        yield from products_from_rows(
+            row for partition in instrumentation.fetched_partitions(result, chunk_size) for row in partition)
 
-    def get_batches(self, sku: str) -> list[model.Batch]:
-        batches_dict: dict[int, model.Batch] = {
-            batch.__repository_id__: batch
-            for batch in self.select_batches(batches.c.sku == sku)}
-        lines = self.select_lines(allocations.c.batch_id.in_(batches_dict.keys()))
-        for batch_id, line in lines:
-            batches_dict[batch_id]._allocations.add(line)
-        return list(batches_dict.values())
+    def iter_batch_quantities(self, chunk_size: int = 1000) -> t.Iterator[sa.engine.Row]:
+        """
+        Потоковое чтение размещённого количества партий: сохранённого
+        в batches.allocated_quantity и посчитанного по аллокациям
+        :param chunk_size: строк в порции
+        :return: строки (reference, sku, purchased_quantity, allocated_quantity, lines_quantity)
+        """
+        lines_quantity = sa.select(sa.func.coalesce(sa.func.sum(order_lines.c.qty), 0)).select_from(
+            allocations.join(order_lines, order_lines.c.id == allocations.c.orderline_id)
+        ).where(allocations.c.batch_id == batches.c.id).scalar_subquery()
+        select_stmt = sa.select(
+            batches.c.reference, batches.c.sku, batches.c.purchased_quantity, batches.c.allocated_quantity,
+            lines_quantity.label('lines_quantity')
+        ).order_by(batches.c.id)
+        result = self.session.execution_options(stream_results=True).execute(select_stmt)
+        for partition in instrumentation.fetched_partitions(result, chunk_size):
+            yield from partition
+
+    @instrumentation.timed
+    def select_product_in_stock(self, sku: str) -> t.Optional[model.Product]:
+        """
+        Загрузка продукта только с партиями, у которых есть остаток, без строк заказа:
+        размещённое количество берётся из batches.allocated_quantity
+        :param sku: артикул
+        :return: продукт или None, если артикула нет
+        """
+        join_stmt = products.join(batches, sa.and_(
+            batches.c.sku == products.c.sku,
+            batches.c.purchased_quantity > batches.c.allocated_quantity
+        ), isouter=True)
+        select_stmt = sa.select([
+            products.c.version_number,
+            batches.c.id.label('batch_id'), batches.c.reference, batches.c.sku.label('batch_sku'),
+            batches.c.purchased_quantity, batches.c.allocated_quantity, batches.c.eta,
+        ]).select_from(join_stmt).where(
+            products.c.sku == sku
+        )
+        select_stmt = self.for_update(select_stmt, of=products)
+        rows = self.execute_locking(select_stmt).all()
+        if not rows:
+            return
 
-    def insert_batch(self, batch: model.Batch) -> int:
+        product_batches = []
+        for row in rows:
+            if row.batch_id is None:
+                continue
+            batch = model.Batch(ref=row.reference, sku=row.batch_sku, qty=row.purchased_quantity, eta=row.eta)
+            object.__setattr__(batch, '__repository_id__', row.batch_id)
+            batch._restore_allocated_quantity(row.allocated_quantity)
+            product_batches.append(batch)
+        return model.Product(sku, product_batches, version_number=rows[0].version_number)
+
+    @instrumentation.timed
+    def select_batch_lines(self, batch: model.Batch) -> list[model.OrderLine]:
+        return [line for _, line in self.select_lines(allocations.c.batch_id == batch.__repository_id__)]
+
+    @instrumentation.timed
+    def add_batches(self, new_batches: t.Iterable[model.Batch]) -> int:
         """
-        Метод сохранения партии, без аллокаций
-        :param batch: Партия
-        :return: id партии
+        Массовая загрузка партий: строки потоком уходят через COPY во временную
+        таблицу, затем переносятся в products и batches двумя запросами.
+        Версия продуктов, получивших партии, увеличивается.
+        Загруженные этой единицей работы продукты не обновляются
+        :param new_batches: партии
+        :return: число добавленных партий, уже существующие пропускаются
         """
-        insert_stmt = insert(batches).values({
+        batches_staging.create(self.session, checkfirst=True)
+        self.session.execute(batches_staging.delete())
+        cursor = self.session.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f'COPY {batches_staging.name} (reference, sku, purchased_quantity, eta) FROM STDIN WITH (FORMAT csv)',
+                CsvStream((batch.reference, batch.sku, batch._purchased_quantity, batch.eta)  # noqa
+                          for batch in new_batches)
+            )
+        finally:
+            cursor.close()
+
+        self.session.execute(insert(products).from_select(
+            ['sku'], sa.select(batches_staging.c.sku).distinct()
+        ).on_conflict_do_nothing())
+        inserted = insert(batches).from_select(
+            ['reference', 'sku', 'purchased_quantity', 'eta'],
+            sa.select(batches_staging.c.reference, batches_staging.c.sku,
+                      batches_staging.c.purchased_quantity, batches_staging.c.eta)
+        ).on_conflict_do_nothing().returning(
+            batches.c.reference, batches.c.sku, batches.c.eta, batches.c.purchased_quantity
+        ).cte('inserted')
+        changed_products = sa.update(products).values(
+            version_number=products.c.version_number + 1
+        ).where(products.c.sku.in_(sa.select(inserted.c.sku))).cte('changed_products')
+        select_stmt = sa.select(sa.func.count()).select_from(inserted).add_cte(
+            changed_products).add_cte(self.insert_availability(inserted))
+        return self.session.execute(select_stmt).scalar_one()
+
+    @instrumentation.timed
+    def insert_batches(self, new_batches: list[model.Batch]):
+        """
+        Сохранение новых партий, без аллокаций, одним запросом. id приходят
+        через RETURNING, в том числе для партий, которые уже есть в базе
+        :param new_batches: Партии
+        """
+        inserted = insert(batches).values([{
             'reference': batch.reference,
             'sku': batch.sku,
             'purchased_quantity': batch._purchased_quantity,  # noqa
             'eta': batch.eta
-        }).on_conflict_do_nothing()
-        self.session.execute(insert_stmt)
-        batch_id = next(self.select_batches(batches.c.reference == batch.reference)).__repository_id__
-        object.__setattr__(batch, '__repository__', self)
-        object.__setattr__(batch, '__repository_id__', batch_id)
-        return batch_id
-
-    def select_batches(self, *condition) -> t.Iterator[model.Batch]:
-        batch_stmt = sa.select(batches)
-        if condition:
-            batch_stmt = batch_stmt.where(*condition)
-        rows = self.session.execute(batch_stmt).all()
-        for row in rows:
-            batch = model.Batch(ref=row.reference, sku=row.sku, qty=row.purchased_quantity, eta=row.eta)
-            object.__setattr__(batch, '__repository__', self)
-            object.__setattr__(batch, '__repository_id__', row.id)
-            yield batch
-
-    def delete_allocations(self, batch_id: int, line_id: int):
-        if self.is_active:
-            delete_stmt = sa.delete(allocations).where(
-                allocations.c.batch_id == batch_id,
-                allocations.c.orderline_id == line_id
+        } for batch in new_batches]).on_conflict_do_nothing().returning(
+            batches.c.id, batches.c.reference, batches.c.sku, batches.c.eta, batches.c.purchased_quantity
+        ).cte('inserted')
+        # CTE видит снимок до вставки: существующие строки - ровно конфликтовавшие
+        existing = sa.select(batches.c.id, batches.c.reference).where(
+            batches.c.reference.in_([batch.reference for batch in new_batches])
+        )
+        stored = sa.union_all(sa.select(inserted.c.id, inserted.c.reference), existing).subquery('stored')
+        select_stmt = sa.select(stored).add_cte(self.insert_availability(inserted))
+        ids = {row.reference: row.id for row in self.session.execute(select_stmt)}
+        missing = [batch.reference for batch in new_batches if batch.reference not in ids]
+        if missing:
+            # Конфликтующую строку закоммитила параллельная транзакция уже после
+            # снимка запроса: её видит только новый запрос
+            ids.update((row.reference, row.id) for row in self.session.execute(
+                sa.select(batches.c.reference, batches.c.id).where(batches.c.reference.in_(missing))
+            ))
+        if len(ids) < len(new_batches):
+            raise ParallelAccess(f'Партии продукта {new_batches[0].sku} изменены параллельно')
+        for batch in new_batches:
+            object.__setattr__(batch, '__repository_id__', ids[batch.reference])
+
+    @instrumentation.timed
+    def delete_allocations(self, deallocated: list[tuple[model.Batch, model.OrderLine]]):
+        """
+        Удаление аллокаций и уменьшение batches.allocated_quantity одним запросом
+        :param deallocated: партия, строка заказа
+        """
+        deleted = sa.delete(allocations).where(
+            allocations.c.orderline_id == order_lines.c.id,
+            allocations.c.batch_id == batches.c.id,
+            sa.tuple_(batches.c.reference, order_lines.c.orderid, order_lines.c.sku).in_(
+                [(batch.reference, line.orderid, line.sku) for batch, line in deallocated]
             )
-            self.session.execute(delete_stmt)
+        ).returning(
+            allocations.c.batch_id, order_lines.c.qty, order_lines.c.orderid, order_lines.c.sku
+        ).cte('deleted')
+        changed = self.change_allocated_quantity(deleted, -1).cte('changed')
+        deleted_views = sa.delete(allocations_view).where(
+            sa.tuple_(allocations_view.c.orderid, allocations_view.c.sku).in_(
+                sa.select(deleted.c.orderid, deleted.c.sku))
+        ).cte('deleted_views')
+        select_stmt = sa.select(sa.func.count()).select_from(changed).add_cte(
+            deleted_views).add_cte(self.upsert_availability(changed))
+        self.session.execute(select_stmt)
+
+    @instrumentation.timed
+    def insert_allocations(self, allocated: list[tuple[model.Batch, model.OrderLine]]):
+        """
+        Сохранение строк заказа, их аллокаций и batches.allocated_quantity одним запросом:
+        новые строки вставляются в CTE, уже сохранённые берутся из order_lines
+        :param allocated: партия, строка заказа
+        """
+        rows = sa.select(sa.values(
+            sa.column('orderid', sa.String), sa.column('sku', sa.String),
+            sa.column('qty', sa.Integer), sa.column('reference', sa.String),
+            name='rows'
+        ).data([(line.orderid, line.sku, line.qty, batch.reference) for batch, line in allocated])).cte('data')
+        new_lines = insert(order_lines).from_select(
+            ['orderid', 'sku', 'qty'], sa.select(rows.c.orderid, rows.c.sku, rows.c.qty)
+        ).on_conflict_do_nothing().returning(
+            order_lines.c.id, order_lines.c.orderid, order_lines.c.sku, order_lines.c.qty
+        ).cte('new_lines')
+        stored_lines = sa.union_all(
+            sa.select(new_lines.c.id, new_lines.c.orderid, new_lines.c.sku, new_lines.c.qty),
+            sa.select(order_lines.c.id, order_lines.c.orderid, order_lines.c.sku, order_lines.c.qty).join(
+                rows, sa.and_(order_lines.c.orderid == rows.c.orderid, order_lines.c.sku == rows.c.sku))
+        ).cte('stored_lines')
+        select_stmt = sa.select(stored_lines.c.id, batches.c.id).select_from(
+            rows.join(stored_lines, sa.and_(stored_lines.c.orderid == rows.c.orderid,
+                                            stored_lines.c.sku == rows.c.sku))
+                .join(batches, batches.c.reference == rows.c.reference)
+        )
+        inserted = insert(allocations).from_select(
+            ['orderline_id', 'batch_id'], select_stmt
+        ).on_conflict_do_nothing().returning(allocations.c.orderline_id, allocations.c.batch_id).cte('inserted')
+        inserted_lines = sa.select(inserted.c.batch_id, stored_lines.c.qty).join(
+            stored_lines, stored_lines.c.id == inserted.c.orderline_id
+        ).cte('inserted_lines')
+        changed = self.change_allocated_quantity(inserted_lines, 1).cte('changed')
+        # В модель чтения - только действительно вставленные аллокации
+        inserted_views = insert(allocations_view).from_select(
+            ['orderid', 'sku', 'batchref'],
+            sa.select(stored_lines.c.orderid, stored_lines.c.sku, batches.c.reference).select_from(
+                inserted.join(stored_lines, stored_lines.c.id == inserted.c.orderline_id)
+                        .join(batches, batches.c.id == inserted.c.batch_id))
+        ).on_conflict_do_update(
+            index_elements=[allocations_view.c.orderid, allocations_view.c.sku],
+            set_={'batchref': insert(allocations_view).excluded.batchref}
+        ).cte('inserted_views')
+        # Один результат на строку заказа: её id и изменение количества её партии
+        select_stmt = sa.select(
+            stored_lines.c.id, stored_lines.c.orderid, stored_lines.c.sku,
+            rows.c.reference, changed.c.qty.label('changed_qty')
+        ).select_from(
+            rows.join(stored_lines, sa.and_(stored_lines.c.orderid == rows.c.orderid,
+                                            stored_lines.c.sku == rows.c.sku))
+                .join(changed, changed.c.reference == rows.c.reference, isouter=True)
+        ).add_cte(inserted_views).add_cte(self.upsert_availability(changed))
+        result = self.session.execute(select_stmt).all()
+
+        line_ids = {(row.orderid, row.sku): row.id for row in result}
+        changed_quantities = {row.reference: row.changed_qty or 0 for row in result}
+        for _, line in allocated:
+            object.__setattr__(line, '__repository_id__', line_ids[line.orderid, line.sku])
+        # Партия без загруженных строк не видит, что строка уже была в ней размещена:
+        # такая строка не вставлена, и количество в памяти поправляется по базе
+        expected: dict[str, list] = {}
+        for batch, line in allocated:
+            expected.setdefault(batch.reference, [batch, 0])[1] += line.qty
+        for reference, (batch, quantity) in expected.items():
+            if changed_quantities.get(reference, 0) != quantity:
+                batch._allocated_quantity -= quantity - changed_quantities.get(reference, 0)
+                batch._quantity_changed()
+
+    @staticmethod
+    def change_allocated_quantity(changed, sign: int):
+        """
+        UPDATE batches.allocated_quantity по строкам (batch_id, qty), которые
+        действительно вставлены или удалены в CTE того же запроса
+        """
+        delta = sa.select(
+            changed.c.batch_id, sa.func.sum(changed.c.qty).label('qty')
+        ).group_by(changed.c.batch_id).subquery('delta')
+        return sa.update(batches).values(
+            allocated_quantity=batches.c.allocated_quantity + sign * delta.c.qty
+        ).where(batches.c.id == delta.c.batch_id).returning(
+            batches.c.reference, delta.c.qty, batches.c.sku, batches.c.eta,
+            (batches.c.purchased_quantity - batches.c.allocated_quantity).label('available_quantity')
+        )
+
+    @staticmethod
+    def insert_availability(inserted):
+        """
+        Остатки новых партий в модель чтения, CTE по строкам
+        (reference, sku, eta, purchased_quantity)
+        """
+        return insert(availability_view).from_select(
+            ['reference', 'sku', 'eta', 'available_quantity'],
+            sa.select(inserted.c.reference, inserted.c.sku, inserted.c.eta, inserted.c.purchased_quantity)
+        ).on_conflict_do_nothing().cte('inserted_availability')
 
-    def insert_allocation(self, batch_id: int, line_id: int):
-        if self.is_active:
-            insert_stmt = insert(allocations).values({
-                'batch_id': batch_id, 'orderline_id': line_id
-            }).on_conflict_do_nothing()
-            self.session.execute(insert_stmt)
+    @staticmethod
+    def upsert_availability(changed):
+        """
+        Новые остатки партий в модель чтения, CTE по строкам
+        (reference, sku, eta, available_quantity) из RETURNING обновления batches
+        """
+        upsert = insert(availability_view).from_select(
+            ['reference', 'sku', 'eta', 'available_quantity'],
+            sa.select(changed.c.reference, changed.c.sku, changed.c.eta, changed.c.available_quantity)
+        )
+        return upsert.on_conflict_do_update(
+            index_elements=[availability_view.c.reference],
+            set_={'available_quantity': upsert.excluded.available_quantity}
+        ).cte('changed_availability')
 
     def select_lines(self, *condition) -> t.Iterator[tuple[int, model.OrderLine]]:
         """
@@ -153,79 +547,110 @@ class SqlAlchemyRepository(AbstractProductRepository):
                                 order_lines]).select_from(join_stmt)
         if condition:
             lines_stmt = lines_stmt.where(*condition)
-        rows = self.session.execute(lines_stmt).all()
-        for row in rows:
+        result = self.session.execution_options(stream_results=True).execute(lines_stmt)
+        for row in (row for partition in instrumentation.fetched_partitions(result, 1000) for row in partition):
             line = model.OrderLine(row.orderid, row.sku, row.qty)
             object.__setattr__(line, '__repository_id__', row.id)
             yield row.batch_id, line
 
-    def sync_orderline(self, line: model.OrderLine) -> int:
-        if hasattr(line, '__repository_id__'):
-            return line.__repository_id__
-        insert_stmt = insert(order_lines).values({
-            'sku': line.sku,
-            'orderid': line.orderid,
-            'qty': line.qty
-        }).on_conflict_do_nothing()
-        self.session.execute(insert_stmt)
-        [(_, stored_line)] = self.select_lines(
-                order_lines.c.orderid == line.orderid,
-                order_lines.c.sku == line.sku
-            )
-        return stored_line.__repository_id__
-
-
-def activate():
-    # Batch decorator
-    def allocate_wrapper(func):
-        def wrapper(batch: model.Batch, line: model.OrderLine):
-            func(batch, line)
-            if hasattr(batch, '__repository__') and line in batch._allocations:
-                repository: SqlAlchemyRepository = batch.__repository__
-                line_id = repository.sync_orderline(line)
-                repository.insert_allocation(batch.__repository_id__, line_id)
-
-        wrapper.__original__ = func
-        return wrapper
-
-    def deallocate_wrapper(func):
-        def wrapper(batch: model.Batch, line: model.OrderLine):
-            func(batch, line)
-            if hasattr(batch, '__repository__') and line not in batch._allocations:
-                repository: SqlAlchemyRepository = batch.__repository__
-                line_id = repository.sync_orderline(line)
-                repository.delete_allocations(batch.__repository_id__, line_id)
-
-        wrapper.__original__ = func
-        return wrapper
-
-    if not hasattr(model.Batch.allocate, '__original__'):
-        model.Batch.allocate = allocate_wrapper(model.Batch.allocate)
-    if not hasattr(model.Batch.deallocate, '__original__'):
-        model.Batch.deallocate = deallocate_wrapper(model.Batch.deallocate)
-
-    # Product decorate
-    def add_batch_wrapper(func):
-        def wrapper(product: model.Product, batch: model.Batch):
-            func(product, batch)
-            if hasattr(product, '__repository__') and batch in product._batches:
-                repository: SqlAlchemyRepository = product.__repository__
-                repository.insert_batch(batch)
-
-        wrapper.__original__ = func
-        return wrapper
-
-    if not hasattr(model.Product.add_batch, '__original__'):
-        model.Product.add_batch = add_batch_wrapper(model.Product.add_batch)
-
-
-def clear():
-    # clear Batch
-    if hasattr(model.Batch.allocate, '__original__'):
-        model.Batch.allocate = model.Batch.allocate.__original__
-
-    if hasattr(model.Batch.deallocate, '__original__'):
-        model.Batch.deallocate = model.Batch.deallocate.__original__
-
-    if hasattr(model.Product.add_batch, '__original__'):
-        model.Product.add_batch = model.Product.add_batch.__original__
+
+class AsyncSqlAlchemyRepository(AbstractProductRepository):
+    """
+    Асинхронный репозиторий поверх SqlAlchemyRepository: запросы те же, а
+    выполняются через AsyncConnection.run_sync, не блокируя цикл событий.
+    Режим partial не поддерживается - ленивая подгрузка строк заказа
+    синхронная
+    """
+
+    def __init__(self, connection: AsyncConnection, cache: t.Optional[ProductCache] = None,
+                 optimistic: bool = False):
+        self.connection = connection
+        self.sync = SqlAlchemyRepository(connection.sync_connection, cache=cache, optimistic=optimistic)
+
+    def add(self, product: model.Product):
+        self.sync.add(product)
+
+    async def get(self, sku: str) -> t.Optional[model.Product]:
+        return await self.connection.run_sync(lambda _: self.sync.get(sku))
+
+    async def flush(self):
+        await self.connection.run_sync(lambda _: self.sync.flush())
+
+    async def iter_products(self, chunk_size: int = 1000) -> t.AsyncIterator[model.Product]:
+        # Серверный курсор читается по продукту за вызов run_sync
+        products = self.sync.iter_products(chunk_size)
+        while True:
+            product = await self.connection.run_sync(lambda _: next(products, None))
+            if product is None:
+                return
+            yield product
+
+    def cache_products(self):
+        self.sync.cache_products()
+
+
+def products_from_rows(rows: t.Iterable[sa.engine.Row]) -> t.Iterator[model.Product]:
+    """
+    Сборка продуктов из строк SqlAlchemyRepository.product_rows,
+    строки одного продукта должны идти подряд
+    """
+    sku, version_number = None, None
+    batches_dict: dict[int, model.Batch] = {}
+    lines_by_batch: dict[int, list[model.OrderLine]] = {}
+
+    def build() -> model.Product:
+        for batch_id, lines in lines_by_batch.items():
+            batches_dict[batch_id]._restore_allocations(lines)
+        return model.Product(sku, batches_dict.values(), version_number=version_number)
+
+    for row in rows:
+        if row.sku != sku:
+            if sku is not None:
+                yield build()
+            sku, version_number = row.sku, row.version_number
+            batches_dict, lines_by_batch = {}, {}
+        if row.batch_id is None:
+            continue
+        if row.batch_id not in batches_dict:
+            batch = model.Batch(ref=row.reference, sku=row.batch_sku,
+                                qty=row.purchased_quantity, eta=row.eta)
+            object.__setattr__(batch, '__repository_id__', row.batch_id)
+            batches_dict[row.batch_id] = batch
+            lines_by_batch[row.batch_id] = []
+        if row.line_id is not None:
+            line = model.OrderLine(row.orderid, row.line_sku, row.qty)
+            object.__setattr__(line, '__repository_id__', row.line_id)
+            lines_by_batch[row.batch_id].append(line)
+    if sku is not None:
+        yield build()
+
+
+class CsvStream(io.RawIOBase):
+    """
+    Файловый объект для COPY FROM STDIN: строки кодируются в CSV по мере
+    чтения, так что в памяти держится не больше одного блока
+    """
+
+    def __init__(self, rows: t.Iterable[tuple]):
+        super().__init__()
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self._pending += self._buffer.getvalue().encode()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        if size < 0:
+            size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
@@ -0,0 +1,210 @@
+import hashlib
+import math
+import os
+import threading
+import time
+import typing as t
+import weakref
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+
+from .db_tables import products
+
+_registries: 'weakref.WeakSet[SkuRegistry]' = weakref.WeakSet()
+
+
+class BloomFilter:
+    """
+    Множество строк с ложноположительными ответами: отсутствие ответ гарантирует,
+    присутствие - с вероятностью ошибки false_positive_rate при заполнении до capacity
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> t.Iterator[int]:
+        # Двойное хэширование: k позиций из двух 64-битных половин одного хэша
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        for number in range(self.hashes):
+            yield (first + number * second) % self.size
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SkuRegistry:
+    """
+    Артикулы продуктов в памяти процесса, чтобы не тратить транзакцию
+    с блокировкой продукта на недопустимый артикул.
+
+    Bloom-фильтр строится по таблице products в фоновом потоке, который
+    запускает start() при первом запросе процесса (и заново после fork),
+    и перестраивается каждые refresh_interval секунд; add_batch этого
+    процесса добавляет артикулы сразу. Артикулы, которых не нашла база,
+    помнятся в LRU до refresh_interval секунд.
+
+    Отрицательный ответ фильтра не окончательный: артикул мог создать другой
+    процесс. exists() перепроверяет его одним запросом без блокировок, и только
+    отсутствие в базе даёт InvalidSku. Если фильтр не обновлялся дольше
+    2 * refresh_interval, его отрицательные ответы не учитываются
+    """
+
+    def __init__(self, engine_factory: t.Callable[[], Engine], refresh_interval: float = 10.0,
+                 missing_size: int = 10_000, false_positive_rate: float = 0.01,
+                 clock: t.Callable[[], float] = time.monotonic):
+        self.engine_factory = engine_factory
+        self.refresh_interval = refresh_interval
+        self.missing_size = missing_size
+        self.false_positive_rate = false_positive_rate
+        self.clock = clock
+        self.last_error: t.Optional[Exception] = None
+        self._bloom: t.Optional[BloomFilter] = None
+        self._fresh_until = 0.0
+        # Артикулы, добавленные во время перестройки фильтра
+        self._added_during_refresh: t.Optional[list[str]] = None
+        self._missing: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread: t.Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        # Процесс, в котором запущен фоновый поток
+        self._started_pid: t.Optional[int] = None
+        _registries.add(self)
+
+    def might_exist(self, sku: str) -> bool:
+        now = self.clock()
+        with self._lock:
+            expires = self._missing.get(sku)
+            if expires is not None:
+                if expires > now:
+                    self._missing.move_to_end(sku)
+                    return False
+                del self._missing[sku]
+            if self._bloom is None or now > self._fresh_until:
+                return True
+            return sku in self._bloom
+
+    def exists(self, sku: str) -> bool:
+        """
+        :return: False - артикула нет в базе; True - он есть или его проверит
+            загрузка продукта
+        """
+        if self.might_exist(sku):
+            return True
+        with self._lock:
+            # Отсутствие уже подтвердила база
+            if sku in self._missing:
+                return False
+        with self.engine_factory().connect() as connection:
+            found = connection.execute(
+                sa.select(products.c.sku).where(products.c.sku == sku)
+            ).first() is not None
+        if found:
+            self.add(sku)
+        else:
+            self.record_missing(sku)
+        return found
+
+    def add(self, sku: str):
+        with self._lock:
+            self._missing.pop(sku, None)
+            if self._bloom is not None:
+                self._bloom.add(sku)
+            if self._added_during_refresh is not None:
+                self._added_during_refresh.append(sku)
+
+    def record_missing(self, sku: str):
+        """
+        Артикула нет в базе - повторные запросы проверяются без блокировок,
+        даже если фильтр ошибочно его содержит
+        """
+        with self._lock:
+            self._missing[sku] = self.clock() + self.refresh_interval
+            self._missing.move_to_end(sku)
+            while len(self._missing) > self.missing_size:
+                self._missing.popitem(last=False)
+
+    def refresh(self):
+        """
+        Перестройка фильтра по всем артикулам базы, потоково
+        """
+        started = self.clock()
+        with self._lock:
+            self._added_during_refresh = []
+        try:
+            with self.engine_factory().connect() as connection:
+                count = connection.execute(sa.select(sa.func.count()).select_from(products)).scalar()
+                # Запас ёмкости на артикулы, добавленные до следующей перестройки
+                bloom = BloomFilter(max(2 * count, 1024), self.false_positive_rate)
+                result = connection.execution_options(stream_results=True).execute(sa.select(products.c.sku))
+                for partition in result.scalars().partitions(10_000):
+                    for sku in partition:
+                        bloom.add(sku)
+        except Exception:
+            with self._lock:
+                self._added_during_refresh = None
+            raise
+        with self._lock:
+            for sku in self._added_during_refresh:
+                bloom.add(sku)
+            self._added_during_refresh = None
+            self._bloom = bloom
+            self._fresh_until = started + 2 * self.refresh_interval
+
+    def start(self):
+        """
+        Фоновое заполнение и перестройка фильтра, если поток ещё не запущен
+        в этом процессе. Пока первое заполнение не закончено, все артикулы
+        проверяет загрузка продукта
+        """
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        with self._lock:
+            if self._started_pid == pid:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._refresh_forever, name='sku-registry', daemon=True)
+            self._thread.start()
+            self._started_pid = pid
+
+    def _after_fork_in_child(self):
+        # Фонового потока в дочернем процессе нет, а блокировку мог держать поток родителя
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._started_pid = None
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._started_pid == os.getpid():
+            self._thread.join()
+        self._started_pid = None
+
+    def _refresh_forever(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as error:
+                # Фильтр устареет, и его отрицательные ответы перестанут учитываться
+                self.last_error = error
+            self._stopped.wait(self.refresh_interval)
+
+
+def _after_fork_in_child():
+    for registry in list(_registries):
+        registry._after_fork_in_child()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
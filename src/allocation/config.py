@@ -10,7 +10,92 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_async_postgres_uri():
+    # Тот же адрес для движка sqlalchemy.ext.asyncio
+    return get_postgres_uri().replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def get_replica_postgres_uri():
+    # Реплика для чтения; без DB_REPLICA_HOST чтение идёт в основную базу
+    host = os.environ.get("DB_REPLICA_HOST")
+    if not host:
+        return None
+    password = os.environ.get("DB_PASSWORD", "example")
+    user, db_name = "cosmic", "cosmic_db"
+    return f"postgresql://{user}:{password}@{host}:5432/{db_name}"
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "127.0.0.1")
     port = 5000 if host == "127.0.0.1" else 80
     return f"http://{host}:{port}"
+
+
+def get_product_cache_size():
+    # Вес кэша: продукты, их партии и строки заказа; 0 - кэш выключен
+    return int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+
+
+def get_concurrency_mode():
+    # pessimistic - SELECT ... FOR UPDATE NOWAIT, optimistic - проверка version_number при коммите
+    return os.environ.get("CONCURRENCY_MODE", "pessimistic")
+
+
+def get_allocation_shards():
+    # Число потоков-шардов для последовательной аллокации по артикулу, 0 - без диспетчера
+    return int(os.environ.get("ALLOCATION_SHARDS", 0))
+
+
+def get_allocation_group_window():
+    # Сколько ждать попутные аллокации для группового коммита, сек
+    return float(os.environ.get("ALLOCATION_GROUP_WINDOW", 0.0))
+
+
+def get_allocation_group_size():
+    # Максимум аллокаций в одном групповом коммите, 1 - без группировки
+    return int(os.environ.get("ALLOCATION_GROUP_SIZE", 1))
+
+
+def get_allocation_timeout():
+    # Сколько запрос ждёт аллокацию в очереди шарда, сек
+    return float(os.environ.get("ALLOCATION_TIMEOUT", 30))
+
+
+def get_partial_load():
+    # Загружать для аллокации только партии с остатком, строки заказа - по требованию
+    return os.environ.get("PARTIAL_LOAD", "0") == "1"
+
+
+def get_pool_size():
+    # Постоянных соединений в пуле движка на процесс
+    return int(os.environ.get("DB_POOL_SIZE", 5))
+
+
+def get_pool_max_overflow():
+    # Дополнительных соединений сверх пула при пиковой нагрузке
+    return int(os.environ.get("DB_POOL_MAX_OVERFLOW", 10))
+
+
+def get_pool_timeout():
+    # Сколько ждать свободное соединение пула, сек
+    return float(os.environ.get("DB_POOL_TIMEOUT", 30))
+
+
+def get_pool_recycle():
+    # Соединения старше этого возраста пересоздаются, сек; -1 - никогда
+    return int(os.environ.get("DB_POOL_RECYCLE", 1800))
+
+
+def get_pool_pre_ping():
+    # Проверять соединение перед выдачей из пула
+    return os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+
+
+def get_metrics_sku_buckets():
+    # На сколько корзин делить артикулы в метриках отказов аллокации
+    return int(os.environ.get("METRICS_SKU_BUCKETS", 16))
+
+
+def get_sku_registry_refresh():
+    # Период перестройки фильтра артикулов для быстрого InvalidSku, сек; 0 - без фильтра
+    return float(os.environ.get("SKU_REGISTRY_REFRESH", 0))
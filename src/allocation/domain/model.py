@@ -1,16 +1,31 @@
+import heapq
 import typing as t
 from dataclasses import dataclass
-from datetime import date
+from datetime import date, datetime
 
 
 @dataclass(frozen=True)
 class OrderLine:
+    __slots__ = ('orderid', 'sku', 'qty', '__repository_id__')
+
     orderid: str
     sku: str
     qty: int
 
+    # copy и pickle восстанавливают слоты через setattr, который frozen запрещает
+    def __getstate__(self) -> dict[str, t.Any]:
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state: dict[str, t.Any]):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
 
 class Batch:
+    __slots__ = ('reference', 'sku', 'eta', '_purchased_quantity',
+                 '_allocations', '_allocated_quantity', '_lines_loaded', '_product', '_changes',
+                 '__repository_id__')
+
     def __init__(
             self, ref: str, sku: str, qty: int, eta: t.Optional[date]
     ):
@@ -18,23 +33,76 @@ class Batch:
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
-        self._allocations = set()
+        self._allocations: set[OrderLine] = set()
+        self._allocated_quantity = 0
+        # False - в _allocations не все строки, allocated_quantity загружен отдельно
+        self._lines_loaded = True
+        self._product: t.Optional[Product] = None
+        # Несохранённые изменения: строка -> True (размещена) / False (снята)
+        self._changes: dict[OrderLine, bool] = {}
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            self._allocated_quantity += line.qty
+            self._lines_changed(1)
+            self._record_change(line, allocated=True)
 
     def deallocate(self, line: OrderLine):
+        if not self._lines_loaded:
+            self._load_lines()
         if line in self._allocations:
             self._allocations.remove(line)
+            self._allocated_quantity -= line.qty
+            self._lines_changed(-1)
+            self._record_change(line, allocated=False)
+
+    def _restore_allocations(self, lines: t.Iterable[OrderLine]):
+        # Загрузка уже сохранённых аллокаций, минуя проверки allocate
+        loaded = len(self._allocations)
+        for line in lines:
+            if line not in self._allocations:
+                self._allocations.add(line)
+                self._allocated_quantity += line.qty
+        self._lines_changed(len(self._allocations) - loaded)
+        self._quantity_changed()
+
+    def _restore_allocated_quantity(self, allocated_quantity: int):
+        # Загрузка без строк заказа: они подгружаются при первом deallocate
+        self._allocated_quantity = allocated_quantity
+        self._lines_loaded = False
+        self._quantity_changed()
+
+    def _load_lines(self):
+        # Строки, размещённые в этой же сессии, уже есть в _allocations и учтены в количестве
+        loaded = len(self._allocations)
+        self._allocations.update(self._product._load_lines(self))
+        self._lines_loaded = True
+        self._lines_changed(len(self._allocations) - loaded)
+
+    def _record_change(self, line: OrderLine, allocated: bool):
+        if self._changes.get(line, allocated) != allocated:
+            # Обратное несохранённому изменению - отменяем его
+            del self._changes[line]
+        else:
+            self._changes[line] = allocated
+        self._quantity_changed()
+
+    def _lines_changed(self, count: int):
+        if self._product is not None:
+            self._product._lines += count
+
+    def _quantity_changed(self):
+        if self._product is not None:
+            self._product._batch_changed(self)
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
-        return self._purchased_quantity - self.allocated_quantity
+        return self._purchased_quantity - self._allocated_quantity
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
@@ -58,7 +126,7 @@ class Batch:
 def allocate(line: OrderLine, batches: t.Iterable[Batch]) -> str:
     try:
         batch = next(
-            b for b in sorted(batches) if b.can_allocate(line)
+            b for b in sorted(batches, key=_batch_priority) if b.can_allocate(line)
         )
         batch.allocate(line)
         return batch.reference
@@ -70,16 +138,127 @@ class OutOfStock(Exception):
     pass
 
 
+def _batch_priority(batch: Batch) -> tuple:
+    # Партии на складе (eta is None) идут первыми, затем по eta и reference.
+    # eta из базы приходит как datetime, из сервисов - как date; сравниваем даты.
+    eta = batch.eta
+    if eta is None:
+        return False, date.min, batch.reference
+    if isinstance(eta, datetime):
+        eta = eta.date()
+    return True, eta, batch.reference
+
+
+class _BatchQueue:
+    """
+    Партии с ненулевым остатком в порядке _batch_priority - куча с ленивым
+    удалением: израсходованная партия остаётся в куче, пока не окажется на
+    вершине, и выбрасывается при следующем поиске. Каждая партия в куче не
+    больше одного раза, приоритет партии не меняется.
+
+    Первая партия очереди находится за O(log n). Если её остатка не хватает
+    на строку, подходящая партия ищется перебором кучи
+    """
+
+    def __init__(self, batches: t.Iterable[Batch] = ()):
+        self._heap: list[tuple[tuple, Batch]] = [(_batch_priority(b), b) for b in batches if b.available_quantity > 0]
+        heapq.heapify(self._heap)
+        self._queued: set[Batch] = {batch for _, batch in self._heap}
+
+    def __len__(self):
+        return sum(1 for _, batch in self._heap if batch.available_quantity > 0)
+
+    def __iter__(self) -> t.Iterator[Batch]:
+        return (batch for _, batch in sorted(self._heap) if batch.available_quantity > 0)
+
+    def update(self, batch: Batch):
+        if batch.available_quantity > 0 and batch not in self._queued:
+            self._queued.add(batch)
+            heapq.heappush(self._heap, (_batch_priority(batch), batch))
+
+    def first(self, line: OrderLine) -> t.Optional[Batch]:
+        heap = self._heap
+        while heap and heap[0][1].available_quantity <= 0:
+            _, batch = heapq.heappop(heap)
+            self._queued.discard(batch)
+        if not heap:
+            return None
+        if heap[0][1].can_allocate(line):
+            return heap[0][1]
+        return min((entry for entry in heap if entry[1].can_allocate(line)), default=(None, None))[1]
+
+
 class Product:
     def __init__(self, sku: str, batches: t.Iterable[Batch], version_number: int = 0):
         self.sku = sku
         self.version_number = version_number
-        self._batches = set(batches)
+        self._batches: set[Batch] = set(batches)
+        self._queue = _BatchQueue(self._batches)
+        self._new_batches: list[Batch] = []
+        self._changed_batches: set[Batch] = set()
+        # Загрузчик строк заказа для партий, загруженных без них (задаёт репозиторий)
+        self._lines_loader: t.Optional[t.Callable[[Batch], t.Iterable[OrderLine]]] = None
+        # Строк заказа в партиях продукта, поддерживается партиями при изменениях
+        self._lines = 0
+        for batch in self._batches:
+            batch._product = self
+            self._lines += len(batch._allocations)
 
     def allocate(self, line: OrderLine) -> str:
-        result = allocate(line, self._batches)
+        batch = self._queue.first(line)
+        if batch is None:
+            raise OutOfStock(f'Артикула {line.sku} нет в наличии')
+        batch.allocate(line)
         self.version_number += 1
-        return result
+        return batch.reference
+
+    def allocate_many(self, lines: t.Iterable[OrderLine]) -> list[t.Union[str, OutOfStock]]:
+        results: list[t.Union[str, OutOfStock]] = []
+        for line in lines:
+            try:
+                results.append(self.allocate(line))
+            except OutOfStock as err:
+                results.append(err)
+        return results
 
     def add_batch(self, batch: Batch):
+        if batch not in self._batches:
+            self._attach(batch)
+            self._new_batches.append(batch)
+
+    def _attach(self, batch: Batch):
+        if batch in self._batches:
+            return
         self._batches.add(batch)
+        batch._product = self
+        self._lines += len(batch._allocations)
+        self._queue.update(batch)
+
+    def _load_lines(self, batch: Batch) -> t.Iterable[OrderLine]:
+        if self._lines_loader is None:
+            raise RuntimeError(f'Строки заказа партии {batch.reference} не загружены')
+        return self._lines_loader(batch)
+
+    def _batch_changed(self, batch: Batch):
+        self._queue.update(batch)
+        if batch._changes:
+            self._changed_batches.add(batch)
+
+    def _has_changes(self) -> bool:
+        return bool(self._new_batches or self._changed_batches)
+
+    def _take_changes(self) -> tuple[list[Batch],
+                                     list[tuple[Batch, OrderLine]],
+                                     list[tuple[Batch, OrderLine]]]:
+        """
+        Изменения с момента загрузки или прошлого вызова, для сохранения репозиторием
+        :return: новые партии, размещённые строки, снятые строки
+        """
+        new_batches, self._new_batches = self._new_batches, []
+        allocated, deallocated = [], []
+        for batch in self._changed_batches:
+            for line, is_allocated in batch._changes.items():
+                (allocated if is_allocated else deallocated).append((batch, line))
+            batch._changes.clear()
+        self._changed_batches.clear()
+        return new_batches, allocated, deallocated
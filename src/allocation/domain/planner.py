@@ -0,0 +1,83 @@
+import typing as t
+
+import numpy as np
+
+from allocation.domain import model
+
+
+class AllocationPlanner:
+    """
+    Планировщик аллокаций для what-if расчётов.
+
+    Остатки партий хранятся в массиве NumPy в порядке приоритета Product
+    (склад, eta, reference). Строки заказа назначаются проходами: подряд
+    идущие строки, которые целиком помещаются в первую партию с остатком,
+    назначаются одним cumsum/searchsorted, остальные - поиском первой
+    подходящей партии по маске остатков.
+
+    Результат совпадает с последовательными вызовами Product.allocate при
+    условии, что qty >= 0 и строки не повторяются и ещё не размещены.
+    Сам продукт планировщик не изменяет.
+    """
+
+    def __init__(self, sku: str, references: t.Sequence[str], available: np.ndarray):
+        self.sku = sku
+        self._references = list(references)
+        self._available = np.asarray(available, dtype=np.int64)
+
+    @classmethod
+    def from_product(cls, product: model.Product) -> 'AllocationPlanner':
+        batches = [batch for batch in product._queue if batch.sku == product.sku]
+        return cls(product.sku,
+                   [batch.reference for batch in batches],
+                   np.fromiter((batch.available_quantity for batch in batches),
+                               dtype=np.int64, count=len(batches)))
+
+    def plan(self, lines: t.Sequence[model.OrderLine]) -> list[t.Optional[str]]:
+        """
+        Назначение партий последовательности строк заказа
+        :param lines: строки заказа
+        :return: reference партии для каждой строки, None - нет в наличии
+        """
+        quantities = np.fromiter((line.qty for line in lines), dtype=np.int64, count=len(lines))
+        if (quantities < 0).any():
+            raise ValueError('Количество в строке заказа не может быть отрицательным')
+        matches = np.fromiter((line.sku == self.sku for line in lines), dtype=bool, count=len(lines))
+        # Строки чужого артикула не расходуют остаток, но и партию не получают
+        demand = np.where(matches, quantities, 0)
+
+        assigned = self._assign(demand, matches)
+        return [self._references[index] if index >= 0 else None for index in assigned]
+
+    def _assign(self, demand: np.ndarray, matches: np.ndarray) -> np.ndarray:
+        available = self._available.copy()
+        assigned = np.full(len(demand), -1, dtype=np.int64)
+        head, position, window = 0, 0, 64
+        while position < len(demand):
+            while head < len(available) and available[head] <= 0:
+                head += 1
+            if head == len(available):
+                break
+
+            # Префикс строк, последовательно помещающихся в головную партию
+            # (строки с нулевым количеством после исчерпания партии уходят в следующую)
+            cumulative = np.cumsum(demand[position:position + window])
+            fitted = int(min(np.searchsorted(cumulative, available[head], side='right'),
+                             np.searchsorted(cumulative, available[head], side='left') + 1))
+            if fitted:
+                chunk = slice(position, position + fitted)
+                assigned[chunk] = np.where(matches[chunk], head, -1)
+                available[head] -= cumulative[fitted - 1]
+                position += fitted
+                window = max(64, 2 * fitted)
+                continue
+
+            # Строка не помещается в головную партию - ищем первую подходящую дальше
+            quantity = demand[position]
+            candidates = available[head:] >= quantity
+            if candidates.any():
+                batch = head + int(np.argmax(candidates))
+                assigned[position] = batch
+                available[batch] -= quantity
+            position += 1
+        return assigned
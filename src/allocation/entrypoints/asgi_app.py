@@ -0,0 +1,108 @@
+import json
+import time
+import typing as t
+from datetime import datetime
+
+from allocation import config
+from allocation.adapters import engines, metrics
+from allocation.adapters.cache import ProductCache
+from allocation.adapters.repository import ParallelAccess
+from allocation.adapters.sku_registry import SkuRegistry
+from allocation.domain import model
+from allocation.service_layer import async_services, services, unit_of_work
+
+# Асинхронная точка входа с тем же контрактом /allocate и /add_batch, что у flask_app.
+# Запускается любым ASGI сервером, например: uvicorn allocation.entrypoints.asgi_app:app.
+# Движок создаётся при первом запросе в каждом рабочем процессе.
+product_cache_size = config.get_product_cache_size()
+product_cache = ProductCache(product_cache_size) if product_cache_size else None
+optimistic = config.get_concurrency_mode() == 'optimistic'
+sku_registry_refresh = config.get_sku_registry_refresh()
+# Фильтр артикулов перестраивается фоновым потоком через синхронный движок
+sku_registry = SkuRegistry(engines.get_engine, refresh_interval=sku_registry_refresh) if sku_registry_refresh else None
+
+
+def make_uow() -> unit_of_work.AsyncSqlAlchemyUnitOfWork:
+    if sku_registry is not None:
+        sku_registry.start()
+    return unit_of_work.AsyncSqlAlchemyUnitOfWork(engines.get_async_engine(), product_cache, optimistic=optimistic,
+                                                  sku_registry=sku_registry)
+
+
+async def allocate_endpoint(data: dict) -> tuple[int, t.Any]:
+    try:
+        batchref = await async_services.allocate(data['orderid'], data['sku'], data['qty'], make_uow())
+    except (model.OutOfStock, services.InvalidSku) as e:
+        return 400, {'message': str(e)}
+    except ParallelAccess as e:
+        return 409, {'message': str(e)}
+    return 201, {'batchref': batchref}
+
+
+async def add_batch_endpoint(data: dict) -> tuple[int, t.Any]:
+    eta = data['eta']
+    if eta is not None:
+        eta = datetime.fromisoformat(eta).date()
+    await async_services.add_batch(data['ref'], data['sku'], data['qty'], eta, make_uow())
+    return 201, 'OK'
+
+
+async def metrics_endpoint(data: dict) -> tuple[int, t.Any]:
+    return 200, metrics.registry.render()
+
+
+ROUTES = {
+    ('POST', '/allocate'): allocate_endpoint,
+    ('POST', '/add_batch'): add_batch_endpoint,
+    ('GET', '/metrics'): metrics_endpoint,
+}
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, status: int, payload: t.Any):
+    if isinstance(payload, str):
+        body, content_type = payload.encode(), b'text/plain; charset=utf-8'
+    else:
+        body, content_type = json.dumps(payload).encode(), b'application/json'
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if sku_registry is not None:
+                sku_registry.stop()
+            await engines.get_async_engine().dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'websocket':
+        # Закрытие до accept сервер отдаёт клиенту как 403
+        return await send({'type': 'websocket.close', 'code': 1008})
+    if scope['type'] != 'http':
+        return
+    endpoint = ROUTES.get((scope['method'], scope['path']))
+    if endpoint is None:
+        return await send_response(send, 404, 'not found')
+    started = time.perf_counter()
+    data = json.loads(await read_body(receive) or b'{}')
+    status, payload = await endpoint(data)
+    metrics.REQUEST_DURATION.observe(time.perf_counter() - started, endpoint.__name__, str(status))
+    await send_response(send, status, payload)
@@ -0,0 +1,22 @@
+import argparse
+
+from allocation.adapters import archive, engines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Перенос израсходованных и доставленных партий с их аллокациями в архивные таблицы')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='партий в одной транзакции')
+    parser.add_argument('--max-chunks', type=int, default=None, help='ограничение числа транзакций за прогон')
+    args = parser.parse_args(argv)
+
+    engine = engines.get_engine()
+    try:
+        moved = archive.compact(engine, chunk_size=args.chunk_size, max_chunks=args.max_chunks)
+    finally:
+        engine.dispose()
+    print(f'Перенесено в архив партий: {moved}')
+
+
+if __name__ == '__main__':
+    main()
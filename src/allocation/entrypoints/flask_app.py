@@ -1,41 +1,144 @@
+import time
+import typing as t
+from dataclasses import dataclass
 from datetime import datetime
 
-from flask import Flask, request, jsonify
-from sqlalchemy import create_engine
+from flask import Blueprint, Flask, current_app, g, request, jsonify
 
 from allocation import config
+from allocation.adapters import engines, instrumentation, metrics
+from allocation.adapters.cache import ProductCache
+from allocation.adapters.repository import ParallelAccess
+from allocation.adapters.sku_registry import SkuRegistry
 from allocation.domain import model
-from allocation.adapters import repository
-from allocation.service_layer import services, unit_of_work
-from allocation.adapters import repository
-engine = create_engine(config.get_postgres_uri())
-app = Flask(__name__)
+from allocation.service_layer import services, unit_of_work, views
+from allocation.service_layer.dispatcher import AllocationDispatcher, DispatcherTimeout
 
-repository.activate()
+api = Blueprint('allocation', __name__)
+
+
+@dataclass
+class Dependencies:
+    """
+    Состояние приложения одного процесса. Движки берутся из adapters.engines
+    при первом запросе, а не при создании приложения
+    """
+    product_cache: t.Optional[ProductCache]
+    optimistic: bool
+    partial_load: bool
+    dispatcher: t.Optional[AllocationDispatcher] = None
+    sku_registry: t.Optional[SkuRegistry] = None
+
+    def make_uow(self) -> unit_of_work.SqlAlchemyUnitOfWork:
+        if self.sku_registry is not None:
+            # Фильтр заполняется с первого запроса процесса, а не при создании приложения
+            self.sku_registry.start()
+        return unit_of_work.SqlAlchemyUnitOfWork(engines.get_engine(), self.product_cache,
+                                               optimistic=self.optimistic, partial_load=self.partial_load,
+                                               sku_registry=self.sku_registry)
+
+    def make_read_uow(self) -> unit_of_work.ReadOnlySqlAlchemyUnitOfWork:
+        return unit_of_work.ReadOnlySqlAlchemyUnitOfWork(engines.get_replica_engine())
+
+
+def create_app() -> Flask:
+    """
+    Фабрика приложения: flask run с FLASK_APP=allocation.entrypoints.flask_app
+    находит её сама (ключ --app вместо переменной - только с Flask 2.2),
+    пре-форк серверы вызывают её в каждом рабочем процессе
+    ("allocation.entrypoints.flask_app:create_app()")
+    """
+    app = Flask(__name__)
+    product_cache_size = config.get_product_cache_size()
+    dependencies = Dependencies(
+        product_cache=ProductCache(product_cache_size) if product_cache_size else None,
+        optimistic=config.get_concurrency_mode() == 'optimistic',
+        partial_load=config.get_partial_load(),
+    )
+    sku_registry_refresh = config.get_sku_registry_refresh()
+    if sku_registry_refresh:
+        dependencies.sku_registry = SkuRegistry(engines.get_engine, refresh_interval=sku_registry_refresh)
+    allocation_shards = config.get_allocation_shards()
+    if allocation_shards:
+        dependencies.dispatcher = AllocationDispatcher(
+            dependencies.make_uow, allocation_shards,
+            group_window=config.get_allocation_group_window(),
+            max_group_size=config.get_allocation_group_size(),
+            timeout=config.get_allocation_timeout(),
+        )
+    app.extensions['allocation'] = dependencies
+    app.register_blueprint(api)
+    return app
+
+
+@api.before_app_request
+def start_request_stats():
+    g.request_started = time.perf_counter()
+    g.request_stats, g.request_stats_token = instrumentation.begin()
+
+
+@api.after_app_request
+def observe_request_duration(response):
+    if 'request_started' in g:
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - g.request_started,
+                                         request.endpoint or 'unknown', str(response.status_code))
+    return response
+
+
+@api.after_app_request
+def add_request_stats_headers(response):
+    # Затраты запроса на базу видны в заголовках только в отладочном режиме
+    if current_app.debug and 'request_stats' in g:
+        response.headers.update(g.request_stats.headers())
+    return response
+
+
+@api.teardown_app_request
+def finish_request_stats(error=None):
+    if 'request_stats_token' not in g:
+        return
+    instrumentation.end(g.request_stats_token)
+    instrumentation.observe_request(request.endpoint or 'unknown', g.request_stats)
+
+
+def get_dependencies() -> Dependencies:
+    return current_app.extensions['allocation']
 
 
 def is_valid_sku(sku, batches):
     return sku in {b.sku for b in batches}
 
 
-@app.route("/allocate", methods=["POST"])
-def allocate_endpoint():
-    uow = unit_of_work.SqlAlchemyUnitOfWork(engine)
+@api.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
+
+@api.route("/allocate", methods=["POST"])
+def allocate_endpoint():
+    dependencies = get_dependencies()
     try:
-        batchref = services.allocate(
-            request.json['orderid'], request.json['sku'], request.json['qty'],
-            uow)
+        if dependencies.dispatcher is not None:
+            batchref = dependencies.dispatcher.allocate(
+                request.json['orderid'], request.json['sku'], request.json['qty'])
+        else:
+            batchref = services.allocate(
+                request.json['orderid'], request.json['sku'], request.json['qty'],
+                dependencies.make_uow())
     except (model.OutOfStock, services.InvalidSku) as e:
         return jsonify({'message': str(e)}), 400
+    except ParallelAccess as e:
+        return jsonify({'message': str(e)}), 409
+    except DispatcherTimeout as e:
+        return jsonify({'message': str(e)}), 503
     except Exception as err:
         raise err
     return jsonify({'batchref': batchref}), 201
 
 
-@app.route("/add_batch", methods=['POST'])
+@api.route("/add_batch", methods=['POST'])
 def add_batch_endpoint():
-    uow = unit_of_work.SqlAlchemyUnitOfWork(engine)
+    uow = get_dependencies().make_uow()
     eta = request.json['eta']
     if eta is not None:
         eta = datetime.fromisoformat(eta).date()
@@ -44,3 +147,16 @@ def add_batch_endpoint():
         eta, uow
     )
     return 'OK', 201
+
+
+@api.route("/allocations/<orderid>", methods=['GET'])
+def allocations_view_endpoint(orderid):
+    result = views.allocations(orderid, get_dependencies().make_read_uow())
+    if not result:
+        return 'not found', 404
+    return jsonify(result), 200
+
+
+@api.route("/availability/<sku>", methods=['GET'])
+def availability_view_endpoint(sku):
+    return jsonify(views.availability(sku, get_dependencies().make_read_uow())), 200
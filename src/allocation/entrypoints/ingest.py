@@ -0,0 +1,61 @@
+import argparse
+import csv
+import json
+import sys
+import typing as t
+from datetime import datetime
+
+from allocation.adapters import engines
+from allocation.domain import model
+from allocation.service_layer import services, unit_of_work
+
+
+def parse_eta(value: t.Optional[str]):
+    if not value:
+        return None
+    return datetime.fromisoformat(value).date()
+
+
+def read_csv(lines: t.Iterable[str]) -> t.Iterator[model.Batch]:
+    """
+    Партии из CSV с заголовком ref,sku,qty,eta
+    """
+    for row in csv.DictReader(lines):
+        yield model.Batch(row['ref'], row['sku'], int(row['qty']), parse_eta(row.get('eta')))
+
+
+def read_ndjson(lines: t.Iterable[str]) -> t.Iterator[model.Batch]:
+    """
+    Партии из NDJSON: по объекту {"ref", "sku", "qty", "eta"} на строку
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        yield model.Batch(row['ref'], row['sku'], int(row['qty']), parse_eta(row.get('eta')))
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Массовая загрузка партий из CSV или NDJSON')
+    parser.add_argument('path', help='файл с партиями, - для stdin')
+    parser.add_argument('--format', choices=sorted(READERS), default=None,
+                        help='формат файла, по умолчанию - по расширению')
+    parser.add_argument('--chunk-size', type=int, default=10_000, help='партий в одной транзакции')
+    args = parser.parse_args(argv)
+
+    file_format = args.format or ('ndjson' if args.path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    engine = engines.get_engine()
+    try:
+        with (sys.stdin if args.path == '-' else open(args.path, newline='')) as lines:
+            added = services.ingest_batches(READERS[file_format](lines), unit_of_work.SqlAlchemyUnitOfWork(engine),
+                                            chunk_size=args.chunk_size)
+    finally:
+        engine.dispose()
+    print(f'Добавлено партий: {added}')
+
+
+if __name__ == '__main__':
+    main()
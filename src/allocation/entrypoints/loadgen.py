@@ -0,0 +1,211 @@
+import argparse
+import itertools
+import json
+import math
+import random
+import threading
+import time
+import typing as t
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import requests
+
+from allocation import config
+
+# Нагрузочный клиент API: поток заказов по артикулам с заданным распределением
+# и пополнениями партий, запросы выполняются параллельно из пула потоков.
+#   allocation-loadgen --requests 10000 --concurrency 16 --skus 1000 --distribution zipf
+
+
+@dataclass(frozen=True)
+class Operation:
+    kind: str  # allocate, add_batch
+    path: str
+    payload: dict[str, t.Any]
+
+
+class SkuDistribution:
+    """
+    Выбор артикула: uniform - равновероятно, zipf - k-й по популярности
+    выбирается с весом 1 / k ** exponent
+    """
+
+    def __init__(self, skus: t.Sequence[str], kind: str = 'zipf', exponent: float = 1.1):
+        self.skus = list(skus)
+        if kind == 'uniform':
+            weights = [1.0] * len(self.skus)
+        elif kind == 'zipf':
+            weights = [1 / rank ** exponent for rank in range(1, len(self.skus) + 1)]
+        else:
+            raise ValueError(f'Неизвестное распределение {kind}')
+        self.cum_weights = list(itertools.accumulate(weights))
+
+    def choose(self, rng: random.Random) -> str:
+        return rng.choices(self.skus, cum_weights=self.cum_weights)[0]
+
+
+def restock(sku: str, qty: int) -> Operation:
+    return Operation('add_batch', '/add_batch',
+                     {'ref': f'{sku}-{uuid.uuid4().hex[:12]}', 'sku': sku, 'qty': qty, 'eta': None})
+
+
+def order_stream(distribution: SkuDistribution, rng: random.Random, max_qty: int,
+                 restock_ratio: float, restock_qty: int) -> t.Iterator[Operation]:
+    """
+    Бесконечный поток операций: аллокации случайного количества от 1 до max_qty,
+    с вероятностью restock_ratio вместо аллокации - пополнение того же артикула
+    """
+    prefix = uuid.uuid4().hex[:8]
+    for number in itertools.count():
+        sku = distribution.choose(rng)
+        if rng.random() < restock_ratio:
+            yield restock(sku, restock_qty)
+        else:
+            yield Operation('allocate', '/allocate',
+                            {'orderid': f'load-{prefix}-{number}', 'sku': sku, 'qty': rng.randint(1, max_qty)})
+
+
+def response_message(response: requests.Response) -> str:
+    try:
+        return response.json().get('message', '')
+    except (ValueError, AttributeError):
+        return response.text
+
+
+def classify(status: int, message: str) -> str:
+    """
+    Исход запроса для разбивки ошибок: 409 - ParallelAccess,
+    400 - OutOfStock или InvalidSku по тексту сообщения
+    """
+    if status in (200, 201):
+        return 'ok'
+    if status == 409:
+        return 'ParallelAccess'
+    if status == 400:
+        if 'нет в наличии' in message:
+            return 'OutOfStock'
+        if 'Недопустимый артикул' in message:
+            return 'InvalidSku'
+    return f'HTTP {status}'
+
+
+def percentile(ordered: t.Sequence[float], fraction: float) -> float:
+    # Ближайший ранг по отсортированным значениям
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+@dataclass
+class OperationStats:
+    latencies: list[float] = field(default_factory=list)
+    outcomes: dict[str, int] = field(default_factory=dict)
+
+    def summary(self, elapsed: float) -> dict[str, t.Any]:
+        ordered = sorted(self.latencies)
+        return {
+            'requests': len(ordered),
+            'throughput': len(ordered) / elapsed if elapsed else 0.0,
+            'latency': {name: percentile(ordered, fraction) for name, fraction in
+                        (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+            'outcomes': dict(sorted(self.outcomes.items())),
+        }
+
+
+class Report:
+    def __init__(self):
+        self.operations: dict[str, OperationStats] = {}
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, latency: float, outcome: str):
+        with self._lock:
+            stats = self.operations.setdefault(kind, OperationStats())
+            stats.latencies.append(latency)
+            stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+
+    def summary(self) -> dict[str, t.Any]:
+        return {'elapsed': self.elapsed,
+                'operations': {kind: stats.summary(self.elapsed) for kind, stats in sorted(self.operations.items())}}
+
+
+def run_load(url: str, operations: t.Iterable[Operation], concurrency: int) -> Report:
+    """
+    Выполнение операций пулом из concurrency потоков, у каждого потока своя сессия
+    """
+    report = Report()
+    local = threading.local()
+
+    def send(operation: Operation):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = session.post(url + operation.path, json=operation.payload)
+            outcome = classify(response.status_code, response_message(response))
+        except requests.RequestException as error:
+            outcome = type(error).__name__
+        report.record(operation.kind, time.perf_counter() - started, outcome)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        # Очередь пула ограничена окном, чтобы поток операций не материализовался целиком
+        window = concurrency * 4
+        pending = []
+        for operation in operations:
+            pending.append(executor.submit(send, operation))
+            if len(pending) >= window:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def print_report(summary: dict[str, t.Any]):
+    print(f'Длительность: {summary["elapsed"]:.2f} с')
+    for kind, stats in summary['operations'].items():
+        latency = '  '.join(f'{name}={value * 1000:.1f}ms' for name, value in stats['latency'].items())
+        outcomes = ', '.join(f'{outcome}: {count}' for outcome, count in stats['outcomes'].items())
+        print(f'{kind}: {stats["requests"]} запросов, {stats["throughput"]:.1f} в секунду')
+        print(f'  {latency}')
+        print(f'  {outcomes}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузка на /allocate и /add_batch')
+    parser.add_argument('--url', default=config.get_api_url(), help='адрес API')
+    parser.add_argument('--requests', type=int, default=1000, help='всего запросов, без начального заполнения')
+    parser.add_argument('--concurrency', type=int, default=8, help='одновременных запросов')
+    parser.add_argument('--skus', type=int, default=100, help='число артикулов')
+    parser.add_argument('--distribution', choices=['zipf', 'uniform'], default='zipf',
+                        help='распределение заказов по артикулам')
+    parser.add_argument('--zipf-exponent', type=float, default=1.1, help='показатель распределения Ципфа')
+    parser.add_argument('--max-qty', type=int, default=10, help='максимум товара в строке заказа')
+    parser.add_argument('--initial-qty', type=int, default=1000, help='партия каждого артикула перед нагрузкой')
+    parser.add_argument('--restock-ratio', type=float, default=0.05, help='доля пополнений среди запросов')
+    parser.add_argument('--restock-qty', type=int, default=500, help='размер партии пополнения')
+    parser.add_argument('--seed', type=int, default=None, help='зерно генератора для повторяемого потока')
+    parser.add_argument('--output', help='файл JSON для отчёта')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    prefix = uuid.uuid4().hex[:8]
+    skus = [f'LOAD-{prefix}-{number}' for number in range(args.skus)]
+    # Начальные партии не входят в замер
+    run_load(args.url, (restock(sku, args.initial_qty) for sku in skus), args.concurrency)
+
+    distribution = SkuDistribution(skus, args.distribution, args.zipf_exponent)
+    stream = order_stream(distribution, rng, args.max_qty, args.restock_ratio, args.restock_qty)
+    summary = run_load(args.url, itertools.islice(stream, args.requests), args.concurrency).summary()
+    print_report(summary)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(summary, file, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
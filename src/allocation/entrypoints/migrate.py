@@ -0,0 +1,23 @@
+import argparse
+
+from allocation.adapters import engines, migrations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Применение миграций схемы базы')
+    parser.add_argument('--target', type=int, default=None, help='последняя применяемая версия')
+    args = parser.parse_args(argv)
+
+    engine = engines.get_engine()
+    try:
+        applied = migrations.migrate(engine, target=args.target)
+    finally:
+        engine.dispose()
+    for migration in applied:
+        print(f'{migration.version}: {migration.name}')
+    if not applied:
+        print('Схема актуальна')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import argparse
+import csv
+import dataclasses
+import sys
+
+from allocation.adapters import engines
+from allocation.service_layer import services, unit_of_work
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Отчёты по всему каталогу')
+    parser.add_argument('report', choices=['inventory', 'reconcile'],
+                        help='inventory - остатки партий, reconcile - расхождения размещённого количества')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='строк в порции серверного курсора')
+    args = parser.parse_args(argv)
+
+    report = {'inventory': services.export_inventory, 'reconcile': services.reconcile}[args.report]
+    fields = {'inventory': services.InventoryRow, 'reconcile': services.Discrepancy}[args.report]
+    engine = engines.get_replica_engine()
+    found = 0
+    try:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(field.name for field in dataclasses.fields(fields))
+        for row in report(unit_of_work.ReadOnlySqlAlchemyUnitOfWork(engine), chunk_size=args.chunk_size):
+            writer.writerow(dataclasses.astuple(row))
+            found += 1
+    finally:
+        engine.dispose()
+    # Для сверки ненулевой код - есть расхождения
+    if args.report == 'reconcile' and found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
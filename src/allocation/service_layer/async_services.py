@@ -0,0 +1,74 @@
+import asyncio
+import random
+import typing as t
+from datetime import date
+
+from allocation.adapters import metrics
+from allocation.adapters.repository import ParallelAccess
+from allocation.domain import model
+from allocation.domain.model import OrderLine
+from allocation.service_layer.services import InvalidSku
+from allocation.service_layer.unit_of_work import AbstractAsyncUnitOfWork
+
+T = t.TypeVar('T')
+
+
+async def retrying(uow: AbstractAsyncUnitOfWork, operation: t.Callable[[], t.Awaitable[T]]) -> T:
+    """
+    Асинхронный вариант services.retrying: задержка между повторами не занимает поток
+    """
+    attempt = 0
+    while True:
+        try:
+            return await operation()
+        except ParallelAccess:
+            if attempt >= uow.max_retries:
+                raise
+            await asyncio.sleep(random.uniform(0, uow.retry_backoff * 2 ** attempt))
+            attempt += 1
+
+
+async def add_batch(
+        reference: str, sku: str, qty: int, eta: t.Optional[date],
+        uow: AbstractAsyncUnitOfWork
+):
+    async def add():
+        async with uow:
+            product = await uow.products.get(sku)
+            if product is None:
+                product = model.Product(sku, batches=[])
+                uow.products.add(product)
+            product.add_batch(model.Batch(reference, sku, qty, eta))
+            await uow.commit()
+
+    await retrying(uow, add)
+    if uow.sku_registry is not None:
+        uow.sku_registry.add(sku)
+
+
+async def allocate(orderid: str, sku: str, qty: int,
+                   uow: AbstractAsyncUnitOfWork) -> str:
+    line = OrderLine(orderid, sku, qty)
+
+    async def allocate_line() -> str:
+        async with uow:
+            product = await uow.products.get(sku)
+            if product is None:
+                if uow.sku_registry is not None:
+                    uow.sku_registry.record_missing(sku)
+                raise InvalidSku(f'Недопустимый артикул {line.sku}')
+            batchref = product.allocate(line)
+            await uow.commit()
+        return batchref
+
+    try:
+        # Перепроверка в базе синхронным движком - вне цикла событий
+        if uow.sku_registry is not None and not uow.sku_registry.might_exist(sku) \
+                and not await asyncio.to_thread(uow.sku_registry.exists, sku):
+            raise InvalidSku(f'Недопустимый артикул {line.sku}')
+        batchref = await retrying(uow, allocate_line)
+    except (InvalidSku, model.OutOfStock, ParallelAccess) as error:
+        metrics.record_allocation(sku, error)
+        raise
+    metrics.record_allocation(sku)
+    return batchref
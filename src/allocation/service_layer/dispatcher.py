@@ -0,0 +1,170 @@
+import os
+import queue
+import threading
+import time
+import typing as t
+import weakref
+import zlib
+from concurrent.futures import Future, TimeoutError
+
+from allocation.adapters import instrumentation
+from allocation.domain.model import OrderLine
+from allocation.service_layer import services
+from allocation.service_layer.unit_of_work import AbstractUnitOfWork
+
+# Future результата, строка заказа и учёт затрат запроса, отправившего команду
+Command = tuple[Future, OrderLine, t.Optional[instrumentation.RequestStats]]
+
+_dispatchers: 'weakref.WeakSet[AllocationDispatcher]' = weakref.WeakSet()
+
+
+class DispatcherTimeout(Exception):
+    pass
+
+
+class AllocationDispatcher:
+    """
+    Последовательное выполнение аллокаций по артикулу внутри процесса.
+
+    Артикулы распределены по шардам, у каждого шарда своя очередь и свой
+    поток. Команды одного артикула выполняются строго по очереди и не
+    конкурируют за блокировку строки продукта, разные шарды работают
+    параллельно. Вызывающий ждёт результат на Future.
+
+    Групповой коммит: шард забирает из очереди до max_group_size команд,
+    ожидая новые не дольше group_window секунд, и размещает строки одного
+    артикула на одном загруженном продукте в одной транзакции
+    (services.allocate_many). Каждый вызывающий получает свой результат.
+
+    Потоки шардов запускает первая команда процесса, в дочернем процессе
+    после fork - заново, со своими очередями. Вызывающий ждёт не дольше
+    timeout секунд и получает DispatcherTimeout.
+    """
+
+    def __init__(self, uow_factory: t.Callable[[], AbstractUnitOfWork], shards: int = 8,
+                 group_window: float = 0.0, max_group_size: int = 1, timeout: float = 30.0):
+        self.uow_factory = uow_factory
+        self.shards = shards
+        self.group_window = group_window
+        self.max_group_size = max_group_size
+        self.timeout = timeout
+        self._queues: list[queue.SimpleQueue] = []
+        self._workers: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        # Процесс, в котором запущены потоки шардов
+        self._started_pid: t.Optional[int] = None
+        _dispatchers.add(self)
+
+    def start(self):
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        with self._lock:
+            if self._started_pid == pid:
+                return
+            self._queues = [queue.SimpleQueue() for _ in range(self.shards)]
+            self._workers = [
+                threading.Thread(target=self._work, args=(commands,),
+                                 name=f'allocation-shard-{number}', daemon=True)
+                for number, commands in enumerate(self._queues)
+            ]
+            for worker in self._workers:
+                worker.start()
+            self._started_pid = pid
+
+    def submit(self, orderid: str, sku: str, qty: int) -> 'Future[str]':
+        self.start()
+        future: Future = Future()
+        # Затраты на базу учитываются в запросе, который отправил команду
+        self._queues[self.shard(sku)].put((future, OrderLine(orderid, sku, qty), instrumentation.current()))
+        return future
+
+    def allocate(self, orderid: str, sku: str, qty: int) -> str:
+        future = self.submit(orderid, sku, qty)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # Команда из очереди не выполнится; уже начатая может завершиться
+            future.cancel()
+            raise DispatcherTimeout(f'Аллокация артикула {sku} не выполнена за {self.timeout} с')
+
+    def shard(self, sku: str) -> int:
+        return zlib.crc32(sku.encode()) % self.shards
+
+    def shutdown(self, wait: bool = True):
+        if self._started_pid != os.getpid():
+            return
+        for commands in self._queues:
+            commands.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+        self._started_pid = None
+
+    def _after_fork_in_child(self):
+        # Потоков шардов в дочернем процессе нет, очереди родителя ему не нужны
+        self._queues = []
+        self._workers = []
+        self._lock = threading.Lock()
+        self._started_pid = None
+
+    def _work(self, commands: queue.SimpleQueue):
+        while True:
+            command = commands.get()
+            if command is None:
+                return
+            group = self._collect_group(commands, command)
+            by_sku: dict[str, list[Command]] = {}
+            for future, line, stats in group:
+                if future.set_running_or_notify_cancel():
+                    by_sku.setdefault(line.sku, []).append((future, line, stats))
+            for sku_commands in by_sku.values():
+                # Групповой коммит учитывается в запросе первой команды группы
+                with instrumentation.track_request(sku_commands[0][2]):
+                    self._allocate_group(sku_commands)
+
+    def _collect_group(self, commands: queue.SimpleQueue, first) -> list[Command]:
+        group = [first]
+        deadline = time.monotonic() + self.group_window
+        while len(group) < self.max_group_size:
+            timeout = deadline - time.monotonic()
+            try:
+                command = commands.get(timeout=timeout) if timeout > 0 else commands.get_nowait()
+            except queue.Empty:
+                break
+            if command is None:
+                # Остановка - дорабатываем собранное и выходим на следующей итерации
+                commands.put(None)
+                break
+            group.append(command)
+        return group
+
+    def _allocate_group(self, sku_commands: list[Command]):
+        if len(sku_commands) == 1:
+            [(future, line, _)] = sku_commands
+            try:
+                future.set_result(services.allocate(line.orderid, line.sku, line.qty, self.uow_factory()))
+            except Exception as err:
+                future.set_exception(err)
+            return
+
+        try:
+            results = services.allocate_many([line for _, line, _ in sku_commands], self.uow_factory())
+        except Exception as err:
+            for future, _, _ in sku_commands:
+                future.set_exception(err)
+            return
+        for (future, _, _), result in zip(sku_commands, results):
+            if result.ok:
+                future.set_result(result.batchref)
+            else:
+                future.set_exception(result.error)
+
+
+def _after_fork_in_child():
+    for dispatcher in list(_dispatchers):
+        dispatcher._after_fork_in_child()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,7 +1,12 @@
+import itertools
+import random
+import time
 import typing as t
+from dataclasses import dataclass
 from datetime import date
 
-from allocation.adapters.repository import AbstractRepository
+from allocation.adapters import metrics
+from allocation.adapters.repository import AbstractRepository, ParallelAccess
 from allocation.domain import model
 from allocation.domain.model import OrderLine
 from allocation.service_layer.unit_of_work import AbstractUnitOfWork
@@ -11,30 +16,200 @@ class InvalidSku(Exception):
     pass
 
 
+@dataclass(frozen=True)
+class AllocationResult:
+    line: OrderLine
+    batchref: t.Optional[str] = None
+    error: t.Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass(frozen=True)
+class InventoryRow:
+    sku: str
+    reference: str
+    eta: t.Optional[date]
+    purchased_quantity: int
+    allocated_quantity: int
+    available_quantity: int
+
+
+@dataclass(frozen=True)
+class Discrepancy:
+    reference: str
+    sku: str
+    purchased_quantity: int
+    stored_quantity: int
+    lines_quantity: int
+
+
 def is_valid_sku(sku, batches):
     return sku in {b.sku for b in batches}
 
 
+T = t.TypeVar('T')
+
+
+def retrying(uow: AbstractUnitOfWork, operation: t.Callable[[], T]) -> T:
+    """
+    Выполнение операции с повтором при ParallelAccess: до uow.max_retries раз,
+    со случайной экспоненциально растущей задержкой
+    """
+    attempt = 0
+    while True:
+        try:
+            return operation()
+        except ParallelAccess:
+            if attempt >= uow.max_retries:
+                raise
+            time.sleep(random.uniform(0, uow.retry_backoff * 2 ** attempt))
+            attempt += 1
+
+
 def add_batch(
         reference: str, sku: str, qty: int, eta: t.Optional[date],
         uow: AbstractUnitOfWork
 ):
-    with uow:
-        product = uow.products.get(sku)
-        if product is None:
-            product = model.Product(sku, batches=[])
-            uow.products.add(product)
-        product.add_batch(model.Batch(reference, sku, qty, eta))
-        uow.commit()
+    def add():
+        with uow:
+            product = uow.products.get(sku)
+            if product is None:
+                product = model.Product(sku, batches=[])
+                uow.products.add(product)
+            product.add_batch(model.Batch(reference, sku, qty, eta))
+            uow.commit()
+
+    retrying(uow, add)
+    if uow.sku_registry is not None:
+        uow.sku_registry.add(sku)
+
+
+def ingest_batches(new_batches: t.Iterable[model.Batch], uow: AbstractUnitOfWork,
+                   chunk_size: int = 10_000) -> int:
+    """
+    Потоковая загрузка партий порциями, каждая порция - в своей транзакции.
+    В памяти держится не больше одной порции
+    :param new_batches: партии, например генератор строк файла
+    :param uow: unit of work
+    :param chunk_size: партий в одной транзакции
+    :return: число добавленных партий
+    """
+    new_batches = iter(new_batches)
+    added = 0
+    while True:
+        chunk = list(itertools.islice(new_batches, chunk_size))
+        if not chunk:
+            return added
+
+        def add_chunk() -> int:
+            with uow:
+                chunk_added = uow.products.add_batches(chunk)
+                uow.commit()
+            return chunk_added
+
+        added += retrying(uow, add_chunk)
+        if uow.sku_registry is not None:
+            for batch in chunk:
+                uow.sku_registry.add(batch.sku)
 
 
 def allocate(orderid: str, sku: str, qty: int,
              uow: AbstractUnitOfWork) -> str:
     line = OrderLine(orderid, sku, qty)
-    with uow:
-        product = uow.products.get(sku)
-        if product is None:
+
+    def allocate_line() -> str:
+        with uow:
+            product = uow.products.get(sku)
+            if product is None:
+                if uow.sku_registry is not None:
+                    uow.sku_registry.record_missing(sku)
+                raise InvalidSku(f'Недопустимый артикул {line.sku}')
+            batchref = product.allocate(line)
+            uow.commit()
+        return batchref
+
+    try:
+        if uow.sku_registry is not None and not uow.sku_registry.exists(sku):
             raise InvalidSku(f'Недопустимый артикул {line.sku}')
-        batchref = product.allocate(line)
-        uow.commit()
+        batchref = retrying(uow, allocate_line)
+    except (InvalidSku, model.OutOfStock, ParallelAccess) as error:
+        metrics.record_allocation(sku, error)
+        raise
+    metrics.record_allocation(sku)
     return batchref
+
+
+def allocate_many(lines: t.Iterable[OrderLine],
+                  uow: AbstractUnitOfWork) -> list[AllocationResult]:
+    """
+    Аллокация пачки строк заказа: каждый продукт загружается один раз,
+    строки одного артикула размещаются по порядку в одной транзакции
+    :param lines: строки заказа
+    :param uow: unit of work
+    :return: результаты в порядке исходных строк
+    """
+    lines = list(lines)
+    positions_by_sku: dict[str, list[int]] = {}
+    for position, line in enumerate(lines):
+        positions_by_sku.setdefault(line.sku, []).append(position)
+
+    def allocate_group(sku: str, positions: list[int]) -> list[t.Union[str, Exception]]:
+        if uow.sku_registry is not None and not uow.sku_registry.exists(sku):
+            return [InvalidSku(f'Недопустимый артикул {sku}')] * len(positions)
+        with uow:
+            product = uow.products.get(sku)
+            if product is None:
+                if uow.sku_registry is not None:
+                    uow.sku_registry.record_missing(sku)
+                return [InvalidSku(f'Недопустимый артикул {sku}')] * len(positions)
+            outcomes = product.allocate_many(lines[position] for position in positions)
+            uow.commit()
+        return outcomes
+
+    results: list[t.Optional[AllocationResult]] = [None] * len(lines)
+    for sku, positions in positions_by_sku.items():
+        try:
+            outcomes = retrying(uow, lambda: allocate_group(sku, positions))
+        except ParallelAccess as error:
+            metrics.record_allocation(sku, error, lines=len(positions))
+            raise
+        for position, outcome in zip(positions, outcomes):
+            metrics.record_allocation(sku, outcome if isinstance(outcome, Exception) else None)
+            if isinstance(outcome, Exception):
+                results[position] = AllocationResult(lines[position], error=outcome)
+            else:
+                results[position] = AllocationResult(lines[position], batchref=outcome)
+    return results
+
+
+def export_inventory(uow: AbstractUnitOfWork, chunk_size: int = 1000) -> t.Iterator[InventoryRow]:
+    """
+    Остатки всех партий каталога. Продукты читаются потоком в одной транзакции,
+    которая открыта, пока генератор не исчерпан или не закрыт
+    :param uow: unit of work
+    :param chunk_size: строк в порции серверного курсора
+    :return: строки остатков в порядке артикула
+    """
+    with uow:
+        for product in uow.products.iter_products(chunk_size):
+            for batch in sorted(product._batches, key=model._batch_priority):
+                yield InventoryRow(product.sku, batch.reference, batch.eta, batch._purchased_quantity,
+                                   batch.allocated_quantity, batch.available_quantity)
+
+
+def reconcile(uow: AbstractUnitOfWork, chunk_size: int = 1000) -> t.Iterator[Discrepancy]:
+    """
+    Сверка batches.allocated_quantity с аллокациями: партии, где сохранённое
+    количество расходится со строками заказа или строк больше, чем закуплено
+    :param uow: unit of work
+    :param chunk_size: строк в порции серверного курсора
+    :return: расхождения
+    """
+    with uow:
+        for row in uow.products.iter_batch_quantities(chunk_size):
+            if row.allocated_quantity != row.lines_quantity or row.lines_quantity > row.purchased_quantity:
+                yield Discrepancy(row.reference, row.sku, row.purchased_quantity,
+                                  row.allocated_quantity, row.lines_quantity)
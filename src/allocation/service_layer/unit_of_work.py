@@ -1,17 +1,23 @@
 import abc
+import time
+import typing as t
 
-from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
 from sqlalchemy.orm import sessionmaker
 
-from allocation import config
-from allocation.adapters import repository
-
-DEFAULT_ENGINE = create_engine(config.get_postgres_uri())
+from allocation.adapters import engines, instrumentation, repository
+from allocation.adapters.cache import ProductCache
+from allocation.adapters.sku_registry import SkuRegistry
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractProductRepository
+    # Повторы сервисных операций при ParallelAccess и базовая задержка между ними, сек
+    max_retries: int = 0
+    retry_backoff: float = 0.05
+    # Артикулы процесса: недопустимый артикул отклоняется без транзакции
+    sku_registry: t.Optional[SkuRegistry] = None
 
     def __exit__(self, *args):
         self.rollback()
@@ -27,22 +33,119 @@ class AbstractUnitOfWork(abc.ABC):
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
 
-    def __init__(self, engine: Engine = DEFAULT_ENGINE):
-        self.engine = engine
+    def __init__(self, engine: t.Optional[Engine] = None, product_cache: t.Optional[ProductCache] = None,
+                 optimistic: bool = False, max_retries: t.Optional[int] = None,
+                 partial_load: bool = False, sku_registry: t.Optional[SkuRegistry] = None):
+        self.engine = engine or engines.get_engine()
+        self.product_cache = product_cache
+        self.sku_registry = sku_registry
+        self.optimistic = optimistic
+        self.partial_load = partial_load
+        if max_retries is None:
+            max_retries = 3 if optimistic else 0
+        self.max_retries = max_retries
 
     def __enter__(self):
+        self.started = time.perf_counter()
         self.connection: Connection = self.engine.begin().__enter__()
         self.transaction = self.connection.get_transaction()
-        self.products = repository.SqlAlchemyRepository(self.connection)
+        self.products = repository.SqlAlchemyRepository(
+            self.connection, cache=self.product_cache, optimistic=self.optimistic,
+            partial=self.partial_load)
         return self
 
-    def __exit__(self, *args):
-        super().__exit__(*args)
+    def __exit__(self, exc_type, *args):
+        super().__exit__(exc_type, *args)
         self.connection.close()
+        instrumentation.record_transaction(time.perf_counter() - self.started,
+                                           lock_failed=exc_type is repository.ParallelAccess)
 
     def commit(self):
+        self.products.flush()
         self.transaction.commit()
+        self.products.cache_products()
 
     def rollback(self):
         if self.transaction.is_active:
             self.transaction.rollback()
+            self.products.cache_products()
+
+
+class ReadOnlySqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    Единица работы для чтения: транзакция READ ONLY, REPEATABLE READ - все
+    запросы видят один снимок базы, продукты загружаются без блокировок и не
+    конкурируют с аллокациями. По умолчанию работает с репликой, если она задана.
+    Сохранение изменений отклоняет сама база
+    """
+
+    def __init__(self, engine: t.Optional[Engine] = None):
+        super().__init__(engine or engines.get_replica_engine())
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.connection: Connection = self.engine.connect().execution_options(
+            isolation_level='REPEATABLE READ', postgresql_readonly=True)
+        self.transaction = self.connection.begin()
+        self.products = repository.SqlAlchemyRepository(self.connection, read_only=True)
+        return self
+
+
+class AbstractAsyncUnitOfWork(abc.ABC):
+    products: repository.AsyncSqlAlchemyRepository
+    max_retries: int = 0
+    retry_backoff: float = 0.05
+    sku_registry: t.Optional[SkuRegistry] = None
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    @abc.abstractmethod
+    async def commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):
+    """
+    Единица работы на движке sqlalchemy.ext.asyncio: пока транзакция ждёт базу,
+    цикл событий обслуживает другие запросы
+    """
+
+    def __init__(self, engine: t.Optional[AsyncEngine] = None, product_cache: t.Optional[ProductCache] = None,
+                 optimistic: bool = False, max_retries: t.Optional[int] = None,
+                 sku_registry: t.Optional[SkuRegistry] = None):
+        self.engine = engine or engines.get_async_engine()
+        self.product_cache = product_cache
+        self.sku_registry = sku_registry
+        self.optimistic = optimistic
+        if max_retries is None:
+            max_retries = 3 if optimistic else 0
+        self.max_retries = max_retries
+
+    async def __aenter__(self):
+        self.started = time.perf_counter()
+        self.connection: AsyncConnection = await self.engine.connect()
+        self.transaction = await self.connection.begin()
+        self.products = repository.AsyncSqlAlchemyRepository(
+            self.connection, cache=self.product_cache, optimistic=self.optimistic)
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        await super().__aexit__(exc_type, *args)
+        await self.connection.close()
+        instrumentation.record_transaction(time.perf_counter() - self.started,
+                                           lock_failed=exc_type is repository.ParallelAccess)
+
+    async def commit(self):
+        await self.products.flush()
+        await self.transaction.commit()
+        self.products.cache_products()
+
+    async def rollback(self):
+        if self.transaction.is_active:
+            await self.transaction.rollback()
+            self.products.cache_products()
@@ -0,0 +1,46 @@
+import typing as t
+
+import sqlalchemy as sa
+
+from allocation.adapters.db_tables import allocations_view, availability_view
+from allocation.service_layer.unit_of_work import SqlAlchemyUnitOfWork
+
+
+def allocations(orderid: str, uow: SqlAlchemyUnitOfWork) -> list[dict]:
+    """
+    Аллокации заказа из модели чтения
+    :param orderid: id заказа
+    :param uow: unit of work, обычно ReadOnlySqlAlchemyUnitOfWork
+    :return: [{'sku', 'batchref'}]
+    """
+    with uow:
+        rows = uow.connection.execute(
+            sa.select(allocations_view.c.sku, allocations_view.c.batchref).where(
+                allocations_view.c.orderid == orderid
+            )
+        ).all()
+    return [{'sku': row.sku, 'batchref': row.batchref} for row in rows]
+
+
+def availability(sku: str, uow: SqlAlchemyUnitOfWork) -> dict[str, t.Any]:
+    """
+    Остатки артикула по партиям из модели чтения, в порядке аллокации
+    :param sku: артикул
+    :param uow: unit of work, обычно ReadOnlySqlAlchemyUnitOfWork
+    :return: {'sku', 'available', 'batches': [{'batchref', 'eta', 'available'}]}
+    """
+    with uow:
+        rows = uow.connection.execute(
+            sa.select(availability_view.c.reference, availability_view.c.eta,
+                      availability_view.c.available_quantity).where(
+                availability_view.c.sku == sku,
+                availability_view.c.available_quantity > 0
+            ).order_by(availability_view.c.eta.asc().nulls_first(), availability_view.c.reference)
+        ).all()
+    return {
+        'sku': sku,
+        'available': sum(row.available_quantity for row in rows),
+        'batches': [{'batchref': row.reference,
+                     'eta': row.eta.date().isoformat() if row.eta is not None else None,
+                     'available': row.available_quantity} for row in rows],
+    }
@@ -2,20 +2,19 @@ import pytest
 import sqlalchemy as sa
 
 from allocation import config
+from allocation.adapters import instrumentation
 from allocation.adapters.db_tables import metadata
-from allocation.adapters import repository
 
 
 @pytest.fixture(name='engine')
 def engine_factory():
-    repository.activate()
     engine = sa.create_engine(config.get_postgres_uri())
+    instrumentation.install(engine)
     metadata.drop_all(engine)
     metadata.create_all(engine)
     yield engine
     metadata.drop_all(engine)
     engine.dispose()
-    repository.clear()
 
 
 @pytest.fixture
@@ -27,3 +26,16 @@ def session_factory(engine):
         def __call__(self):
             return self.engine.begin().__enter__()
     yield Session(engine)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
@@ -1,9 +1,11 @@
+import json
 import uuid
 
 import pytest
 import requests
 
 from allocation import config
+from allocation.entrypoints import loadgen
 
 
 def random_suffix():
@@ -59,3 +61,60 @@ def test_unhappy_path_returns_400_and_error_message():
     r = requests.post(f'{url}/allocate', json=data)
     assert r.status_code == 400
     assert r.json()['message'] == f'Недопустимый артикул {unknown_sku}'
+
+
+@pytest.mark.usefixtures('session_factory')
+@pytest.mark.usefixtures('restart_api')
+def test_allocation_and_availability_views():
+    sku, orderid = random_sku(), random_orderid()
+    earlybatch, laterbatch = random_batchref(1), random_batchref(2)
+    post_to_add_batch(laterbatch, sku, 100, '2021-01-02')
+    post_to_add_batch(earlybatch, sku, 10, None)
+    url = config.get_api_url()
+
+    r = requests.post(f'{url}/allocate', json={'orderid': orderid, 'sku': sku, 'qty': 10})
+    assert r.status_code == 201
+
+    r = requests.get(f'{url}/allocations/{orderid}')
+    assert r.status_code == 200
+    assert r.json() == [{'sku': sku, 'batchref': earlybatch}]
+    r = requests.get(f'{url}/availability/{sku}')
+    assert r.json() == {'sku': sku, 'available': 100,
+                        'batches': [{'batchref': laterbatch, 'eta': '2021-01-02', 'available': 100}]}
+
+    assert requests.get(f'{url}/allocations/{random_orderid()}').status_code == 404
+
+
+@pytest.mark.usefixtures('session_factory')
+@pytest.mark.usefixtures('restart_api')
+def test_metrics_endpoint_reports_allocations_and_latency():
+    sku = random_sku()
+    post_to_add_batch(random_batchref(), sku, 10, None)
+    url = config.get_api_url()
+    requests.post(f'{url}/allocate', json={'orderid': random_orderid(), 'sku': sku, 'qty': 5})
+    requests.post(f'{url}/allocate', json={'orderid': random_orderid(), 'sku': sku, 'qty': 50})
+
+    r = requests.get(f'{url}/metrics')
+
+    assert r.status_code == 200
+    assert r.headers['Content-Type'].startswith('text/plain')
+    assert '# TYPE allocation_request_duration_seconds histogram' in r.text
+    assert 'allocation_request_duration_seconds_count{endpoint="allocation.allocate_endpoint",status="201"}' in r.text
+    assert 'allocation_allocation_errors_total{error="OutOfStock",sku_bucket=' in r.text
+    assert 'allocation_pool_checkout_wait_seconds_count{engine="primary"}' in r.text
+    assert 'allocation_request_db_statements_count{endpoint="allocation.allocate_endpoint"}' in r.text
+
+
+@pytest.mark.usefixtures('session_factory')
+@pytest.mark.usefixtures('restart_api')
+def test_load_generator_reports_outcomes(tmp_path):
+    output = tmp_path / 'load.json'
+    loadgen.main(['--requests', '60', '--concurrency', '4', '--skus', '5', '--initial-qty', '20',
+                  '--seed', '1', '--output', str(output)])
+
+    summary = json.loads(output.read_text())
+    allocations = summary['operations']['allocate']
+    assert allocations['requests'] + summary['operations'].get('add_batch', {}).get('requests', 0) == 60
+    assert allocations['outcomes'].get('ok', 0) > 0
+    assert set(allocations['outcomes']) <= {'ok', 'OutOfStock', 'ParallelAccess'}
+    assert allocations['latency']['p50'] <= allocations['latency']['p99']
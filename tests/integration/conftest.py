@@ -0,0 +1,11 @@
+import pytest
+import sqlalchemy as sa
+
+
+@pytest.fixture
+def get_product_version(engine):
+    def get_product_version(sku):
+        with engine.connect() as connection:
+            return connection.execute(
+                sa.text("SELECT version_number FROM products WHERE sku = :sku"), sku=sku).scalar_one()
+    return get_product_version
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sa
+
+from allocation.adapters import archive
+from allocation.service_layer import services, unit_of_work
+from random_refs import random_sku, random_batchref, random_orderid
+
+
+def count_rows(engine, table):
+    with engine.connect() as connection:
+        return connection.execute(sa.text(f"SELECT count(*) FROM {table}")).scalar_one()
+
+
+def test_compact_moves_consumed_and_delivered_batches_to_archive(engine, get_product_version):
+    sku = random_sku()
+    consumed, in_transit, in_stock = random_batchref(1), random_batchref(2), random_batchref(3)
+    orders = [random_orderid(number) for number in range(4)]
+    tomorrow = (datetime.now(timezone.utc) + timedelta(days=1)).date()
+    services.add_batch(consumed, sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.add_batch(in_transit, sku, 5, tomorrow, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    for orderid, qty in zip(orders, [6, 4, 5]):
+        services.allocate(orderid, sku, qty, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.add_batch(in_stock, sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate(orders[3], sku, 20, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    version = get_product_version(sku)
+
+    assert archive.compact(engine) == 1
+
+    assert count_rows(engine, 'batches') == 2
+    assert count_rows(engine, 'allocations') == 2
+    assert count_rows(engine, 'order_lines') == 2
+    assert count_rows(engine, 'batches_archive') == 1
+    assert count_rows(engine, 'allocations_archive') == 2
+    assert get_product_version(sku) == version + 1
+    with engine.connect() as connection:
+        history = archive.select_allocation_history(connection, sku)
+    assert sorted((row.orderid, row.reference, row.archived) for row in history) == [
+        (orders[0], consumed, True),
+        (orders[1], consumed, True),
+        (orders[2], in_transit, False),
+        (orders[3], in_stock, False),
+    ]
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        product = uow.products.get(sku)
+        assert {batch.reference for batch in product._batches} == {in_transit, in_stock}
+
+
+def test_compact_works_in_chunks_and_skips_locked_products(engine):
+    skus = [random_sku(str(number)) for number in range(3)]
+    for sku in skus:
+        for number in range(2):
+            services.add_batch(f'{sku}-{number}', sku, 1, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+            services.allocate(f'{sku}-order{number}', sku, 1, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        uow.products.get(skus[0])
+        assert archive.compact(engine, chunk_size=1, max_chunks=2) == 2
+        assert archive.compact(engine, chunk_size=3) == 2
+        assert count_rows(engine, 'batches_archive') == 4
+    assert archive.compact(engine, chunk_size=3) == 2
+    assert count_rows(engine, 'batches') == 0
@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from allocation import config
+from allocation.adapters import repository
+from allocation.service_layer import async_services, services, unit_of_work
+from random_refs import random_sku, random_batchref, random_orderid
+
+pytest.importorskip('asyncpg')
+
+
+def run_with_engine(coroutine_factory):
+    async def run():
+        async_engine = create_async_engine(config.get_async_postgres_uri(), pool_size=5, max_overflow=0)
+        try:
+            return await coroutine_factory(async_engine)
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(run())
+
+
+def test_async_uow_allocates_many_orders_concurrently_on_a_small_pool(engine):
+    skus = [random_sku(str(number)) for number in range(10)]
+
+    async def scenario(async_engine):
+        for sku in skus:
+            await async_services.add_batch(random_batchref(), sku, 100, None,
+                                           unit_of_work.AsyncSqlAlchemyUnitOfWork(async_engine))
+        orders = [(random_orderid(number), skus[number % len(skus)]) for number in range(50)]
+        return await asyncio.gather(*[
+            async_services.allocate(orderid, sku, 1, unit_of_work.AsyncSqlAlchemyUnitOfWork(
+                async_engine, optimistic=True, max_retries=50))
+            for orderid, sku in orders
+        ])
+
+    batchrefs = run_with_engine(scenario)
+
+    assert len(batchrefs) == 50
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT sum(allocated_quantity) FROM batches").scalar_one() == 50
+
+
+def test_async_repository_reports_locked_products_as_parallel_access(engine):
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    async def scenario(async_engine):
+        async with unit_of_work.AsyncSqlAlchemyUnitOfWork(async_engine) as first:
+            await first.products.get(sku)
+            with pytest.raises(repository.ParallelAccess):
+                await async_services.allocate(random_orderid(), sku, 1,
+                                              unit_of_work.AsyncSqlAlchemyUnitOfWork(async_engine))
+
+    run_with_engine(scenario)
+
+
+def call_asgi(method, path, payload):
+    from allocation.adapters import engines
+    from allocation.entrypoints import asgi_app
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': json.dumps(payload).encode(), 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        await asgi_app.app({'type': 'http', 'method': method, 'path': path}, receive, send)
+        # Соединения пула привязаны к циклу событий, который закроет asyncio.run
+        await engines.get_async_engine().dispose()
+
+    asyncio.run(run())
+    start, body = messages
+    return start['status'], body['body']
+
+
+def test_asgi_app_keeps_the_flask_contract(engine):
+    sku = random_sku()
+
+    status, _ = call_asgi('POST', '/add_batch', {'ref': 'batch1', 'sku': sku, 'qty': 10, 'eta': None})
+    assert status == 201
+    status, body = call_asgi('POST', '/allocate', {'orderid': random_orderid(), 'sku': sku, 'qty': 3})
+    assert (status, json.loads(body)) == (201, {'batchref': 'batch1'})
+    status, body = call_asgi('POST', '/allocate', {'orderid': random_orderid(), 'sku': sku, 'qty': 30})
+    assert (status, json.loads(body)) == (400, {'message': f'Артикула {sku} нет в наличии'})
+
+
+def test_asgi_app_rejects_unsupported_scopes():
+    from allocation.entrypoints import asgi_app
+    sent = []
+
+    async def receive():
+        return {'type': 'websocket.connect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app.app({'type': 'websocket', 'path': '/allocate'}, receive, send))
+    asyncio.run(asgi_app.app({'type': 'unknown'}, receive, send))
+
+    assert sent == [{'type': 'websocket.close', 'code': 1008}]
+
+
+def test_async_repository_streams_products(engine):
+    skus = sorted(random_sku(str(number)) for number in range(3))
+    for sku in skus:
+        services.add_batch(random_batchref(), sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    async def scenario(async_engine):
+        async with unit_of_work.AsyncSqlAlchemyUnitOfWork(async_engine) as uow:
+            return [product.sku async for product in uow.products.iter_products(chunk_size=2)]
+
+    assert run_with_engine(scenario) == skus
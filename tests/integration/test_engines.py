@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+
+from allocation.adapters import engines, instrumentation, metrics
+from allocation.service_layer import unit_of_work  # noqa
+from allocation.entrypoints import flask_app
+
+
+def backend_pid(engine):
+    with engine.connect() as connection:
+        return connection.exec_driver_sql("SELECT pg_backend_pid()").scalar_one()
+
+
+def report_backend_pid(queue):
+    engine = engines.get_engine()
+    queue.put((id(engine), backend_pid(engine), engine.pool.checkedin()))
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='нет os.register_at_fork')
+def test_forked_child_opens_its_own_connections(engine):
+    parent_engine = engines.get_engine()
+    assert engines.get_engine() is parent_engine
+    parent_pid = backend_pid(parent_engine)
+    assert parent_engine.pool.checkedin() == 1
+
+    queue = multiprocessing.get_context('fork').Queue()
+    child = multiprocessing.get_context('fork').Process(target=report_backend_pid, args=(queue,))
+    child.start()
+    engine_id, child_pid, child_checkedin = queue.get(timeout=10)
+    child.join()
+
+    assert engine_id == id(parent_engine)
+    assert child_pid != parent_pid
+    assert child_checkedin == 1
+    # Соединение родителя пережило fork и по-прежнему рабочее
+    assert backend_pid(parent_engine) == parent_pid
+
+
+def test_app_factory_does_not_connect_before_the_first_request(monkeypatch):
+    monkeypatch.setenv('SKU_REGISTRY_REFRESH', '10')
+    connected = []
+    monkeypatch.setattr(engines, 'get_engine', lambda: connected.append('primary'))
+    app = flask_app.create_app()
+    assert 'allocation' in app.blueprints
+    assert app.extensions['allocation'].dispatcher is None
+    # Фильтр артикулов заполняется с первого запроса, а не при сборке приложения
+    assert app.extensions['allocation'].sku_registry._thread is None
+    assert connected == []
+
+
+def checkout_count(engine_name):
+    cell = metrics.POOL_CHECKOUT_WAIT.values().get((engine_name,))
+    return sum(cell[:-1]) if cell else 0
+
+
+def test_pool_checkout_wait_is_recorded_per_engine_and_survives_dispose(engine):
+    checkouts = checkout_count('primary')
+    backend_pid(engines.get_engine())
+    assert checkout_count('primary') == checkouts + 1
+
+    engines.get_engine().dispose()
+    backend_pid(engines.get_engine())
+    assert checkout_count('primary') == checkouts + 2
+
+
+def test_only_engines_of_the_process_are_instrumented():
+    assert not sa.event.contains(Engine, 'after_cursor_execute', instrumentation.after_cursor_execute)
+    assert sa.event.contains(engines.get_engine(), 'after_cursor_execute', instrumentation.after_cursor_execute)
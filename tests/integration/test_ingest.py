@@ -0,0 +1,57 @@
+import io
+
+import sqlalchemy as sa
+
+from allocation.entrypoints.ingest import read_csv, read_ndjson
+from allocation.service_layer import services, unit_of_work
+from random_refs import random_sku
+
+
+def get_batches(engine):
+    with engine.connect() as connection:
+        return connection.execute(sa.text(
+            "SELECT reference, sku, purchased_quantity, eta::date FROM batches ORDER BY reference")).all()
+
+
+def get_versions(engine):
+    with engine.connect() as connection:
+        return dict(connection.execute(sa.text("SELECT sku, version_number FROM products")).all())
+
+
+def test_ingest_copies_batches_and_creates_products(engine):
+    existing, new = random_sku('existing'), random_sku('new')
+    services.add_batch('b0', existing, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    versions = get_versions(engine)
+    file = io.StringIO(
+        "ref,sku,qty,eta\n"
+        f"b0,{existing},99,\n"
+        f"b1,{existing},20,2026-01-02\n"
+        f'"b,2",{new},30,\n'
+        f"b3,{new},40,\n"
+    )
+
+    added = services.ingest_batches(read_csv(file), unit_of_work.SqlAlchemyUnitOfWork(engine), chunk_size=3)
+
+    assert added == 3
+    rows = get_batches(engine)
+    assert [(row.reference, row.sku, row.purchased_quantity) for row in rows] == [
+        ('b,2', new, 30), ('b0', existing, 10), ('b1', existing, 20), ('b3', new, 40)
+    ]
+    assert str(rows[2].eta) == '2026-01-02'
+    assert get_versions(engine)[existing] == versions[existing] + 1
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        assert {batch.reference for batch in uow.products.get(new)._batches} == {'b,2', 'b3'}
+
+
+def test_ingest_streams_a_large_ndjson_file(engine):
+    sku = random_sku()
+    lines = (f'{{"ref": "batch-{number}", "sku": "{sku}", "qty": {number}, "eta": null}}\n'
+             for number in range(20_000))
+
+    added = services.ingest_batches(read_ndjson(lines), unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    assert added == 20_000
+    with engine.connect() as connection:
+        assert connection.execute(sa.text(
+            "SELECT count(*), sum(purchased_quantity) FROM batches")).one() == (20_000, sum(range(20_000)))
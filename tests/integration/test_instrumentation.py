@@ -0,0 +1,81 @@
+import pytest
+
+from allocation.adapters import instrumentation, metrics, repository
+from allocation.adapters.cache import ProductCache
+from allocation.domain import model
+from allocation.entrypoints import flask_app
+from allocation.service_layer import services, unit_of_work
+from random_refs import random_sku, random_batchref, random_orderid
+
+
+def test_query_budget_of_service_calls(engine):
+    sku = random_sku()
+    cache = ProductCache(1000)
+
+    with instrumentation.track_request() as stats:
+        services.add_batch(random_batchref(), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    # Загрузка продукта, вставка продукта, вставка партии
+    assert stats.statements == 3
+    assert stats.transactions == 1
+
+    with instrumentation.track_request() as stats:
+        services.allocate(random_orderid(), sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    # Загрузка продукта, версия, аллокация
+    assert stats.statements == 3
+    # Строка партии и строка, возвращённая RETURNING
+    assert stats.rows == 2
+    assert set(stats.methods) >= {'get', 'select_product', 'flush', 'update_version', 'insert_allocations'}
+    assert stats.method_calls['get'] == 1
+
+    with instrumentation.track_request() as stats:
+        services.allocate_many([model.OrderLine(random_orderid(number), sku, 1) for number in range(5)],
+                               unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    # Продукт из кэша: проверка версии вместо загрузки
+    assert stats.statements == 3
+    assert 'select_product' not in stats.methods
+    assert stats.db_time <= stats.transaction_time
+
+
+def test_lock_failures_are_counted(engine):
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as holder:
+        holder.products.get(sku)
+        with instrumentation.track_request() as stats:
+            with pytest.raises(repository.ParallelAccess):
+                services.allocate(random_orderid(), sku, 1, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    assert stats.lock_failures == 1
+    assert stats.statements == 1
+
+
+def test_debug_app_reports_request_stats_in_headers_and_metrics(engine):
+    metrics.registry.reset()
+    app = flask_app.create_app()
+    app.debug = True
+    client = app.test_client()
+    sku = random_sku()
+
+    client.post('/add_batch', json={'ref': random_batchref(), 'sku': sku, 'qty': 10, 'eta': None})
+    response = client.post('/allocate', json={'orderid': random_orderid(), 'sku': sku, 'qty': 1})
+
+    assert response.status_code == 201
+    assert response.headers['X-DB-Statements'] == '3'
+    assert 'select_product;calls=1' in response.headers['X-DB-Repository-Time']
+    rendered = client.get('/metrics').get_data(as_text=True)
+    assert 'allocation_request_db_statements_bucket{endpoint="allocation.allocate_endpoint",le="2"} 0' in rendered
+    assert 'allocation_request_db_statements_bucket{endpoint="allocation.allocate_endpoint",le="3"} 1' in rendered
+    assert 'allocation_request_db_seconds_count{endpoint="allocation.add_batch_endpoint"} 1' in rendered
+    assert ('allocation_repository_method_seconds_count'
+            '{endpoint="allocation.allocate_endpoint",method="select_product"} 1') in rendered
+
+
+def test_rows_of_server_side_cursors_are_counted_as_fetched(engine):
+    batches = [model.Batch(random_batchref(number), random_sku(), 10, None) for number in range(5)]
+    services.ingest_batches(batches, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with instrumentation.track_request() as stats:
+        assert list(services.reconcile(unit_of_work.ReadOnlySqlAlchemyUnitOfWork(engine), chunk_size=2)) == []
+
+    assert stats.rows == 5
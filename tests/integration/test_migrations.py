@@ -0,0 +1,83 @@
+import pytest
+import sqlalchemy as sa
+
+from allocation.adapters import migrations
+from allocation.adapters.db_tables import metadata
+from allocation.service_layer import services, unit_of_work
+from random_refs import random_sku, random_batchref, random_orderid
+
+OLD_SCHEMA = [
+    "CREATE TABLE products (sku varchar(255) PRIMARY KEY)",
+    "CREATE TABLE order_lines (id serial PRIMARY KEY, sku varchar(255), qty integer NOT NULL,"
+    " orderid varchar(255))",
+    "CREATE UNIQUE INDEX idx_unq_orderline_sku_orderid ON order_lines (orderid, sku)",
+    "CREATE TABLE batches (id serial PRIMARY KEY, reference varchar(255) UNIQUE,"
+    " sku varchar(255) REFERENCES products (sku), purchased_quantity integer NOT NULL,"
+    " eta timestamp with time zone)",
+    "CREATE TABLE allocations (id serial PRIMARY KEY, orderline_id integer UNIQUE REFERENCES order_lines (id),"
+    " batch_id integer REFERENCES batches (id))",
+    "INSERT INTO products VALUES ('OLD-LAMP')",
+    "INSERT INTO batches (reference, sku, purchased_quantity) VALUES ('batch1', 'OLD-LAMP', 10)",
+    "INSERT INTO order_lines (sku, qty, orderid) VALUES ('OLD-LAMP', 3, 'o1'), ('OLD-LAMP', 4, 'o2')",
+    "INSERT INTO allocations (orderline_id, batch_id) SELECT id, 1 FROM order_lines",
+]
+
+
+def get_indexes(connection, table):
+    return {index['name'] for index in sa.inspect(connection).get_indexes(table)}
+
+
+def test_migrate_upgrades_an_old_schema(engine):
+    metadata.drop_all(engine)
+    with engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.execute(sa.text(statement))
+
+    applied = migrations.migrate(engine)
+
+    assert [migration.version for migration in applied] == [m.version for m in migrations.MIGRATIONS]
+    with engine.connect() as connection:
+        assert connection.execute(sa.text(
+            "SELECT allocated_quantity FROM batches WHERE reference = 'batch1'")).scalar_one() == 7
+        assert {'idx_batches_sku', 'idx_batches_sku_in_stock'} <= get_indexes(connection, 'batches')
+        assert 'idx_allocations_batch_id' in get_indexes(connection, 'allocations')
+        assert migrations.applied_versions(connection) == {m.version for m in migrations.MIGRATIONS}
+    assert migrations.migrate(engine) == []
+
+    services.allocate('o3', 'OLD-LAMP', 3, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, partial_load=True) as uow:
+        assert uow.products.get('OLD-LAMP')._batches == set()
+
+
+def test_migrate_is_a_noop_on_a_schema_created_from_metadata(engine):
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate(random_orderid(), sku, 4, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    migrations.migrate(engine, target=3)
+    with engine.connect() as connection:
+        assert migrations.applied_versions(connection) == {1, 2, 3}
+    migrations.migrate(engine)
+
+    with engine.connect() as connection:
+        assert connection.execute(sa.text(
+            "SELECT allocated_quantity FROM batches WHERE sku = :sku"), sku=sku).scalar_one() == 4
+
+
+def test_interrupted_concurrent_index_is_rebuilt(engine):
+    sku = random_sku()
+    services.add_batch(random_batchref(1), sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.add_batch(random_batchref(2), sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(sa.text("DROP INDEX IF EXISTS idx_batches_sku"))
+        # Построение обрывается на дубликатах и оставляет индекс INVALID
+        with pytest.raises(sa.exc.IntegrityError):
+            connection.execute(sa.text("CREATE UNIQUE INDEX CONCURRENTLY idx_batches_sku ON batches (sku)"))
+
+        migrations.create_index_concurrently('idx_batches_sku', 'batches (sku)')(connection)
+
+        valid = connection.execute(sa.text(
+            "SELECT indisvalid, indisunique FROM pg_index"
+            " JOIN pg_class ON pg_class.oid = pg_index.indexrelid WHERE relname = 'idx_batches_sku'")).one()
+    assert tuple(valid) == (True, False)
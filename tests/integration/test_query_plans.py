@@ -0,0 +1,42 @@
+import pytest
+import sqlalchemy as sa
+
+from allocation.adapters import archive
+from allocation.adapters.query_plans import QueryPlanChecker, SequentialScanFound
+from allocation.domain import model
+from allocation.service_layer import services, unit_of_work
+from random_refs import random_sku, random_batchref, random_orderid
+
+
+def test_repository_statements_use_indexes(engine):
+    sku, other_sku = random_sku(), random_sku('other')
+    services.add_batch(random_batchref('other'), other_sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with QueryPlanChecker(engine) as checker:
+        services.add_batch(random_batchref(1), sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+        services.add_batch(random_batchref(2), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+        services.allocate(random_orderid(1), sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine))
+        services.allocate_many([model.OrderLine(random_orderid(2), sku, 5),
+                                model.OrderLine(random_orderid(3), sku, 5)],
+                               unit_of_work.SqlAlchemyUnitOfWork(engine))
+        with unit_of_work.SqlAlchemyUnitOfWork(engine, partial_load=True) as uow:
+            product = uow.products.get(sku)
+            [batch] = product._batches
+            for line in list(uow.products.select_batch_lines(batch)):
+                batch.deallocate(line)
+            uow.commit()
+        archive.compact(engine)
+        with engine.connect() as connection:
+            archive.select_allocation_history(connection, sku)
+
+    assert checker.explained > 10
+    checker.check()
+
+
+def test_checker_reports_sequential_scans(engine):
+    with QueryPlanChecker(engine) as checker:
+        with engine.connect() as connection:
+            connection.execute(sa.text("SELECT * FROM order_lines WHERE qty = 1"))
+
+    with pytest.raises(SequentialScanFound, match='order_lines'):
+        checker.check()
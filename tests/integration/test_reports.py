@@ -0,0 +1,35 @@
+import sqlalchemy as sa
+
+from allocation.domain import model
+from allocation.service_layer import services, unit_of_work
+
+
+def test_export_inventory_streams_products_across_cursor_chunks(engine):
+    skus = [f'sku-{number:03}' for number in range(50)]
+    batches = (model.Batch(f'{sku}-batch{number}', sku, 10, None) for sku in skus for number in range(3))
+    services.ingest_batches(batches, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate_many([model.OrderLine(f'order-{sku}', sku, 4) for sku in skus],
+                           unit_of_work.SqlAlchemyUnitOfWork(engine))
+    with engine.begin() as connection:
+        connection.execute(sa.text("INSERT INTO products (sku) VALUES ('sku-empty')"))
+
+    rows = list(services.export_inventory(unit_of_work.SqlAlchemyUnitOfWork(engine), chunk_size=7))
+
+    assert len(rows) == 150
+    assert [row.sku for row in rows] == sorted(row.sku for row in rows)
+    assert sum(row.allocated_quantity for row in rows) == 4 * 50
+    assert rows[0] == services.InventoryRow('sku-000', 'sku-000-batch0', None, 10, 4, 6)
+
+
+def test_reconcile_reports_batches_with_diverged_allocated_quantity(engine):
+    services.add_batch('batch1', 'RECONCILED-SOFA', 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.add_batch('batch2', 'RECONCILED-SOFA', 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate('order1', 'RECONCILED-SOFA', 4, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    assert list(services.reconcile(unit_of_work.SqlAlchemyUnitOfWork(engine))) == []
+
+    with engine.begin() as connection:
+        connection.execute(sa.text("UPDATE batches SET allocated_quantity = 1 WHERE reference = 'batch1'"))
+
+    assert list(services.reconcile(unit_of_work.SqlAlchemyUnitOfWork(engine), chunk_size=1)) == [
+        services.Discrepancy('batch1', 'RECONCILED-SOFA', 10, 1, 4)
+    ]
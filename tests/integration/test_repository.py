@@ -1,3 +1,6 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from allocation.adapters import repository
 from allocation.domain import model
 import sqlalchemy as sa
@@ -110,6 +113,7 @@ def test_repository_can_save_a_batch(session_factory):
     repo = repository.SqlAlchemyRepository(session_factory())
     repo.add(product)
     product.add_batch(batch)
+    repo.flush()
     repo.session.get_transaction().commit()
     repo.session.close()
 
@@ -134,14 +138,111 @@ def test_updating_a_batch(session_factory):
     product.add_batch(batch)
 
     batch.allocate(order1)
+    repo.flush()
     assert get_allocations(connection, "batch1") == {"order1"}
 
     batch.allocate(order2)
+    repo.flush()
     assert get_allocations(connection, "batch1") == {"order1", "order2"}
 
     batch.deallocate(order1)
+    repo.flush()
     assert get_allocations(connection, "batch1") == {"order2"}
 
     connection.get_transaction().commit()
     connection.close()
     repo.session.close()
+
+
+def test_repository_loads_a_product_with_a_single_statement(session_factory):
+    connection = session_factory()
+    orderline_id = insert_order_line(connection)
+    insert_product(connection)
+    batch1_id = insert_batch(connection, "batch1")
+    insert_batch(connection, "batch2")
+    insert_allocation(connection, orderline_id, batch1_id)
+    connection.get_transaction().commit()
+    connection.close()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    repo = repository.SqlAlchemyRepository(session_factory())
+    sa.event.listen(repo.session, 'before_cursor_execute', before_cursor_execute)
+    product = repo.get('GENERIC-SOFA')
+
+    assert len(statements) == 1
+    assert {batch.reference for batch in product._batches} == {"batch1", "batch2"}
+    assert product.allocate(model.OrderLine("order2", "GENERIC-SOFA", 80)) == "batch1"
+    repo.session.get_transaction().rollback()
+    repo.session.close()
+
+
+def test_flush_learns_ids_of_new_and_existing_rows_from_the_writes(session_factory):
+    connection = session_factory()
+    stored_line_id = insert_order_line(connection)
+    insert_product(connection)
+    stored_batch_id = insert_batch(connection, "batch1")
+    connection.get_transaction().commit()
+    connection.close()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # Продукт и batch1 уже сохранены параллельно: вставки упрутся в конфликт
+    repo = repository.SqlAlchemyRepository(session_factory())
+    product = model.Product('GENERIC-SOFA', [])
+    repo.add(product)
+    stored_batch = model.Batch("batch1", "GENERIC-SOFA", 100, eta=None)
+    new_batches = [model.Batch(f"batch{number}", "GENERIC-SOFA", 100, eta=None) for number in (2, 3)]
+    for batch in [stored_batch, *new_batches]:
+        product.add_batch(batch)
+    stored_line = model.OrderLine("order1", "GENERIC-SOFA", 12)
+    new_line = model.OrderLine("order2", "GENERIC-SOFA", 5)
+    product.allocate(stored_line)
+    product.allocate(new_line)
+
+    sa.event.listen(repo.session, 'before_cursor_execute', before_cursor_execute)
+    repo.flush()
+
+    assert len(statements) == 3
+    assert stored_batch.__repository_id__ == stored_batch_id
+    assert stored_line.__repository_id__ == stored_line_id
+    [[new_line_id]] = repo.session.execute(
+        sa.text("SELECT id FROM order_lines WHERE orderid = 'order2'")).all()
+    assert new_line.__repository_id__ == new_line_id
+    assert {batch.__repository_id__ for batch in new_batches} == {
+        id_ for [id_] in repo.session.execute(
+            sa.text("SELECT id FROM batches WHERE reference IN ('batch2', 'batch3')"))
+    }
+    repo.session.get_transaction().rollback()
+    repo.session.close()
+
+
+def test_insert_batches_learns_id_of_a_batch_committed_concurrently(engine):
+    with engine.begin() as connection:
+        connection.execute(sa.text("INSERT INTO products (sku) VALUES ('RACE-SOFA')"))
+    competitor = engine.connect()
+    competitor_transaction = competitor.begin()
+    competitor.execute(sa.text("INSERT INTO batches (reference, sku, purchased_quantity, allocated_quantity)"
+                               " VALUES ('race-batch', 'RACE-SOFA', 10, 0)"))
+    batch = model.Batch('race-batch', 'RACE-SOFA', 10, None)
+
+    def insert():
+        with engine.begin() as connection:
+            # Вставка ждёт конкурента на конфликте и видит снимок до его коммита
+            repository.SqlAlchemyRepository(connection).insert_batches([batch])
+
+    with ThreadPoolExecutor(1) as executor:
+        inserted = executor.submit(insert)
+        time.sleep(0.3)
+        competitor_transaction.commit()
+        inserted.result(timeout=5)
+    [[batch_id]] = competitor.execute(sa.text("SELECT id FROM batches WHERE reference = 'race-batch'"))
+    competitor.close()
+
+    assert batch.__repository_id__ == batch_id
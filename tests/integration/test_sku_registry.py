@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from allocation.adapters import engines, instrumentation
+from allocation.adapters.sku_registry import SkuRegistry
+from allocation.service_layer import services, unit_of_work
+from random_refs import random_sku, random_batchref, random_orderid
+
+
+def test_invalid_sku_is_answered_without_database(engine):
+    sku, garbage = random_sku(), random_sku('garbage')
+    services.add_batch(random_batchref(), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    registry = SkuRegistry(lambda: engine)
+    registry.refresh()
+
+    with instrumentation.track_request() as stats:
+        with pytest.raises(services.InvalidSku):
+            services.allocate(random_orderid(), garbage, 10,
+                              unit_of_work.SqlAlchemyUnitOfWork(engine, sku_registry=registry))
+    # Только проверка артикула в базе, без транзакции с блокировкой продукта
+    assert stats.statements == 1
+    assert stats.transactions == 0
+
+    with instrumentation.track_request() as stats:
+        with pytest.raises(services.InvalidSku):
+            services.allocate(random_orderid(), garbage, 10,
+                              unit_of_work.SqlAlchemyUnitOfWork(engine, sku_registry=registry))
+    assert stats.statements == 0
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(engine, sku_registry=registry)
+    assert services.allocate(random_orderid(), sku, 10, uow)
+
+
+def test_add_batch_registers_sku_during_and_after_refresh(engine):
+    registry = SkuRegistry(lambda: engine)
+    registry.refresh()
+    sku = random_sku()
+    assert not registry.might_exist(sku)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(engine, sku_registry=registry)
+    services.add_batch(random_batchref(), sku, 100, None, uow)
+
+    assert registry.might_exist(sku)
+    registry.refresh()
+    assert registry.might_exist(sku)
+
+
+def test_sku_created_by_another_process_is_found_in_database(engine):
+    registry = SkuRegistry(lambda: engine)
+    registry.refresh()
+    # Артикул создан другим процессом после перестройки фильтра
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    assert not registry.might_exist(sku)
+
+    assert registry.exists(sku)
+    assert registry.might_exist(sku)
+    services.allocate(random_orderid(), sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine, sku_registry=registry))
+
+
+def test_stale_filter_defers_to_database(engine, clock):
+    registry = SkuRegistry(lambda: engine, refresh_interval=10, clock=clock)
+    registry.refresh()
+    # Артикул создан другим процессом после перестройки фильтра
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    assert not registry.might_exist(sku)
+
+    clock.now = 21
+    assert registry.might_exist(sku)
+    services.allocate(random_orderid(), sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine, sku_registry=registry))
+
+
+def test_background_refresh_fills_registry(engine):
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    registry = SkuRegistry(lambda: engine, refresh_interval=0.05)
+    registry.start()
+    try:
+        for _ in range(100):
+            if not registry.might_exist(random_sku('garbage')):
+                break
+            time.sleep(0.05)
+        else:
+            pytest.fail('Фильтр артикулов не заполнен')
+        assert registry.might_exist(sku)
+    finally:
+        registry.stop()
+
+
+def report_registry_thread(registry, queue):
+    before = registry._thread
+    registry.start()
+    queue.put((before is None, registry._thread.is_alive()))
+    registry.stop()
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='нет os.register_at_fork')
+def test_forked_child_starts_its_own_refresh_thread(engine):
+    # Движок процесса: после fork дочерний процесс открывает свои соединения
+    registry = SkuRegistry(engines.get_engine, refresh_interval=10)
+    registry.start()
+    try:
+        for _ in range(100):
+            if registry._bloom is not None:
+                break
+            time.sleep(0.05)
+        queue = multiprocessing.get_context('fork').Queue()
+        child = multiprocessing.get_context('fork').Process(target=report_registry_thread, args=(registry, queue))
+        child.start()
+        assert queue.get(timeout=10) == (True, True)
+        child.join()
+        assert registry._thread.is_alive()
+    finally:
+        registry.stop()
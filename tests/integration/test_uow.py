@@ -8,8 +8,10 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from allocation import config
+from allocation.adapters import repository
+from allocation.adapters.cache import ProductCache
 from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from allocation.service_layer import services, unit_of_work
 from random_refs import random_sku, random_batchref, random_orderid
 
 
@@ -88,10 +90,10 @@ def test_rolls_back_on_error(engine):
     assert rows == []
 
 
-def try_to_allocate(orderid, sku, exceptions):
+def try_to_allocate(orderid, sku, exceptions, optimistic=False):
     line = model.OrderLine(orderid, sku, 10)
     try:
-        with unit_of_work.SqlAlchemyUnitOfWork() as uow:
+        with unit_of_work.SqlAlchemyUnitOfWork(optimistic=optimistic) as uow:
             product = uow.products.get(sku=sku)
             product.allocate(line)
             time.sleep(0.2)
@@ -139,3 +141,246 @@ def test_concurrent_updates_to_version_are_not_allowed(engine):
 
 
 
+
+
+def test_commit_writes_an_allocation_and_product_version_in_two_statements(engine):
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        insert_product(uow.connection, 'GROUPED-CHAIR')
+        insert_batch(uow.connection, "batch1", "GROUPED-CHAIR", 100, None)
+        uow.commit()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(engine)
+    with uow:
+        product = uow.products.get('GROUPED-CHAIR')
+        product.allocate(model.OrderLine('o1', 'GROUPED-CHAIR', 10))
+        sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            uow.commit()
+        finally:
+            sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    assert len(statements) == 2
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        assert get_allocated_batch_ref(uow.connection, 'o1', 'GROUPED-CHAIR') == 'batch1'
+
+
+def test_uow_reuses_cached_product_while_version_is_unchanged(engine, get_product_version):
+    cache = ProductCache(max_weight=1000)
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        insert_product(uow.connection, 'CACHED-TABLE')
+        insert_batch(uow.connection, "batch1", "CACHED-TABLE", 100, None)
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, cache) as uow:
+        first = uow.products.get('CACHED-TABLE')
+        first.allocate(model.OrderLine('o1', 'CACHED-TABLE', 10))
+        uow.commit()
+    assert get_product_version('CACHED-TABLE') == 1
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, cache) as uow:
+        second = uow.products.get('CACHED-TABLE')
+        uow.commit()
+    assert second is first
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        insert_batch(uow.connection, "batch2", "CACHED-TABLE", 100, None)
+        uow.connection.execute(sa.text(
+            "UPDATE products SET version_number = version_number + 1 WHERE sku = 'CACHED-TABLE'"))
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, cache) as uow:
+        third = uow.products.get('CACHED-TABLE')
+    assert third is not first
+    assert {batch.reference for batch in third._batches} == {'batch1', 'batch2'}
+
+
+def test_uow_does_not_cache_products_from_rolled_back_work(engine):
+    cache = ProductCache(max_weight=1000)
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        insert_product(uow.connection, 'CACHED-LAMP')
+        insert_batch(uow.connection, "batch1", "CACHED-LAMP", 100, None)
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, cache) as uow:
+        uow.products.get('CACHED-LAMP')
+        uow.commit()
+    assert len(cache) == 1
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, cache) as uow:
+        product = uow.products.get('CACHED-LAMP')
+        product.add_batch(model.Batch('batch2', 'CACHED-LAMP', 10, None))
+    assert len(cache) == 0
+
+
+def test_uow_keeps_product_cached_after_out_of_stock(engine):
+    cache = ProductCache(max_weight=1000)
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    services.allocate(random_orderid(), sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    cached = cache.take(sku)
+    cache.put(cached)
+
+    with pytest.raises(model.OutOfStock):
+        services.allocate(random_orderid(), sku, 1, unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    assert cache.take(sku) is cached
+
+
+def test_uow_keeps_product_cached_when_it_is_locked_by_another_transaction(engine):
+    cache = ProductCache(max_weight=1000)
+    sku = random_sku()
+    services.add_batch(random_batchref(), sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    services.allocate(random_orderid(), sku, 1, unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    assert len(cache) == 1
+
+    with engine.begin() as connection:
+        connection.execute(sa.text("SELECT 1 FROM products WHERE sku = :sku FOR UPDATE"), sku=sku)
+        with pytest.raises(repository.ParallelAccess):
+            services.allocate(random_orderid(), sku, 1, unit_of_work.SqlAlchemyUnitOfWork(engine, cache))
+    assert len(cache) == 1
+
+
+def run_concurrently(*targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def get_allocated_orderids(engine, sku):
+    with engine.connect() as connection:
+        return {orderid for [orderid] in connection.execute(
+            sa.text("SELECT orderid FROM allocations"
+                    " JOIN order_lines ON allocations.orderline_id = order_lines.id"
+                    " WHERE order_lines.sku = :sku"),
+            sku=sku
+        )}
+
+
+def test_optimistic_mode_rejects_the_later_of_concurrent_commits(engine, get_product_version):
+    sku, batch = random_sku(), random_batchref()
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        insert_product(uow.connection, sku)
+        insert_batch(uow.connection, batch, sku, 100, eta=None)
+        uow.commit()
+
+    order1, order2 = random_orderid(1), random_orderid(2)
+    exceptions = []
+    run_concurrently(lambda: try_to_allocate(order1, sku, exceptions, optimistic=True),
+                     lambda: try_to_allocate(order2, sku, exceptions, optimistic=True))
+
+    [exception] = exceptions
+    assert isinstance(exception, repository.ParallelAccess)
+    assert len(get_allocated_orderids(engine, sku)) == 1
+    assert get_product_version(sku) == 1
+
+
+def test_optimistic_mode_retries_in_the_service_layer(engine):
+    sku, batch = random_sku(), random_batchref()
+    services.add_batch(batch, sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    orders = [random_orderid(number) for number in range(5)]
+    exceptions = []
+
+    def allocate(orderid):
+        try:
+            uow = unit_of_work.SqlAlchemyUnitOfWork(engine, optimistic=True, max_retries=20)
+            services.allocate(orderid, sku, 10, uow)
+        except Exception as e:
+            exceptions.append(e)
+
+    run_concurrently(*[lambda orderid=orderid: allocate(orderid) for orderid in orders])
+
+    assert exceptions == []
+    assert get_allocated_orderids(engine, sku) == set(orders)
+
+
+def get_allocated_quantities(engine, sku):
+    with engine.connect() as connection:
+        return dict(connection.execute(
+            sa.text("SELECT reference, allocated_quantity FROM batches WHERE sku = :sku"), sku=sku
+        ).all())
+
+
+def test_commit_maintains_allocated_quantity_of_batches(engine):
+    sku, batch1, batch2 = random_sku(), random_batchref(1), random_batchref(2)
+    services.add_batch(batch1, sku, 20, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.add_batch(batch2, sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        product = uow.products.get(sku)
+        product.allocate(model.OrderLine('o1', sku, 15))
+        product.allocate(model.OrderLine('o2', sku, 10))
+        product.allocate(model.OrderLine('o3', sku, 5))
+        uow.commit()
+    assert get_allocated_quantities(engine, sku) == {batch1: 20, batch2: 10}
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        product = uow.products.get(sku)
+        [batch] = [batch for batch in product._batches if batch.reference == batch1]
+        batch.deallocate(model.OrderLine('o1', sku, 15))
+        uow.commit()
+    assert get_allocated_quantities(engine, sku) == {batch1: 5, batch2: 10}
+
+
+def test_partial_load_skips_consumed_batches_and_loads_lines_on_deallocate(engine):
+    sku, consumed, in_stock = random_sku(), random_batchref(1), random_batchref(2)
+    services.add_batch(consumed, sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.add_batch(in_stock, sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate('o1', sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate('o2', sku, 30, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, partial_load=True) as uow:
+        product = uow.products.get(sku)
+        [batch] = product._batches
+        assert batch.reference == in_stock
+        assert batch.available_quantity == 70
+        assert batch._allocations == set()
+
+        batch.deallocate(model.OrderLine('o2', sku, 30))
+        assert batch.available_quantity == 100
+        uow.commit()
+    assert get_allocated_quantities(engine, sku) == {consumed: 10, in_stock: 0}
+    assert get_allocated_orderids(engine, sku) == {'o1'}
+
+
+def test_partial_load_corrects_quantity_of_a_line_allocated_again(engine):
+    sku, batch = random_sku(), random_batchref()
+    services.add_batch(batch, sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate('o1', sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine, partial_load=True) as uow:
+        product = uow.products.get(sku)
+        product.allocate(model.OrderLine('o1', sku, 10))
+        uow.commit()
+        [loaded] = product._batches
+        assert loaded.available_quantity == 90
+    assert get_allocated_quantities(engine, sku) == {batch: 10}
+
+
+def test_read_only_uow_reads_a_snapshot_without_waiting_for_locks(engine):
+    sku, batch = random_sku(), random_batchref()
+    services.add_batch(batch, sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as writer:
+        writer.products.get(sku).allocate(model.OrderLine('o1', sku, 10))
+        with unit_of_work.ReadOnlySqlAlchemyUnitOfWork(engine) as reader:
+            [before] = reader.products.get(sku)._batches
+            writer.commit()
+            # Снимок транзакции чтения не видит коммит, сделанный после её первого запроса
+            [after_commit] = reader.products.select_product(sku)._batches
+    assert before.available_quantity == after_commit.available_quantity == 100
+
+    with unit_of_work.ReadOnlySqlAlchemyUnitOfWork(engine) as reader:
+        product = reader.products.get(sku)
+        [batch] = product._batches
+        assert batch.available_quantity == 90
+        product.allocate(model.OrderLine('o2', sku, 10))
+        with pytest.raises(sa.exc.DBAPIError, match='read-only'):
+            reader.commit()
+    assert get_allocated_orderids(engine, sku) == {'o1'}
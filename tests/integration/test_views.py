@@ -0,0 +1,34 @@
+from allocation.adapters import archive
+from allocation.domain import model
+from allocation.service_layer import services, unit_of_work, views
+from random_refs import random_sku, random_batchref, random_orderid
+
+
+def read_uow(engine):
+    return unit_of_work.ReadOnlySqlAlchemyUnitOfWork(engine)
+
+
+def test_views_follow_allocations_and_deallocations(engine):
+    sku, batch1, batch2 = random_sku(), random_batchref(1), random_batchref(2)
+    order1, order2 = random_orderid(1), random_orderid(2)
+    services.add_batch(batch1, sku, 10, None, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.ingest_batches([model.Batch(batch2, sku, 20, None)], unit_of_work.SqlAlchemyUnitOfWork(engine))
+    assert views.availability(sku, read_uow(engine))['available'] == 30
+
+    services.allocate(order1, sku, 10, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    services.allocate(order2, sku, 5, unit_of_work.SqlAlchemyUnitOfWork(engine))
+    assert views.allocations(order1, read_uow(engine)) == [{'sku': sku, 'batchref': batch1}]
+    assert views.availability(sku, read_uow(engine)) == {
+        'sku': sku, 'available': 15, 'batches': [{'batchref': batch2, 'eta': None, 'available': 15}]
+    }
+
+    with unit_of_work.SqlAlchemyUnitOfWork(engine) as uow:
+        [batch] = [batch for batch in uow.products.get(sku)._batches if batch.reference == batch2]
+        batch.deallocate(model.OrderLine(order2, sku, 5))
+        uow.commit()
+    assert views.allocations(order2, read_uow(engine)) == []
+    assert views.availability(sku, read_uow(engine))['available'] == 20
+
+    archive.compact(engine)
+    assert views.allocations(order1, read_uow(engine)) == [{'sku': sku, 'batchref': batch1}]
+    assert views.availability(sku, read_uow(engine))['available'] == 20
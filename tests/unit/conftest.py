@@ -0,0 +1,50 @@
+import pytest
+
+from allocation.adapters import repository
+from allocation.domain import model
+from allocation.service_layer.unit_of_work import AbstractUnitOfWork
+
+
+class FakeRepository(repository.AbstractProductRepository):
+
+    def __init__(self, products):
+        self._products = set(products)
+        # Загрузки продуктов и число следующих загрузок, отвечающих ParallelAccess
+        self.loads = 0
+        self.failures = 0
+
+    def add(self, product: model.Product):
+        self._products.add(product)
+
+    def get(self, sku) -> model.Batch:
+        self.loads += 1
+        if self.failures:
+            self.failures -= 1
+            raise repository.ParallelAccess()
+        return next((b for b in self._products if b.sku == sku), None)
+
+    def iter_products(self, chunk_size: int = 1000):
+        return iter(sorted(self._products, key=lambda product: product.sku))
+
+
+class FakeUnitOfWork(AbstractUnitOfWork):
+
+    def __init__(self):
+        self.products = FakeRepository([])
+        self.committed = False
+        self.commits = 0
+
+    def __enter__(self):
+        pass
+
+    def commit(self):
+        self.committed = True
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def uow():
+    return FakeUnitOfWork()
@@ -1,7 +1,9 @@
+import time
+
 import pytest
 
 from datetime import date, timedelta
-from allocation.domain.model import Batch, OrderLine, allocate, OutOfStock
+from allocation.domain.model import Batch, OrderLine, Product, allocate, OutOfStock
 
 
 # today = date.today()
@@ -48,3 +50,103 @@ from allocation.domain.model import Batch, OrderLine, allocate, OutOfStock
 #     assert earliest.available_quantity == 90
 #     assert medium.available_quantity == 100
 #     assert latest.available_quantity == 100
+
+
+def test_product_prefers_in_stock_then_earlier_batches():
+    today = date.today()
+    latest = Batch("slow-batch", "MINIMALIST-SPOON", 100, eta=today + timedelta(days=8))
+    earliest = Batch("speedy-batch", "MINIMALIST-SPOON", 100, eta=today)
+    in_stock = Batch("in-stock-batch", "MINIMALIST-SPOON", 100, eta=None)
+    product = Product("MINIMALIST-SPOON", [latest, earliest])
+
+    assert product.allocate(OrderLine("order1", "MINIMALIST-SPOON", 10)) == "speedy-batch"
+    product.add_batch(in_stock)
+    assert product.allocate(OrderLine("order2", "MINIMALIST-SPOON", 10)) == "in-stock-batch"
+
+
+def test_product_breaks_eta_ties_by_reference():
+    today = date.today()
+    product = Product("RETRO-CLOCK", [
+        Batch("batch-b", "RETRO-CLOCK", 100, eta=today),
+        Batch("batch-a", "RETRO-CLOCK", 100, eta=today),
+    ])
+    assert product.allocate(OrderLine("order1", "RETRO-CLOCK", 10)) == "batch-a"
+
+
+def test_product_skips_consumed_batches_until_deallocated():
+    first = Batch("first", "SMALL-FORK", 10, eta=None)
+    second = Batch("second", "SMALL-FORK", 10, eta=date.today())
+    product = Product("SMALL-FORK", [first, second])
+    line = OrderLine("order1", "SMALL-FORK", 10)
+
+    assert product.allocate(line) == "first"
+    assert list(product._queue) == [second]
+
+    first.deallocate(line)
+    assert list(product._queue) == [first, second]
+
+
+def test_product_raises_out_of_stock_when_no_batch_fits():
+    product = Product("SMALL-FORK", [Batch("batch1", "SMALL-FORK", 5, eta=None)])
+    with pytest.raises(OutOfStock, match='SMALL-FORK'):
+        product.allocate(OrderLine("order1", "SMALL-FORK", 6))
+    assert product.version_number == 0
+
+
+def test_product_records_changes_until_taken():
+    product = Product("SMALL-FORK", [])
+    batch = Batch("batch1", "SMALL-FORK", 100, eta=None)
+    kept = OrderLine("order1", "SMALL-FORK", 10)
+    undone = OrderLine("order2", "SMALL-FORK", 10)
+    product.add_batch(batch)
+    product.allocate(kept)
+    product.allocate(undone)
+    batch.deallocate(undone)
+
+    assert product._take_changes() == ([batch], [(batch, kept)], [])
+    assert product._take_changes() == ([], [], [])
+
+    batch.deallocate(kept)
+    assert product._take_changes() == ([], [], [(batch, kept)])
+
+
+def test_batch_loaded_without_lines_loads_them_on_deallocate():
+    stored_line = OrderLine("order1", "RETRO-CLOCK", 10)
+    batch = Batch("batch1", "RETRO-CLOCK", 100, eta=None)
+    product = Product("RETRO-CLOCK", [batch])
+    batch._restore_allocated_quantity(10)
+    loaded = []
+    product._lines_loader = lambda b: loaded.append(b) or [stored_line]
+
+    product.allocate(OrderLine("order2", "RETRO-CLOCK", 5))
+    assert batch.available_quantity == 85
+    assert loaded == []
+
+    batch.deallocate(stored_line)
+    assert loaded == [batch]
+    assert batch.available_quantity == 95
+    _, allocated, deallocated = product._take_changes()
+    assert deallocated == [(batch, stored_line)]
+    assert allocated == [(batch, OrderLine("order2", "RETRO-CLOCK", 5))]
+
+
+def reallocation_time(batches_count, cycles=2000):
+    batches = [Batch(f"batch-{number:06}", "SCALED-LAMP", 1, eta=date(2022, 1, 1) + timedelta(days=number))
+               for number in range(batches_count)]
+    first = batches[0]
+    product = Product("SCALED-LAMP", batches)
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for number in range(cycles):
+            line = OrderLine(f"order{number}", "SCALED-LAMP", 1)
+            product.allocate(line)
+            first.deallocate(line)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def test_allocation_time_grows_slower_than_number_of_batches():
+    # Первая партия то расходуется, то возвращается в очередь: у отсортированного
+    # списка это сдвиг всех партий, у кучи - O(log n)
+    assert reallocation_time(100_000) < 5 * reallocation_time(1_000)
@@ -1,3 +1,5 @@
+import copy
+import pickle
 from datetime import date
 
 from allocation.domain.model import Batch, OrderLine
@@ -49,3 +51,30 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_deallocating_restores_the_available_quantity():
+    batch, line = make_batch_and_line("BLUE-VASE", 20, 2)
+    batch.allocate(line)
+    batch.deallocate(line)
+    batch.deallocate(line)
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+def test_batch_and_order_line_use_slots():
+    batch, line = make_batch_and_line("RED-CHAIR", 20, 2)
+    assert not hasattr(batch, '__dict__')
+    assert not hasattr(line, '__dict__')
+    assert line == OrderLine('order-123', "RED-CHAIR", 2)
+    assert hash(line) == hash(OrderLine('order-123', "RED-CHAIR", 2))
+
+
+def test_order_line_survives_copy_and_pickle():
+    line = OrderLine('order-123', 'ELEGANT-LAMP', 2)
+    object.__setattr__(line, '__repository_id__', 7)
+
+    for restored in (copy.copy(line), copy.deepcopy(line), pickle.loads(pickle.dumps(line))):
+        assert restored == line
+        assert restored.__repository_id__ == 7
+    assert pickle.loads(pickle.dumps(OrderLine('order-1', 'ELEGANT-LAMP', 1))) == OrderLine('order-1', 'ELEGANT-LAMP', 1)
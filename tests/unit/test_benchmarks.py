@@ -0,0 +1,40 @@
+import json
+
+from benchmarks import domain, harness
+
+
+def test_run_scenario_times_each_repeat_after_warmup():
+    calls = []
+
+    def setup():
+        def run():
+            calls.append(1)
+            return 4
+        return run
+
+    result = harness.run_scenario(harness.Scenario('fake', 'unit', setup, repeat=3, warmup=2))
+
+    assert len(calls) == 5
+    assert result.operations == [4, 4, 4]
+    assert len(result.timings) == 3
+    assert result.median == sorted(elapsed / 4 for elapsed in result.timings)[1]
+
+
+def test_domain_scenario_runs():
+    result = harness.run_scenario(harness.Scenario('domain', 'domain', domain.allocate_with_lines(10)), repeat=1)
+    assert result.operations == [domain.ALLOCATIONS]
+
+
+def test_compare_flags_slowdown_over_threshold(tmp_path):
+    fast = harness.Result('fast', 'unit', timings=[1.0], operations=[100])
+    slow = harness.Result('slow', 'unit', timings=[1.0], operations=[100])
+    new = harness.Result('new', 'unit', timings=[1.0], operations=[100])
+    path = str(tmp_path / 'baseline.json')
+    harness.save([harness.Result('fast', 'unit', timings=[1.0], operations=[95]),
+                  harness.Result('slow', 'unit', timings=[1.0], operations=[150])], path)
+
+    comparisons = harness.compare(harness.load_medians(path), [fast, slow, new], threshold=0.1)
+
+    assert [(c.name, c.regressed) for c in comparisons] == [('fast', False), ('slow', True)]
+    with open(path) as file:
+        assert 'environment' in json.load(file)
@@ -0,0 +1,53 @@
+from allocation.adapters.cache import ProductCache, product_weight
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def make_product(sku, batches=1):
+    return Product(sku, [Batch(f'{sku}-batch-{number}', sku, 100, eta=None)
+                         for number in range(batches)])
+
+
+def test_take_hands_out_product_once():
+    cache = ProductCache(max_weight=100)
+    product = make_product('SMALL-TABLE')
+    cache.put(product)
+
+    assert cache.take('SMALL-TABLE') is product
+    assert cache.take('SMALL-TABLE') is None
+
+
+def test_evicts_least_recently_put_products_over_weight():
+    cache = ProductCache(max_weight=6)
+    cache.put(make_product('OLD-CHAIR'))
+    cache.put(make_product('NEW-CHAIR', batches=2))
+    cache.put(make_product('NEWEST-CHAIR'))
+
+    assert cache.take('OLD-CHAIR') is None
+    assert cache.take('NEW-CHAIR') is not None
+    assert cache.take('NEWEST-CHAIR') is not None
+
+
+def test_weight_counts_allocated_lines():
+    cache = ProductCache(max_weight=3)
+    product = make_product('BUSY-LAMP')
+    product.allocate(OrderLine('o1', 'BUSY-LAMP', 1))
+    cache.put(product)
+    assert cache.weight == 3
+
+    product.allocate(OrderLine('o2', 'BUSY-LAMP', 1))
+    cache.put(product)
+    assert len(cache) == 0
+
+
+def test_weight_follows_allocations_without_recounting_lines():
+    product = make_product('COUNTED-LAMP', batches=2)
+    batch = next(iter(product._batches))
+    batch._restore_allocations([OrderLine('loaded', 'COUNTED-LAMP', 1)])
+    product.allocate(OrderLine('o1', 'COUNTED-LAMP', 1))
+    product.allocate(OrderLine('o2', 'COUNTED-LAMP', 1))
+    product.add_batch(Batch('COUNTED-LAMP-batch-new', 'COUNTED-LAMP', 100, eta=None))
+    for allocated in product._batches:
+        allocated.deallocate(OrderLine('o2', 'COUNTED-LAMP', 1))
+
+    assert product._lines == sum(len(b._allocations) for b in product._batches) == 2
+    assert product_weight(product) == 1 + 3 + 2
@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from allocation.domain.model import OutOfStock
+from allocation.service_layer import services
+from allocation.service_layer.dispatcher import AllocationDispatcher, DispatcherTimeout
+
+
+@pytest.fixture
+def uow(uow):
+    services.add_batch("lamp-batch", "TALL-LAMP", 30, None, uow)
+    services.add_batch("fork-batch", "SMALL-FORK", 30, None, uow)
+    return uow
+
+
+def test_allocations_for_a_sku_run_in_submission_order(uow):
+    dispatcher = AllocationDispatcher(lambda: uow, shards=4)
+    futures = [dispatcher.submit(f"order{number}", "TALL-LAMP", 10) for number in range(4)]
+    others = [dispatcher.submit(f"order{number}", "SMALL-FORK", 10) for number in range(3)]
+
+    assert [future.result(timeout=5) for future in futures[:3]] == ["lamp-batch"] * 3
+    with pytest.raises(OutOfStock):
+        futures[3].result(timeout=5)
+    assert [future.result(timeout=5) for future in others] == ["fork-batch"] * 3
+    dispatcher.shutdown()
+
+
+def test_errors_are_delivered_to_the_caller(uow):
+    dispatcher = AllocationDispatcher(lambda: uow, shards=2)
+    with pytest.raises(services.InvalidSku):
+        dispatcher.allocate("order1", "NONEXISTENTSKU", 1)
+    dispatcher.shutdown()
+
+
+def test_group_commit_allocates_queued_lines_in_one_transaction(uow):
+    uow.commits = 0
+    dispatcher = AllocationDispatcher(lambda: uow, shards=1, group_window=0.5, max_group_size=4)
+
+    futures = [dispatcher.submit(f"order{number}", "TALL-LAMP", 10) for number in range(4)]
+
+    assert [future.result(timeout=5) for future in futures[:3]] == ["lamp-batch"] * 3
+    with pytest.raises(OutOfStock):
+        futures[3].result(timeout=5)
+    assert uow.commits == 1
+    dispatcher.shutdown()
+
+
+def test_shard_workers_start_with_the_first_command(uow):
+    dispatcher = AllocationDispatcher(lambda: uow, shards=2)
+    assert dispatcher._workers == []
+    assert dispatcher.allocate("order1", "TALL-LAMP", 10) == "lamp-batch"
+    assert len(dispatcher._workers) == 2
+    dispatcher.shutdown()
+
+
+def test_caller_stops_waiting_after_the_timeout(uow):
+    released = threading.Event()
+
+    def blocked_uow():
+        released.wait(5)
+        return uow
+
+    dispatcher = AllocationDispatcher(blocked_uow, shards=1, timeout=0.05)
+    with pytest.raises(DispatcherTimeout):
+        dispatcher.allocate("order1", "TALL-LAMP", 10)
+    released.set()
+    dispatcher.shutdown()
+
+
+def report_child_allocation(dispatcher, queue):
+    queue.put(dispatcher.allocate("order2", "TALL-LAMP", 10))
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='нет os.register_at_fork')
+def test_forked_child_starts_its_own_shard_workers(uow):
+    dispatcher = AllocationDispatcher(lambda: uow, shards=2, timeout=5)
+    assert dispatcher.allocate("order1", "TALL-LAMP", 10) == "lamp-batch"
+
+    queue = multiprocessing.get_context('fork').Queue()
+    child = multiprocessing.get_context('fork').Process(target=report_child_allocation, args=(dispatcher, queue))
+    child.start()
+    assert queue.get(timeout=10) == "lamp-batch"
+    child.join()
+    dispatcher.shutdown()
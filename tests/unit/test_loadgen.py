@@ -0,0 +1,41 @@
+import random
+from collections import Counter
+
+from allocation.entrypoints.loadgen import SkuDistribution, classify, order_stream, percentile
+
+
+def test_zipf_distribution_prefers_top_skus():
+    distribution = SkuDistribution(['a', 'b', 'c', 'd'], 'zipf', exponent=2)
+    rng = random.Random(1)
+    counts = Counter(distribution.choose(rng) for _ in range(10_000))
+    assert counts['a'] > counts['b'] > counts['c'] > counts['d']
+    assert 0.65 < counts['a'] / 10_000 < 0.75
+
+
+def test_order_stream_is_reproducible_and_mixes_restocks():
+    distribution = SkuDistribution(['a', 'b'], 'uniform')
+
+    def kinds_and_skus(seed):
+        stream = order_stream(distribution, random.Random(seed), max_qty=5, restock_ratio=0.2, restock_qty=100)
+        return [(operation.kind, operation.payload['sku']) for operation, _ in zip(stream, range(500))]
+
+    first = kinds_and_skus(7)
+    assert first == kinds_and_skus(7)
+    restocks = sum(kind == 'add_batch' for kind, _ in first)
+    assert 50 < restocks < 150
+
+
+def test_classify_outcomes():
+    assert classify(201, '') == 'ok'
+    assert classify(409, 'Продукт X изменён параллельно') == 'ParallelAccess'
+    assert classify(400, 'Артикула X нет в наличии') == 'OutOfStock'
+    assert classify(400, 'Недопустимый артикул X') == 'InvalidSku'
+    assert classify(500, '') == 'HTTP 500'
+
+
+def test_percentile_nearest_rank():
+    ordered = list(range(1, 101))
+    assert percentile(ordered, 0.5) == 50
+    assert percentile(ordered, 0.99) == 99
+    assert percentile(ordered, 1.0) == 100
+    assert percentile([], 0.5) == 0.0
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from allocation.adapters.metrics import MetricsRegistry, sku_bucket
+
+
+def test_counter_sums_values_written_by_each_thread():
+    registry = MetricsRegistry()
+    counter = registry.counter('test_total', 'Тестовый счётчик', ('kind',))
+
+    def work():
+        for _ in range(1000):
+            counter.inc('a')
+        counter.inc('b', amount=2)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.values() == {('a',): 4000, ('b',): 8}
+
+
+def test_histogram_is_rendered_with_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('test_seconds', 'Тестовая гистограмма', ('endpoint',), buckets=(0.1, 1))
+    histogram.observe(0.05, 'allocate')
+    histogram.observe(0.5, 'allocate')
+    histogram.observe(3, 'allocate')
+
+    assert registry.render().splitlines() == [
+        '# HELP test_seconds Тестовая гистограмма',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{endpoint="allocate",le="0.1"} 1',
+        'test_seconds_bucket{endpoint="allocate",le="1"} 2',
+        'test_seconds_bucket{endpoint="allocate",le="+Inf"} 3',
+        'test_seconds_sum{endpoint="allocate"} 3.55',
+        'test_seconds_count{endpoint="allocate"} 3',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter('test_total', 'Тестовый счётчик', ('sku',)).inc('a"b\\c')
+    assert 'test_total{sku="a\\"b\\\\c"} 1' in registry.render()
+
+
+def test_reset_and_duplicate_names():
+    registry = MetricsRegistry()
+    counter = registry.counter('test_total', 'Тестовый счётчик')
+    counter.inc()
+    registry.reset()
+    assert counter.values() == {}
+    with pytest.raises(ValueError):
+        registry.counter('test_total', 'Повтор')
+
+
+def test_sku_bucket_is_stable():
+    assert sku_bucket('RED-CHAIR') == sku_bucket('RED-CHAIR')
+    assert 0 <= int(sku_bucket('RED-CHAIR')) < 16
+
+
+def test_values_of_finished_threads_are_merged_and_their_shards_dropped():
+    registry = MetricsRegistry()
+    counter = registry.counter('test_total', 'Тестовый счётчик')
+    histogram = registry.histogram('test_seconds', 'Тестовая гистограмма', buckets=(1,))
+
+    def work():
+        counter.inc()
+        histogram.observe(0.5)
+
+    for _ in range(200):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+    assert counter.values() == {(): 200}
+    assert histogram.values() == {(): [200, 0, 100.0]}
+    assert len(counter._shards) <= 1
+    assert len(histogram._shards) <= 1
@@ -0,0 +1,54 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from allocation.domain.model import Batch, OrderLine, Product, OutOfStock  # noqa: E402
+from allocation.domain.planner import AllocationPlanner  # noqa: E402
+
+today = date.today()
+
+
+def make_product(rnd: random.Random, sku: str) -> Product:
+    batches = []
+    for number in range(rnd.randint(0, 30)):
+        eta = None if rnd.random() < 0.2 else today + timedelta(days=rnd.randint(0, 10))
+        batch = Batch(f'batch-{number}', sku, rnd.randint(0, 200), eta=eta)
+        for line_number in range(rnd.randint(0, 3)):
+            batch.allocate(OrderLine(f'old-{number}-{line_number}', sku, rnd.randint(1, 50)))
+        batches.append(batch)
+    return Product(sku, batches)
+
+
+def make_lines(rnd: random.Random, sku: str) -> list[OrderLine]:
+    return [
+        OrderLine(f'order-{number}',
+                  sku if rnd.random() < 0.95 else 'OTHER-SKU',
+                  rnd.choice([0, 1, 2, 5, 10, 40, 150]))
+        for number in range(rnd.randint(0, 500))
+    ]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_planner_matches_sequential_product_allocation(seed):
+    rnd = random.Random(seed)
+    product = make_product(rnd, 'PLANNED-LAMP')
+    lines = make_lines(rnd, 'PLANNED-LAMP')
+
+    planned = AllocationPlanner.from_product(product).plan(lines)
+    sequential = [None if isinstance(result, OutOfStock) else result
+                  for result in product.allocate_many(lines)]
+
+    assert planned == sequential
+
+
+def test_planner_does_not_change_product():
+    batch = Batch('batch1', 'PLANNED-LAMP', 10, eta=None)
+    product = Product('PLANNED-LAMP', [batch])
+    planner = AllocationPlanner.from_product(product)
+
+    assert planner.plan([OrderLine('o1', 'PLANNED-LAMP', 10),
+                         OrderLine('o2', 'PLANNED-LAMP', 1)]) == ['batch1', None]
+    assert batch.available_quantity == 10
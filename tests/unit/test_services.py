@@ -2,78 +2,43 @@ from datetime import date, timedelta
 
 import pytest
 
-from allocation.adapters import repository
+from allocation.adapters import metrics, repository
 from allocation.domain import model
 from allocation.domain.model import OutOfStock
 from allocation.service_layer import services
-from allocation.service_layer.unit_of_work import AbstractUnitOfWork
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
 later = tomorrow + timedelta(days=7)
 
 
-class FakeRepository(repository.AbstractProductRepository):
-
-    def __init__(self, products):
-        self._products = set(products)
-
-    def add(self, product: model.Product):
-        self._products.add(product)
-
-    def get(self, sku) -> model.Batch:
-        return next((b for b in self._products if b.sku == sku), None)
-
-
-class FakeUnitOfWork(AbstractUnitOfWork):
-
-    def __init__(self):
-        self.products = FakeRepository([])
-        self.committed = False
-
-    def __enter__(self):
-        pass
-
-    def commit(self):
-        self.committed = True
-
-    def rollback(self):
-        pass
-
-
-def test_add_batch():
-    uow = FakeUnitOfWork()
+def test_add_batch(uow):
     services.add_batch("b1", "CRUNCHY-ARMCHAIR", 100, None, uow)
     product = uow.products.get("CRUNCHY-ARMCHAIR")
     assert product._batches.pop().reference == 'b1'
     assert uow.committed
 
 
-def test_returns_allocation():
-    uow = FakeUnitOfWork()
+def test_returns_allocation(uow):
     services.add_batch("b1", "COMPLICATED-LAMP", 100, None, uow)
     result = services.allocate("o1", "COMPLICATED-LAMP", 10, uow)
     assert result == "b1"
 
 
-def test_error_for_invalid_sku():
-    uow = FakeUnitOfWork()
+def test_error_for_invalid_sku(uow):
     services.add_batch("b1", "AREALSKU", 100, None, uow)
 
     with pytest.raises(services.InvalidSku, match="Недопустимый артикул NONEXISTENTSKU"):
         services.allocate("o1", "NONEXISTENTSKU", 10, uow)
 
 
-def test_commits():
-    uow = FakeUnitOfWork()
-
+def test_commits(uow):
     services.add_batch("b1", "OMINOUS-MIRROR", 100, None, uow)
     services.allocate("o1", "OMINOUS-MIRROR", 10, uow)
     assert uow.committed is True
 
 
-def test_prefers_warehouse_batches_to_shipments():
-    uow = FakeUnitOfWork()
+def test_prefers_warehouse_batches_to_shipments(uow):
     services.add_batch("in-stock-batch", "RETRO-CLOCK", 100, None, uow)
     services.add_batch("shipment-batch", "RETRO-CLOCK", 100, tomorrow, uow)
 
@@ -86,9 +51,7 @@ def test_prefers_warehouse_batches_to_shipments():
     assert shipment_batch.available_quantity == 100
 
 
-def test_prefers_earlier_batches():
-    uow = FakeUnitOfWork()
-
+def test_prefers_earlier_batches(uow):
     services.add_batch("speedy-batch", "MINIMALIST-SPOON", 100, today, uow)
     services.add_batch("normal-batch", "MINIMALIST-SPOON", 100, tomorrow, uow)
     services.add_batch("slow-batch", "MINIMALIST-SPOON", 100, later, uow)
@@ -107,8 +70,7 @@ def test_prefers_earlier_batches():
     assert slow_batch.available_quantity == 100
 
 
-def test_raises_out_of_stock_exception_if_cannot_allocate():
-    uow = FakeUnitOfWork()
+def test_raises_out_of_stock_exception_if_cannot_allocate(uow):
     services.add_batch('batch1', 'SMALL-FORK', 10, today, uow)
 
     services.allocate('order1', 'SMALL-FORK', 10, uow)
@@ -116,10 +78,92 @@ def test_raises_out_of_stock_exception_if_cannot_allocate():
         services.allocate('order2', 'SMALL-FORK', 1, uow)
 
 
-def test_returns_allocated_batch_ref():
-    uow = FakeUnitOfWork()
+def test_returns_allocated_batch_ref(uow):
     services.add_batch("in-stock-batch-ref", "HIGHBROW-POSTER", 100, None, uow)
     services.add_batch("shipment-batch-ref", "HIGHBROW-POSTER", 100, tomorrow, uow)
 
     batchref = services.allocate("oref", "HIGHBROW-POSTER", 10, uow)
     assert batchref == "in-stock-batch-ref"
+
+
+def test_allocate_many_returns_result_per_line_in_order(uow):
+    services.add_batch("fork-batch", "SMALL-FORK", 10, None, uow)
+    services.add_batch("lamp-batch", "TALL-LAMP", 100, None, uow)
+    lines = [
+        model.OrderLine("o1", "SMALL-FORK", 8),
+        model.OrderLine("o1", "TALL-LAMP", 5),
+        model.OrderLine("o2", "SMALL-FORK", 8),
+        model.OrderLine("o2", "NONEXISTENTSKU", 1),
+        model.OrderLine("o3", "SMALL-FORK", 2),
+    ]
+
+    results = services.allocate_many(lines, uow)
+
+    assert [r.line for r in results] == lines
+    assert [r.batchref for r in results] == ["fork-batch", "lamp-batch", None, None, "fork-batch"]
+    assert isinstance(results[2].error, OutOfStock)
+    assert isinstance(results[3].error, services.InvalidSku)
+    assert uow.committed
+
+
+def test_retries_parallel_access_up_to_max_retries(uow):
+    services.add_batch("b1", "BUSY-LAMP", 100, None, uow)
+    uow.products.failures = 2
+    uow.max_retries, uow.retry_backoff = 2, 0
+
+    assert services.allocate("o1", "BUSY-LAMP", 10, uow) == "b1"
+
+    uow.products.failures = 3
+    with pytest.raises(repository.ParallelAccess):
+        services.allocate("o2", "BUSY-LAMP", 10, uow)
+
+
+def test_ingest_batches_commits_each_chunk_and_skips_known_batches(uow):
+    services.add_batch("b0", "TALL-LAMP", 10, None, uow)
+    new_batches = (model.Batch(f"b{number}", "SHORT-LAMP" if number % 2 else "TALL-LAMP", 10, None)
+                   for number in range(5))
+
+    assert services.ingest_batches(new_batches, uow, chunk_size=2) == 4
+    assert uow.commits == 1 + 3
+    assert {b.reference for b in uow.products.get("TALL-LAMP")._batches} == {"b0", "b2", "b4"}
+    assert {b.reference for b in uow.products.get("SHORT-LAMP")._batches} == {"b1", "b3"}
+
+
+def test_allocation_outcomes_are_counted_in_metrics(uow):
+    services.add_batch("b1", "METRIC-LAMP", 10, None, uow)
+    allocated = metrics.ALLOCATIONS.values().get((), 0)
+    bucket = metrics.sku_bucket("METRIC-LAMP")
+    out_of_stock = metrics.ALLOCATION_ERRORS.values().get(('OutOfStock', bucket), 0)
+
+    services.allocate("o1", "METRIC-LAMP", 10, uow)
+    with pytest.raises(OutOfStock):
+        services.allocate("o2", "METRIC-LAMP", 1, uow)
+
+    assert metrics.ALLOCATIONS.values()[()] == allocated + 1
+    assert metrics.ALLOCATION_ERRORS.values()[('OutOfStock', bucket)] == out_of_stock + 1
+
+
+def test_invalid_sku_is_rejected_by_the_registry_without_loading(uow):
+    class Registry:
+        def exists(self, sku):
+            return sku != 'GARBAGE'
+
+    uow.sku_registry = Registry()
+
+    with pytest.raises(services.InvalidSku, match='Недопустимый артикул GARBAGE'):
+        services.allocate('o1', 'GARBAGE', 10, uow)
+    [result] = services.allocate_many([model.OrderLine('o2', 'GARBAGE', 1)], uow)
+
+    assert isinstance(result.error, services.InvalidSku)
+    assert uow.products.loads == 0
+
+
+def test_export_inventory_lists_batches_of_every_product(uow):
+    services.add_batch("b2", "SMALL-TABLE", 20, None, uow)
+    services.add_batch("b1", "BIG-TABLE", 10, None, uow)
+    services.allocate("o1", "BIG-TABLE", 4, uow)
+
+    rows = list(services.export_inventory(uow))
+
+    assert [(row.sku, row.reference, row.available_quantity) for row in rows] == [
+        ("BIG-TABLE", "b1", 6), ("SMALL-TABLE", "b2", 20)]
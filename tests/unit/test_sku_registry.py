@@ -0,0 +1,36 @@
+from allocation.adapters.sku_registry import BloomFilter, SkuRegistry
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter(10_000, false_positive_rate=0.01)
+    for number in range(10_000):
+        bloom.add(f'SKU-{number}')
+
+    assert all(f'SKU-{number}' in bloom for number in range(10_000))
+    false_positives = sum(f'OTHER-{number}' in bloom for number in range(10_000))
+    assert false_positives < 300
+
+
+def test_missing_skus_are_rejected_until_they_expire_or_are_added(clock):
+    registry = SkuRegistry(lambda: None, refresh_interval=10, clock=clock)
+    # Без фильтра отвечает база
+    assert registry.might_exist('GARBAGE')
+
+    registry.record_missing('GARBAGE')
+    registry.record_missing('LATER-ADDED')
+    assert not registry.might_exist('GARBAGE')
+
+    registry.add('LATER-ADDED')
+    assert registry.might_exist('LATER-ADDED')
+
+    clock.now = 11
+    assert registry.might_exist('GARBAGE')
+
+
+def test_missing_skus_are_bounded():
+    registry = SkuRegistry(lambda: None, missing_size=2)
+    for sku in ('A', 'B', 'C'):
+        registry.record_missing(sku)
+    assert registry.might_exist('A')
+    assert not registry.might_exist('B')
+    assert not registry.might_exist('C')